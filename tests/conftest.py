@@ -0,0 +1,111 @@
+# Shared fixtures: the finders are built around small synthetic layers, without the building data files.
+
+import os
+import sys
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import geopandas
+import shapely
+import pytest
+from sqlalchemy import create_engine
+
+# the utilities package, from the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utilities.BldgFinder import BldgFinder
+from utilities.spatial_index import BldgIndex
+
+
+def grid_layer(n=400, names=None):
+    """ n 30m x 20m buildings on a grid in London, ids b0, b1, ... """
+    x = -0.13 + (np.arange(n) % 20) * 0.001
+    y = 51.5 + (np.arange(n) // 20) * 0.001
+    return geopandas.GeoDataFrame({'id': ['b{}'.format(i) for i in range(n)],
+                                   'name': names if names is not None else [None] * n},
+                                  geometry=shapely.box(x, y, x + 0.0003, y + 0.0002), crs="EPSG:4326")
+
+
+def make_finder(layer, city='london', geocode_cache=None, geocoder=None, local_geocoder=None):
+    """ BldgFinder over layer, skipping the load of the city data. """
+    finder = BldgFinder.__new__(BldgFinder)
+    finder.city = city
+    finder.country = BldgFinder.city_to_country_mapper[city]
+    finder.geocode_cache = geocode_cache
+    finder.geocoder = geocoder
+    finder.local_geocoder = local_geocoder
+    finder.bldg_data = layer
+    finder.bldg_index = BldgIndex(layer.geometry)
+    finder._centroid_index = None
+    finder._centroid_lock = threading.Lock()
+    finder.popup_template = BldgFinder.make_popup_template(layer.columns)
+    return finder
+
+
+@pytest.fixture(scope='session')
+def pg_url(tmp_path_factory):
+    """ Postgres for the tests of the SQL paths: TEST_DATABASE_URL when set, else a throwaway pgserver instance; the tests
+    are skipped without either. """
+    url = os.environ.get('TEST_DATABASE_URL')
+    if url is not None:
+        yield url
+        return
+    pgserver = pytest.importorskip('pgserver')
+    server = pgserver.get_server(str(tmp_path_factory.mktemp('pg')), cleanup_mode='stop')
+    # the driver of the repo, psycopg2
+    yield server.get_uri().replace('postgresql://', 'postgresql+psycopg2://', 1)
+    server.cleanup()
+
+
+@pytest.fixture
+def pg_engine(pg_url):
+    """ Engine of its own per test, so no statement stays prepared across tests on replaced tables. """
+    engine = create_engine(pg_url)
+    yield engine
+    engine.dispose()
+
+
+def load_tables(engine, tables):
+    """ Replaces the tables of the database with the frames of tables, a dict name -> DataFrame. """
+    for name, frame in tables.items():
+        frame.to_sql(name, engine, if_exists='replace', index=False)
+
+
+@pytest.fixture
+def layer():
+    return grid_layer()
+
+
+@pytest.fixture
+def stub_nominatim():
+    """ Local http server answering like Nominatim /search: a point on building b<n> for queries starting with a number
+    n, no result otherwise. Yields (url, the queries received). """
+    queries = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            from urllib.parse import urlparse, parse_qs
+            q = parse_qs(urlparse(self.path).query)['q'][0]
+            queries.append(q)
+            first = q.split()[0]
+            results = []
+            if first.isdigit():
+                i = int(first)
+                lon, lat = -0.13 + (i % 20) * 0.001 + 0.0001, 51.5 + (i // 20) * 0.001 + 0.0001
+                results = [{'lat': str(lat), 'lon': str(lon), 'display_name': q, 'address': {'country': 'UK'},
+                            'geojson': {'type': 'Point', 'coordinates': [lon, lat]}}]
+            payload = json.dumps(results).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}/search".format(server.server_address[1]), queries
+    server.shutdown()
+    server.server_close()
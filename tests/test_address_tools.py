@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pandas as pd
+os.environ.setdefault("RY_API_KEY", "test")
+from utilities import address_tools_demo as at
+from utilities.ry_client import BatchClient, BatchResult
+
+
+class EchoClient(BatchClient):
+    """ Answers every batch without posting it: property ry<custom_id> for every address. """
+
+    def post(self, url, payload, batch=0):
+        try:
+            payload = payload()
+        except Exception as e:
+            return BatchResult(batch, None, None, str(e), 0)
+        matches = [{'params': p, 'property_id': 'ry' + p['custom_id']} for p in payload['params']]
+        return BatchResult(batch, payload, {'matches': matches}, None, 1)
+
+
+def test_expand_abbv():
+    assert at.expand_abbv("12 W 34th St.") == "12 West 34th Street"
+
+
+def test_token_memo_is_bounded():
+    at._expand_token.cache_clear()
+    first = [at._expand_token(t) for t in ["St.", "Ave", "Broadway"]]
+    hits = at._expand_token.cache_info().hits
+    assert [at._expand_token(t) for t in ["St.", "Ave", "Broadway"]] == first == ["Street", "Avenue", "Broadway"]
+    assert at._expand_token.cache_info().hits == hits + 3
+    # every distinct token of a long run doesn't stay in memory
+    for i in range(at._expand_token.cache_info().maxsize + 100):
+        at._expand_token("t{}".format(i))
+    info = at._expand_token.cache_info()
+    assert info.currsize == info.maxsize and at._expand_token("St.") == "Street"
+
+
+def test_parse_address_series_matches_parse_address():
+    addresses = pd.Series(["350 5th Ave, New York, NY 10118", "1 W 72nd St New York NY", "350 5th Ave, New York, NY 10118"],
+                          index=[5, 6, 7])
+    parsed = at.parse_address_series(addresses, processes=2, chunksize=1)
+    assert parsed.index.tolist() == [5, 6, 7]
+    assert parsed.tolist() == [at.parse_address(a, verbose=False) for a in addresses]
+    assert parsed[5] is not parsed[7]
+
+
+def test_get_ry_id_for_df_parses_in_processes():
+    # more distinct addresses than a chunk, so they go to the process pool
+    streets = ["{} Broadway, New York, NY".format(n) for n in range(1, 601)]
+    df = pd.DataFrame({'address': streets + streets[:100]}, index=np.arange(700) + 1000)
+    df.loc[1150, 'address'] = np.nan
+    client = EchoClient(max_in_flight=2)
+    ids = at.get_ry_id_for_df(df, client=client, processes=2)
+    # the batch holding the missing address fails alone
+    assert len(client.failures) == 1 and client.failures[0].batch == 1
+    assert ids.shape[0] == 600 and ids[1000] == 'ry1000' and 1150 not in ids.index
+
+
+def test_resumed_job_reports_failures_by_batch_number():
+    streets = ["{} Broadway, New York, NY".format(n) for n in range(1, 401)]
+    df = pd.DataFrame({'address': streets})
+    df.loc[350, 'address'] = np.nan
+    client = EchoClient(max_in_flight=2)
+    batches = [batch for batch, _ in at.iter_ry_id_batches(df, client=client, skip_batches={0, 1})]
+    assert batches == [2]
+    assert [res.batch for res in client.failures] == [3]
+
+
+def test_match_address_is_quiet(monkeypatch, capsys):
+    class Answer:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {'matches': [{'property_id': 'ry1'}]}
+    monkeypatch.setattr(at.requests, 'post', lambda *args, **kwargs: Answer())
+    assert at._match_address("350 5th Ave, New York, NY 10118") == 'ry1'
+    assert capsys.readouterr().out == ''
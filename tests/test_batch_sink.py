@@ -0,0 +1,43 @@
+import pandas as pd
+from utilities.batch_sink import BatchSink
+
+
+def batch_frame(batch, n=3):
+    return pd.DataFrame({'original_idx': range(batch * 10, batch * 10 + n),
+                         'addresses': [['{} main street'.format(i)] for i in range(n)]})
+
+
+def test_csv_resume_drops_a_half_written_batch(tmp_path):
+    path = str(tmp_path / "out.csv")
+    sink = BatchSink(path, list_cols=['addresses'])
+    sink.write(0, batch_frame(0))
+    sink.write(1, batch_frame(1))
+    # crash halfway through batch 2: part of its rows reached the csv, the batch list never got it
+    with open(path, 'a') as f:
+        f.write(batch_frame(2).assign(batch=2).to_csv(index=False, header=False)[:25])
+
+    sink = BatchSink(path, list_cols=['addresses'])
+    assert sink.done_batches() == {0, 1}
+    sink.write(2, batch_frame(2))
+    frame = sink.read()
+    assert frame.groupby('batch').size().to_dict() == {0: 3, 1: 3, 2: 3}
+    assert frame.original_idx.tolist() == [0, 1, 2, 10, 11, 12, 20, 21, 22]
+    assert frame.addresses.iloc[0] == ['0 main street']
+
+
+def test_csv_resume_before_the_first_batch_completes(tmp_path):
+    path = str(tmp_path / "out.csv")
+    with open(path, 'w') as f:
+        f.write("original_idx,addresses,batch\n0,")
+    sink = BatchSink(path, list_cols=['addresses'])
+    assert sink.done_batches() == set()
+    assert sink.read().empty
+    sink.write(0, batch_frame(0))
+    assert sink.read().shape[0] == 3
+
+
+def test_empty_batches_count_as_done(tmp_path):
+    sink = BatchSink(str(tmp_path / "out.csv"), list_cols=['addresses'])
+    sink.write(0, batch_frame(0, n=0))
+    sink.write(1, batch_frame(1))
+    assert BatchSink(sink.path).done_batches() == {0, 1}
@@ -0,0 +1,16 @@
+import pandas as pd
+import shapely
+from utilities import bldg_store
+
+
+def test_partition_round_trip(tmp_path):
+    df = pd.DataFrame({'id': ['a', 'b'],
+                       'levels': [3., None],
+                       'geo': [repr({'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}),
+                               {'type': 'Polygon', 'coordinates': [[[2, 2], [3, 2], [3, 3], [2, 3], [2, 2]]]}]})
+    bldg_store.write_partition(df, 'xx', str(tmp_path))
+    assert bldg_store.has_partition('xx', str(tmp_path))
+    layer = bldg_store.read_partition('xx', str(tmp_path))
+    assert layer.id.tolist() == ['a', 'b'] and layer.crs.to_epsg() == 4326
+    assert layer.geometry.values[1].equals(shapely.box(2, 2, 3, 3))
+    assert shapely.get_num_coordinates(layer.geometry.values[0]) == 4
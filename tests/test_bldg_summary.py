@@ -0,0 +1,95 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+from utilities import bldg_summary
+from utilities.bldg_summary import BldgSummary
+from conftest import load_tables
+
+TODAY = pd.Timestamp(dt.date.today())
+
+
+def summary_tables():
+    leases = pd.DataFrame({'property_id': ['ck0', 'ck0', 'ck1', 'ck1', 'ck2', 'ck3', 'ck3'],
+                           'current_rent': [50., np.nan, 70., 80., 60., 40., 45.],
+                           'transaction_size': [1000., 500., 2000., 1000., 3000., 800., 700.],
+                           'commencement_date': TODAY - pd.to_timedelta([400, 100, 300, 900, 50, 2000, 30], unit='D'),
+                           'expiration_date': TODAY + pd.to_timedelta([300, 600, 100, -10, 900, 50, 400], unit='D'),
+                           'touched_at': pd.Timestamp('2020-01-01')})
+    mapping = pd.DataFrame({'ck_id': ['ck0', 'ck1', 'ck2', 'ck3'], 'ry_id': ['r0', 'r1', 'r2', 'r3']})
+    bldgs = pd.DataFrame({'reonomy_id': ['r0', 'r1', 'r2', 'r3', 'r4'],
+                          'rsf': [10000., 20000., 15000., 5000., 8000.],
+                          'perc_known': [80., 100., 50., np.nan, 0.],
+                          'perc_vacant': [5., 0., 10., np.nan, 0.],
+                          'perc_occupied': [75., 100., 40., np.nan, 0.]})
+    return {'leases_ck': leases, 'ck_to_ry': mapping, 'properties_ry': bldgs}
+
+
+def reference(tables, ry_ids):
+    """ The KPIs, lease by lease in pandas. """
+    leases = tables['leases_ck'].merge(tables['ck_to_ry'], left_on='property_id', right_on='ck_id')
+    current = leases.loc[(leases.commencement_date <= TODAY) & (leases.expiration_date > TODAY)]
+    rows = []
+    for _, b in tables['properties_ry'].loc[tables['properties_ry'].reonomy_id.isin(ry_ids)].iterrows():
+        cur = current.loc[current.ry_id == b.reonomy_id]
+        known = cur.current_rent.notna()
+        rows.append({'ry_id': b.reonomy_id, 'rsf': b.rsf, 'perc_known': b.perc_known, 'perc_vacant': b.perc_vacant,
+                     'perc_occupied': b.perc_occupied, 'current_leases': cur.shape[0],
+                     'leased_sf': cur.transaction_size.sum(), 'mean_rent': cur.current_rent.mean(),
+                     'known_rent_revenue': (cur.transaction_size * cur.current_rent)[known].sum(),
+                     'unknown_rent_sf': cur.transaction_size[~known].sum()})
+    return pd.DataFrame(rows).set_index('ry_id').loc[:, bldg_summary.summary_cols]
+
+
+def check(summary, tables, ry_ids):
+    pd.testing.assert_frame_equal(summary.frame.loc[ry_ids], reference(tables, ry_ids), check_dtype=False,
+                                  check_names=False)
+
+
+def test_snapshot_and_refresh(pg_engine, tmp_path):
+    tables = summary_tables()
+    load_tables(pg_engine, tables)
+    ry_ids = ['r0', 'r1', 'r2', 'r3', 'r4']
+    summary = BldgSummary(str(tmp_path / 'summary.parquet'))
+    assert summary.build(pg_engine, ry_ids) == 5
+    check(summary, tables, ry_ids)
+    assert summary.is_fresh() and summary.lookup('r4')['current_leases'] == 0
+    assert bldg_summary.mean_rent(summary.lookup('r1')) == 70.
+
+    # read back from disk, nothing changed
+    summary = BldgSummary(str(tmp_path / 'summary.parquet'))
+    assert summary.refresh(pg_engine) == 0
+    check(summary, tables, ry_ids)
+
+    # a lease of r1 touched
+    tables['leases_ck'].loc[2, ['current_rent', 'touched_at']] = [90., pd.Timestamp('2021-01-01')]
+    load_tables(pg_engine, tables)
+    assert summary.refresh(pg_engine) == 1
+    check(summary, tables, ry_ids)
+    assert summary.lookup('r1')['mean_rent'] == 90.
+
+
+def test_refresh_drops_deleted_buildings(pg_engine, tmp_path):
+    tables = summary_tables()
+    load_tables(pg_engine, tables)
+    summary = BldgSummary(str(tmp_path / 'summary.parquet'))
+    summary.build(pg_engine, ['r0', 'r1', 'r2', 'r3'])
+    # r2 deleted, its lease touched by the deletion
+    tables['properties_ry'] = tables['properties_ry'].loc[tables['properties_ry'].reonomy_id != 'r2']
+    tables['leases_ck'].loc[4, 'touched_at'] = pd.Timestamp('2021-01-01')
+    load_tables(pg_engine, tables)
+    assert summary.refresh(pg_engine) == 1
+    assert summary.frame.index.tolist() == ['r0', 'r1', 'r3']
+    assert summary.lookup('r2') is None
+    check(summary, tables, ['r0', 'r1', 'r3'])
+
+
+def test_stale_snapshot_is_not_served(pg_engine, tmp_path):
+    load_tables(pg_engine, summary_tables())
+    summary = BldgSummary(str(tmp_path / 'summary.parquet'), max_age=dt.timedelta(hours=1))
+    summary.build(pg_engine, ['r0', 'r1'])
+    summary.meta['refreshed_at'] = (dt.datetime.now() - dt.timedelta(hours=2)).isoformat()
+    assert not summary.is_fresh() and summary.lookup('r0') is None and summary.lookup_many(['r0']).empty
+    summary.meta['as_of'] = (dt.date.today() - dt.timedelta(days=1)).isoformat()
+    summary.refresh(pg_engine)
+    assert summary.is_fresh() and summary.lookup('r0') is not None
@@ -0,0 +1,54 @@
+import pytest
+from utilities import queries
+from utilities.Building_demo import Building
+
+
+class _Captured(Exception):
+    pass
+
+
+def test_registered_bldg_queries_list_their_columns():
+    for name in ('bldg_f42', 'bldg_f42_sales', 'bldg_leases', 'bldg_vacancies'):
+        assert '*' not in queries.queries[name].sql, name
+    assert 'f42.rsf' in queries.queries['bldg_f42'].sql
+    assert 'lis.price' in queries.queries['bldg_f42_sales'].sql
+
+
+def test_section_query_lists_the_f42_columns(monkeypatch):
+    captured = {}
+
+    def read(engine, name, params=None, **kwargs):
+        captured['sql'] = queries.queries[name].sql
+        raise _Captured()
+
+    monkeypatch.setattr(queries, 'read', read)
+    bldg = Building.__new__(Building)
+    bldg.ry_id, bldg.db_engine = 'r1', None
+    with pytest.raises(_Captured):
+        bldg.load_bldg_sections(['f42_bldg', 'f42_sales'])
+    assert '*' not in captured['sql']
+    assert ', '.join('f42_data.' + c for c in Building.f42_bldg_cols) in captured['sql']
+    assert ', '.join('lis.' + c for c in Building.f42_sales_cols) in captured['sql']
+
+
+def test_section_queries_are_registered_once(monkeypatch):
+    names = [name for name in queries.queries if name.startswith('bldg_sections_')]
+    assert len(names) == 2 ** (len(Building.load_sections) - 1) and all(n.startswith('bldg_sections_0') for n in names)
+    read = []
+
+    def capture(engine, name, params=None, **kwargs):
+        read.append(name)
+        raise _Captured()
+
+    monkeypatch.setattr(queries, 'read', capture)
+    registered = dict(queries.queries)
+    bldg = Building.__new__(Building)
+    bldg.ry_id, bldg.db_engine = 'r1', None
+    for include in (['f42_sales', 'leases'], ['leases', 'f42_sales', 'metadata'], [], Building.load_sections):
+        with pytest.raises(_Captured):
+            bldg.load_bldg_sections(include)
+    # in load_sections order, whatever the order asked, and nothing registered on the way
+    assert read == ['bldg_sections_025', 'bldg_sections_025', 'bldg_sections_0', 'bldg_sections_012345']
+    assert queries.queries == registered
+    sql = queries.queries['bldg_sections_025'].sql
+    assert sql.index('AS metadata') < sql.index('AS leases') < sql.index('AS f42_sales') and 'AS vacancies' not in sql
@@ -0,0 +1,37 @@
+import pytest
+from sqlalchemy import create_engine, text
+from utilities import db
+from utilities.Market_demo import Market
+
+
+@pytest.fixture
+def injected(monkeypatch):
+    monkeypatch.delenv(db.DEFAULT_URL_ENV, raising=False)
+    engine = db.set_engine(create_engine("sqlite://"))
+    yield engine
+    db.dispose_engines()
+
+
+def test_injected_engine_is_the_default(injected):
+    assert db.get_engine() is injected
+    assert Market(['1', '2']).db_engine is injected
+    with db.get_engine().connect() as conn:
+        assert conn.execute(text("SELECT 1")).scalar() == 1
+    metrics = db.pool_metrics()
+    assert metrics['checkouts'] == 1 and metrics['checkins'] == 1
+
+
+def test_engines_are_shared_by_url(monkeypatch):
+    monkeypatch.setenv(db.DEFAULT_URL_ENV, "sqlite://")
+    try:
+        assert db.get_engine() is db.get_engine() is db.get_engine("sqlite://")
+        assert db.get_engine("sqlite:///:memory:") is not db.get_engine()
+    finally:
+        db.dispose_engines()
+
+
+def test_default_engine_needs_a_url(monkeypatch):
+    monkeypatch.delenv(db.DEFAULT_URL_ENV, raising=False)
+    db.dispose_engines()
+    with pytest.raises(KeyError):
+        db.get_engine()
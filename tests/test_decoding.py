@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+from utilities.decoding import decode, concat_decoded, lease_dtypes
+
+
+def test_concat_decoded_with_an_all_null_chunk():
+    chunks = [decode(pd.DataFrame({'tenant_name': ['A', 'B'], 'current_rent': [10.1, 20.2]}), lease_dtypes),
+              decode(pd.DataFrame({'tenant_name': [None, None], 'current_rent': [None, 30.3]}), lease_dtypes),
+              decode(pd.DataFrame({'tenant_name': ['C', 'A'], 'current_rent': [1, 2]}), lease_dtypes)]
+    frame = concat_decoded(chunks)
+    assert isinstance(frame.tenant_name.dtype, pd.CategoricalDtype)
+    assert list(frame.tenant_name.cat.categories) == ['A', 'B', 'C']
+    assert frame.tenant_name.tolist()[:2] == ['A', 'B'] and frame.tenant_name.isna().tolist()[2:4] == [True, True]
+
+
+def test_rents_keep_float64_precision():
+    rents = pd.Series([123456.78, 234567.89, 345678.91] * 1000)
+    frame = decode(pd.DataFrame({'current_rent': rents.astype(object), 'transaction_size': rents.astype(object)}),
+                   lease_dtypes)
+    assert frame.current_rent.dtype == np.float64 and frame.transaction_size.dtype == np.float64
+    assert frame.current_rent.sum() == rents.sum()
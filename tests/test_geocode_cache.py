@@ -0,0 +1,67 @@
+import time
+from utilities.geocode_cache import GeocodeCache, normalize_address
+from conftest import make_finder
+
+
+def test_normalize_address():
+    assert normalize_address("  9, Bloomsbury St.  London ") == "9 bloomsbury st london"
+
+
+def test_nominatim_answers_are_cached(layer, stub_nominatim):
+    url, queries = stub_nominatim
+    cache = GeocodeCache(':memory:')
+    finder = make_finder(layer, geocode_cache=cache)
+    finder.base_url_nominatim = url
+
+    first = finder._search_address("12 Some Street")
+    again = finder._search_address("12 some street,")
+    assert first == again
+    assert queries == ["12 Some Street"]
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    matches = finder.find_many(["12 Some Street", "7 Other Road"], max_workers=2)
+    assert matches.bldg_id.tolist() == ['b12', 'b7']
+    assert queries == ["12 Some Street", "7 Other Road"]
+
+
+def test_not_found_is_cached(layer, stub_nominatim):
+    url, queries = stub_nominatim
+    cache = GeocodeCache(':memory:')
+    finder = make_finder(layer, geocode_cache=cache)
+    finder.base_url_nominatim = url
+
+    assert finder._search_address("nowhere") is None
+    assert finder._search_address("Nowhere") is None
+    assert queries == ["nowhere"]
+    assert cache.get("nowhere", 'gb') == (True, None)
+
+
+def test_expiry():
+    cache = GeocodeCache(':memory:', ttl=60, negative_ttl=0)
+    cache.set("1 a street", 'gb', {'lat': '1'})
+    cache.set("nowhere", 'gb', None)
+    time.sleep(0.01)
+    # the negative entry is past its TTL, the positive one isn't
+    assert cache.get("nowhere", 'gb') == (False, None)
+    assert cache.get("1 a street", 'gb') == (True, {'lat': '1'})
+
+
+def test_lru_eviction():
+    cache = GeocodeCache(':memory:', max_entries=2)
+    cache.set("1 a street", 'gb', {'lat': '1'})
+    time.sleep(0.01)
+    cache.set("2 b street", 'gb', {'lat': '2'})
+    time.sleep(0.01)
+    cache.get("1 a street", 'gb')
+    time.sleep(0.01)
+    cache.set("3 c street", 'gb', {'lat': '3'})
+    assert cache.stats()['entries'] == 2
+    assert cache.get("2 b street", 'gb') == (False, None)
+    assert cache.get("1 a street", 'gb')[0] and cache.get("3 c street", 'gb')[0]
+
+
+def test_cache_is_keyed_on_service_and_country():
+    cache = GeocodeCache(':memory:')
+    cache.set("1 a street", 'gb', {'lat': '1'})
+    assert cache.get("1 a street", 'fr') == (False, None)
+    assert cache.get("1 a street", 'gb', service='reonomy') == (False, None)
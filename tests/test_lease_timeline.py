@@ -0,0 +1,63 @@
+import datetime as dt
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from utilities.lease_timeline import LeaseTimeline
+from conftest import load_tables
+
+current_sql = "SELECT id FROM leases_ck WHERE commencement_date <= :day AND expiration_date > :day ORDER BY id"
+expiring_sql = "SELECT id FROM leases_ck WHERE commencement_date <= :day AND expiration_date > :day \
+                AND expiration_date <= :horizon ORDER BY id"
+
+DAYS = [dt.date(2019, 1, 31), dt.date(2019, 12, 31), dt.date(2020, 2, 29), dt.date(2020, 6, 15), dt.date(2021, 3, 1)]
+
+
+def lease_frame(n=200):
+    rng = np.random.default_rng(11)
+    starts = pd.Timestamp('2017-01-01') + pd.to_timedelta(rng.integers(0, 1600, n), unit='D')
+    ends = starts + pd.to_timedelta(rng.integers(1, 1500, n), unit='D')
+    leases = pd.DataFrame({'id': np.arange(n), 'commencement_date': starts.date, 'expiration_date': ends.date,
+                           'current_rent': rng.uniform(30, 90, n), 'transaction_size': rng.integers(1, 20, n) * 500.,
+                           'touched_at': pd.Timestamp('2020-01-01')})
+    # leases starting or ending exactly on the days asked about, and leases without dates
+    leases.loc[:4, 'commencement_date'] = DAYS
+    leases.loc[5:9, 'expiration_date'] = DAYS
+    leases.loc[10:14, 'expiration_date'] = [d + relativedelta(months=12) for d in DAYS]
+    leases.loc[15, 'commencement_date'] = None
+    leases.loc[16, 'expiration_date'] = None
+    return leases
+
+
+def sql_ids(engine, sql, **params):
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(text(sql), params)]
+
+
+def test_timeline_matches_the_sql_filters(pg_engine):
+    leases = lease_frame()
+    load_tables(pg_engine, {'leases_ck': leases})
+    timeline = LeaseTimeline(leases.sample(frac=1, random_state=0))
+    for day in DAYS:
+        assert sorted(timeline.active_at(day).id) == sql_ids(pg_engine, current_sql, day=day), day
+        for months in (1, 6, 12):
+            horizon = day + relativedelta(months=months)
+            assert sorted(timeline.expiring_within(months, day).id) == \
+                sql_ids(pg_engine, expiring_sql, day=day, horizon=horizon), (day, months)
+
+
+def test_refreshed_timeline_matches_the_sql_filters(pg_engine):
+    leases = lease_frame()
+    timeline = LeaseTimeline(leases)
+    # extended, shortened and new leases
+    changed = leases.loc[[20, 21, 22]].copy()
+    changed['expiration_date'] = [dt.date(2025, 1, 1), dt.date(2019, 1, 1), dt.date(2020, 6, 15)]
+    added = leases.loc[[23]].assign(id=999, commencement_date=dt.date(2020, 6, 15))
+    changed = pd.concat([changed, added]).assign(touched_at=pd.Timestamp('2020-07-01'))
+    assert timeline.refresh(changed) == 4
+    load_tables(pg_engine, {'leases_ck': pd.concat([leases.loc[~leases.id.isin(changed.id)], changed])})
+    assert timeline.last_touched == pd.Timestamp('2020-07-01')
+    for day in DAYS:
+        assert sorted(timeline.active_at(day).id) == sql_ids(pg_engine, current_sql, day=day), day
+        assert sorted(timeline.expiring_within(12, day).id) == \
+            sql_ids(pg_engine, expiring_sql, day=day, horizon=day + relativedelta(months=12)), day
@@ -0,0 +1,119 @@
+import os
+import pandas as pd
+from utilities.BldgFinder import BldgFinder
+from utilities.geocode_cache import GeocodeCache
+from utilities.local_geocoder import LocalGeocoder, normalize_tokens, read_address_extract
+from conftest import grid_layer, make_finder
+
+
+def named_layer():
+    names = [None] * 400
+    names[7], names[42], names[99], names[300] = 'The Nadler', 'The London Eye', 'The Nadler Covent Garden', 'Café Königsbau'
+    return grid_layer(names=names)
+
+
+def extract(layer):
+    points = layer.geometry.representative_point()
+    return pd.DataFrame({'housenumber': ['9', '62', '12a', '5'],
+                         'street': ['Bloomsbury Street', 'Mittelstraße', 'Rue des Prairies', 'London Road'],
+                         'name': None,
+                         'lon': points.x.values[[10, 20, 30, 40]], 'lat': points.y.values[[10, 20, 30, 40]]})
+
+
+def test_read_address_extract(tmp_path):
+    path = str(tmp_path / 'gb.csv')
+    extract(named_layer()).drop(columns='name').rename(
+        columns={'housenumber': 'addr:housenumber', 'street': 'addr:street'}).to_csv(path, index=False)
+    frame = read_address_extract(path)
+    assert list(frame.columns) == ['housenumber', 'street', 'name', 'lon', 'lat']
+    assert frame.housenumber.tolist() == ['9', '62', '12a', '5']
+
+
+def test_normalize_tokens():
+    assert normalize_tokens("62 Mittelstr., Café") == ['62', 'mittelstrasse', 'cafe']
+    assert normalize_tokens("9 Bloomsbury St") == ['9', 'bloomsbury', 'street']
+
+
+def test_lookups():
+    layer = named_layer()
+    geocoder = LocalGeocoder.from_layer(layer, 'gb', 'london', extract=extract(layer))
+    found = dict((q, geocoder.lookup(q)) for q in
+                 ["the nadler london", "The Nadler, London, UK", "the nadler convent garden", "The London Eye",
+                  "cafe konigsbau", "9 Bloomsbury St, London WC1B 3QJ", "Bloomsbury Street 9", "62 Mittelstr.",
+                  "12A rue des prairies, 75020", "5 London Road, London", "10 Bloomsbury Street", "somewhere else"])
+    assert found["the nadler london"]['match'] == 'name'
+    assert found["The Nadler, London, UK"]['display_name'] == 'The Nadler, London'
+    assert found["the nadler convent garden"]['match'] == 'fuzzy_name'
+    assert found["the nadler convent garden"]['display_name'] == 'The Nadler Covent Garden, London'
+    assert found["The London Eye"]['display_name'] == 'The London Eye, London'
+    assert found["cafe konigsbau"]['match'] == 'name'
+    for q in ["9 Bloomsbury St, London WC1B 3QJ", "Bloomsbury Street 9", "62 Mittelstr.", "12A rue des prairies, 75020",
+              "5 London Road, London"]:
+        assert found[q]['match'] == 'address', q
+    assert found["10 Bloomsbury Street"] is None and found["somewhere else"] is None
+    assert geocoder.stats()['hits'] == 10 and geocoder.stats()['misses'] == 2
+
+
+def test_find_many_falls_back_on_misses():
+    layer = named_layer()
+    remote = []
+
+    def stub(address):
+        remote.append(address)
+        return None
+    finder = make_finder(layer, local_geocoder=LocalGeocoder.from_layer(layer, 'gb', 'london', extract=extract(layer)))
+    finder._search_remote = stub
+    matches = finder.find_many(["the nadler london", "9 bloomsbury street", "nowhere at all", "the london eye"])
+    assert matches.bldg_id.tolist()[:2] == ['b7', 'b10'] and matches.bldg_id.tolist()[3] == 'b42'
+    assert matches.match_type.tolist() == ['intersect', 'intersect', 'not_found', 'intersect']
+    assert remote == ["nowhere at all"]
+
+
+def test_injected_geocoder_answers_alone(monkeypatch):
+    layer = named_layer()
+    monkeypatch.setattr(BldgFinder, 'get_bldg_data', lambda self: layer)
+    assert BldgFinder('london', geocode_cache=GeocodeCache(':memory:')).local_geocoder is not None
+
+    finder = BldgFinder('london', geocode_cache=GeocodeCache(':memory:'), geocoder=lambda address: None)
+    assert finder.local_geocoder is None
+    assert finder.find_many(["the nadler london"]).match_type.tolist() == ['not_found']
+
+
+def test_near_miss_names_go_remote():
+    names = [None] * 400
+    names[5], names[6] = 'Kings Place', 'St Pauls Cathedral School'
+    layer = grid_layer(names=names)
+    remote = []
+
+    def stub(address):
+        remote.append(address)
+        return None
+    finder = make_finder(layer, local_geocoder=LocalGeocoder.from_layer(layer, 'gb', 'london'))
+    finder._search_remote = stub
+    matches = finder.find_many(["kings place", "kings palace", "st pauls cathedral"])
+    assert matches.match_type.tolist() == ['intersect', 'not_found', 'not_found']
+    assert remote == ["kings palace", "st pauls cathedral"]
+
+
+def test_extract_index_is_built_once(tmp_path, monkeypatch):
+    from utilities import local_geocoder
+    layer = named_layer()
+    path = str(tmp_path / 'gb.csv')
+    extract(layer).to_csv(path, index=False)
+    built = local_geocoder.LocalGeocoder.from_layer(layer, 'gb', 'london', extract=path)
+    assert os.path.exists(os.path.join(path + '.london.index', 'meta.json'))
+
+    def no_read(path):
+        raise AssertionError("the extract is read again")
+    monkeypatch.setattr(local_geocoder, 'read_address_extract', no_read)
+    loaded = local_geocoder.LocalGeocoder.from_layer(layer, 'gb', 'london', extract=path)
+    assert loaded.stats() == built.stats()
+    for q in ["9 Bloomsbury St, London", "62 Mittelstr.", "Bloomsbury Stret 9", "the nadler london"]:
+        assert loaded.lookup(q) == built.lookup(q), q
+    assert loaded.lookup("Bloomsbury Stret 9")['match'] == 'fuzzy_address'
+
+    # a changed extract is indexed again
+    monkeypatch.undo()
+    extract(layer).iloc[:2].to_csv(path, index=False)
+    os.utime(path, (0, 0))
+    assert LocalGeocoder.from_layer(layer, 'gb', 'london', extract=path).stats()['addresses'] == 2
@@ -0,0 +1,83 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+from utilities import market_stats, queries
+from utilities.decoding import decode, market_lease_dtypes
+from conftest import load_tables
+
+DAY = dt.date(2020, 6, 15)
+
+
+def market_tables():
+    rng = np.random.default_rng(7)
+    n = 60
+    starts = pd.Timestamp('2016-01-01') + pd.to_timedelta(rng.integers(0, 1800, n), unit='D')
+    leases = pd.DataFrame({'property_id': ['ck{}'.format(i % 7) for i in range(n)],
+                           'current_rent': np.where(rng.random(n) < 0.2, np.nan, rng.uniform(30, 90, n).round(2)),
+                           'transaction_size': np.where(rng.random(n) < 0.1, np.nan, rng.integers(1, 30, n) * 500.),
+                           'commencement_date': starts,
+                           'expiration_date': starts + pd.to_timedelta(rng.integers(200, 2500, n), unit='D'),
+                           'submarket': rng.choice(['Midtown', 'Soho', None], n),
+                           'space_type': rng.choice(['Office', 'Retail'], n),
+                           'touched_at': pd.Timestamp('2020-01-01')})
+    mapping = pd.DataFrame({'ck_id': ['ck{}'.format(i) for i in range(7)], 'ry_id': ['r0', 'r1', 'r2', 'r2', 'r3',
+                                                                                      'r4', 'r9']})
+    bldgs = pd.DataFrame({'reonomy_id': ['r0', 'r1', 'r2', 'r3', 'r4', 'r5'],
+                          'rsf': [100000., 50000., 0., 80000., np.nan, 20000.]})
+    return {'leases_ck': leases, 'ck_to_ry': mapping, 'properties_ry': bldgs}
+
+
+def local_dataset(tables, ry_ids):
+    leases = tables['leases_ck'].merge(tables['ck_to_ry'], left_on='property_id', right_on='ck_id')
+    leases = leases.loc[leases.ry_id.isin(ry_ids), market_stats.lease_cols]
+    bldgs = tables['properties_ry'].loc[tables['properties_ry'].reonomy_id.isin(ry_ids), market_stats.bldg_cols]
+    return decode(leases, market_lease_dtypes), bldgs
+
+
+def same(sql, local):
+    sql = sql.reset_index(drop=True)
+    local = local.reset_index(drop=True).astype(dict((c, object) for c in local.columns
+                                                     if isinstance(local[c].dtype, pd.CategoricalDtype)))
+    assert list(sql.columns) == list(local.columns)
+    pd.testing.assert_frame_equal(sql.replace({None: np.nan}), local.replace({None: np.nan}), check_dtype=False)
+
+
+@pytest.fixture
+def market(pg_engine):
+    tables = market_tables()
+    load_tables(pg_engine, tables)
+    ry_ids = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5']
+    leases, bldgs = local_dataset(tables, ry_ids)
+    return pg_engine, ry_ids, leases, bldgs
+
+
+@pytest.mark.parametrize('group_by', [None, 'building', 'submarket', ['submarket', 'space_type']])
+def test_rent_stats_parity(market, group_by):
+    engine, ry_ids, leases, _ = market
+    percentiles = (0.1, 0.5, 0.9)
+    same(market_stats.rent_stats_sql(engine, ry_ids, group_by, percentiles, DAY),
+         market_stats.rent_stats_local(leases, group_by, percentiles, DAY))
+
+
+@pytest.mark.parametrize('by_building', [True, False])
+def test_occupancy_parity(market, by_building):
+    engine, ry_ids, leases, bldgs = market
+    same(market_stats.occupancy_sql(engine, ry_ids, by_building, DAY),
+         market_stats.occupancy_local(leases, bldgs, by_building, DAY))
+
+
+@pytest.mark.parametrize('group_by', [None, 'building', 'space_type'])
+def test_expiring_sf_parity(market, group_by):
+    engine, ry_ids, leases, _ = market
+    same(market_stats.expiring_sf_sql(engine, ry_ids, group_by, 24, DAY),
+         market_stats.expiring_sf_local(leases, group_by, 24, DAY))
+
+
+def test_aggregates_go_through_queries_read(market):
+    engine, ry_ids, _, _ = market
+    queries.timings.clear()
+    market_stats.rent_stats_sql(engine, ry_ids, 'submarket', (0.125,), DAY)
+    market_stats.occupancy_sql(engine, ry_ids, False, DAY)
+    assert [t.name for t in queries.timings] == ['market_rent_stats_submarket_p12d5', 'market_occupancy_all']
+    assert all(t.prepared for t in queries.timings)
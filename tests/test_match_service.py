@@ -0,0 +1,75 @@
+import json
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from utilities import match_service
+from conftest import make_finder
+
+
+def stub_geocoder(address):
+    """ A point on building b<n> for "<n> ...", an area around it for "<n> ... area", not found otherwise. """
+    first = address.split()[0]
+    if not first.isdigit():
+        return None
+    i = int(first)
+    lon, lat = -0.13 + (i % 20) * 0.001 + 0.0001, 51.5 + (i // 20) * 0.001 + 0.0001
+    geojson = {'type': 'Polygon', 'coordinates': []} if address.endswith('area') else \
+        {'type': 'Point', 'coordinates': [lon, lat]}
+    return {'lat': str(lat), 'lon': str(lon), 'display_name': address, 'address': {'country': 'UK'}, 'geojson': geojson}
+
+
+@pytest.fixture
+def service_url(layer):
+    service = match_service.MatchService({'London': make_finder(layer, geocoder=stub_geocoder)})
+    server = match_service.make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def call(url, body=None):
+    """ Status and json answer of a GET, or of a POST of body. """
+    request = urllib.request.Request(url, data=body)
+    try:
+        with urllib.request.urlopen(request) as r:
+            return r.status, json.load(r)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_match(service_url):
+    status, match = call(service_url + "/match?address=12%20Some%20Street")
+    assert status == 200
+    assert (match['bldg_id'], match['match_type'], match['distance']) == ('b12', 'intersect', 0.)
+    assert match['attributes']['id'] == 'b12'
+    assert call(service_url + "/match?address=5%20Some%20area&city=london")[1]['match_type'] == 'nearest_centroid'
+    assert call(service_url + "/match?address=nowhere")[1]['match_type'] == 'not_found'
+    assert call(service_url + "/match?address=1&city=paris")[0] == 400
+    assert call(service_url + "/match")[0] == 400
+    assert call(service_url + "/nowhere")[0] == 404
+
+
+def test_match_batch(service_url):
+    status, matches = call(service_url + "/match_batch",
+                           json.dumps({'addresses': ['1 a', '2 b', 'nowhere'], 'city': 'London'}).encode())
+    assert status == 200
+    assert [m['bldg_id'] for m in matches] == ['b1', 'b2', None]
+    assert [m['bldg_id'] for m in call(service_url + "/match_batch", b'["3 c"]')[1]] == ['b3']
+    for body in [b'not json', b'"x"', b'3', b'{"addresses": "1 a"}']:
+        assert call(service_url + "/match_batch", body)[0] == 400, body
+
+
+def test_concurrent_matches_and_stats(service_url):
+    def match(i):
+        return call(service_url + "/match?address={}%20St".format(i))[1]['bldg_id'] == 'b{}'.format(i)
+    with ThreadPoolExecutor(16) as pool:
+        assert all(pool.map(match, range(200)))
+    call(service_url + "/match_batch", b'["1 a"]')
+    status, stats = call(service_url + "/stats")
+    assert status == 200
+    assert stats['/match']['requests'] == 200 and stats['/match_batch']['requests'] == 1
+    assert 0 < stats['/match']['p50_ms'] <= stats['/match']['p99_ms'] <= stats['/match']['max_ms']
+    assert call(service_url + "/health")[1] == {'cities': ['london']}
@@ -0,0 +1,37 @@
+import geopandas as gpd
+from shapely.geometry import Point
+from utilities import nearby
+from utilities.nearby import LocationIndex
+
+
+def locations(city, category, n=5):
+    return gpd.GeoDataFrame({'reonomy_id': ['{}{}{}'.format(city, category, i) for i in range(n)],
+                             'address_city': city, 'category': category},
+                            geometry=gpd.points_from_xy([-73.98 + 0.001 * i for i in range(n)], [40.75] * n),
+                            crs="EPSG:4326").rename_geometry('location')
+
+
+def test_default_index_per_city_and_category(tmp_path, monkeypatch):
+    monkeypatch.setattr(nearby, 'DEFAULT_PATH', str(tmp_path / 'locations.parquet'))
+    monkeypatch.setattr(nearby, '_default_index', {})
+    loaded = []
+
+    def from_db(engine, city='MN', category='Office'):
+        loaded.append((city, category))
+        return LocationIndex(locations(city, category))
+    monkeypatch.setattr(LocationIndex, 'from_db', staticmethod(from_db))
+
+    LocationIndex(locations('MN', 'Office')).write(nearby.location_path('MN', 'Office'))
+    point = Point(-73.98, 40.75)
+    manhattan = nearby.default_location_index()
+    brooklyn = nearby.default_location_index('engine', city='BK')
+    retail = nearby.default_location_index('engine', category='Retail')
+    # the MN offices read from their file, the others loaded from the database and written next to it
+    assert loaded == [('BK', 'Office'), ('MN', 'Retail')]
+    assert (tmp_path / 'locations_BK_Office.parquet').exists() and (tmp_path / 'locations_MN_Retail.parquet').exists()
+    assert manhattan.surrounding(point, 500).id.tolist() == ['MNOffice{}'.format(i) for i in range(5)]
+    assert brooklyn.surrounding(point, 500, city='BK').id.tolist() == ['BKOffice{}'.format(i) for i in range(5)]
+    assert retail.surrounding(point, 500, category='Retail', limit=2).id.tolist() == ['MNRetail0', 'MNRetail1']
+    # then served from memory
+    assert nearby.default_location_index(city='BK') is brooklyn and nearby.default_location_index() is manhattan
+    assert len(loaded) == 2
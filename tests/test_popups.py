@@ -0,0 +1,59 @@
+import html
+import numpy as np
+import pandas as pd
+from utilities.popups import PopupTemplate, escape
+
+
+def missing(value):
+    return not isinstance(value, (dict, list)) and pd.isna(value)
+
+
+def reference_popup(row, title, fields, bold, blanks, formatted):
+    """ One building at a time, html.escape on every value. """
+    popup = "<h3> " + ('' if missing(row[title]) else html.escape(str(row[title]))) + " </h3>"
+    for label, column in fields:
+        if column in row and not missing(formatted(column, row[column])):
+            popup += (("<b>{}:</b> " if label in bold else "{}: ").format(html.escape(label))
+                      + html.escape(str(formatted(column, row[column]))) + "<br>")
+    return popup + ''.join("{}: <br>".format(html.escape(label)) for label in blanks)
+
+
+def buildings():
+    return pd.DataFrame({'Address': ['1 <b>Main</b> St', "O'Neil & Sons", None, '"Quoted" Plaza', '1 <b>Main</b> St'],
+                         'Building ID': ['abcdef123456789', 'x<y>z&w', 'plainid', 'abcdef123456789', '12345678901'],
+                         'Year Built': [1990., np.nan, 1990., 2005., 1880.],
+                         'Floors': pd.array([10, 3, None, 10, 2], dtype='Int64'),
+                         'Owner': ['<script>x</script>', 'A & B', np.nan, "it's", 'A & B'],
+                         'Amenities': [{'gym': '<yes>'}, {}, None, {'roof': 'a&b'}, {'gym': '<yes>'}],
+                         'Elevators': [True, False, None, True, True]},
+                        index=[10, 11, 12, 13, 14])
+
+
+def test_render_and_table_match_html_escape():
+    fields = [('Baya ID', 'Building ID'), ('Year <Built>', 'Year Built'), ('Floors', 'Floors'), ('Owner', 'Owner'),
+              ('Amenities', 'Amenities'), ('Elevators', 'Elevators'), ('Not loaded', 'Missing Column')]
+    template = PopupTemplate('Address', fields, bold=['Baya ID'], blanks=['Tenants & Co'],
+                             formatters={'Building ID': lambda ids: ids.astype(str).str[:8]})
+    frame = buildings()
+
+    def formatted(column, value):
+        return str(value)[:8] if column == 'Building ID' else value
+
+    expected = [reference_popup(row, 'Address', fields, ['Baya ID'], ['Tenants & Co'], formatted)
+                for _, row in frame.iterrows()]
+    assert template.render(frame).tolist() == expected
+    assert template.render(frame).index.tolist() == frame.index.tolist()
+
+    table = template.table(frame)
+    assert list(table.columns) == ['Address', 'Baya ID', 'Year <Built>', 'Floors', 'Owner', 'Amenities', 'Elevators']
+    for label, column in [('Address', 'Address')] + fields[:-1]:
+        assert table[label].tolist() == ['' if missing(formatted(column, v)) else html.escape(str(formatted(column, v)))
+                                         for v in frame[column]], label
+
+
+def test_escape_matches_html_escape():
+    for column, values in buildings().items():
+        escaped = escape(values)
+        assert escaped.index.equals(values.index)
+        assert [None if missing(v) else v for v in escaped] == \
+            [None if missing(v) else html.escape(str(v)) for v in values], column
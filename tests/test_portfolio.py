@@ -0,0 +1,70 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+from utilities import bldg_summary
+from utilities.Building_demo import Building
+from utilities.lease_timeline import LeaseTimeline
+from utilities.portfolio import portfolio_revenue
+
+TODAY = pd.Timestamp(dt.date.today())
+
+
+def buildings():
+    """ Buildings with their lease timeline loaded, so their estimates are computed live from the leases. """
+    rng = np.random.default_rng(5)
+    bldgs = []
+    for i, (rsf, perc_known, perc_vacant) in enumerate([(10000., 40., 5.), (20000., 100., 0.), (15000., 0., 10.),
+                                                        (8000., 120., 2.), (30000., 75., 20.), (5000., 60., 0.)]):
+        n = 0 if i == 5 else int(rng.integers(1, 8))
+        leases = pd.DataFrame({'id': np.arange(n) + 100 * i,
+                               'current_rent': np.where(rng.random(n) < 0.3, np.nan, rng.uniform(30, 90, n)),
+                               'transaction_size': np.where(rng.random(n) < 0.1, np.nan, rng.integers(1, 20, n) * 250.),
+                               'commencement_date': TODAY - pd.to_timedelta(rng.integers(1, 900, n), unit='D'),
+                               'expiration_date': TODAY + pd.to_timedelta(rng.integers(-100, 900, n), unit='D')})
+        bldg = Building.__new__(Building)
+        bldg.ry_id, bldg.rsf, bldg.perc_known, bldg.perc_vacant = 'r{}'.format(i), rsf, perc_known, perc_vacant
+        bldg.lease_timeline = LeaseTimeline(leases)
+        bldgs.append(bldg)
+    return bldgs
+
+
+def kpis(bldgs):
+    rows = []
+    for b in bldgs:
+        active = b.lease_timeline.active_at()
+        known = active.current_rent.notna()
+        rows.append({'ry_id': b.ry_id, 'rsf': b.rsf, 'perc_known': b.perc_known, 'perc_vacant': b.perc_vacant,
+                     'current_leases': active.shape[0],
+                     'known_rent_revenue': (active.transaction_size * active.current_rent)[known].sum(),
+                     'unknown_rent_sf': active.transaction_size[~known].sum()})
+    return pd.DataFrame(rows).set_index('ry_id')
+
+
+def test_portfolio_matches_the_buildings():
+    bldgs = buildings()
+    result = portfolio_revenue(kpis(bldgs), 55.)
+    for b in bldgs:
+        assert np.isclose(result.loc[b.ry_id, 'estimated_revenue'], b.get_estimated_revenue(55.)), b.ry_id
+        assert np.isclose(result.loc[b.ry_id, 'knotel_revenue_increase'], b.get_knotel_revenue_increase(55.)), b.ry_id
+
+
+def test_scenarios_and_rent_per_building():
+    bldgs = buildings()
+    rents = pd.Series([40., 50., 60., 70., 80., 90.], index=[b.ry_id for b in bldgs])
+    occupied, vacant = [0.5, 0.75, 1.], [0.1, 0.25]
+    result = portfolio_revenue(kpis(bldgs), rents, occupied, vacant)
+    for b in bldgs:
+        for o in occupied:
+            assert np.isclose(result.loc[b.ry_id, ('estimated_revenue', o)],
+                              b.get_estimated_revenue(rents[b.ry_id], occupied_from_unknown=o)), (b.ry_id, o)
+        for v in vacant:
+            assert np.isclose(result.loc[b.ry_id, ('knotel_revenue_increase', v)],
+                              b.get_knotel_revenue_increase(rents[b.ry_id], vacant_from_unknown=v)), (b.ry_id, v)
+
+
+def test_unknown_perc_known_counts_as_zero():
+    # as bldg_summary.estimated_revenue does for a building served from the snapshot
+    summaries = kpis(buildings()[:1]).assign(perc_known=np.nan)
+    result = portfolio_revenue(summaries, 55.)
+    assert np.isclose(result.estimated_revenue.iloc[0], bldg_summary.estimated_revenue(summaries.iloc[0], 55.))
+    assert result.knotel_revenue_increase.iloc[0] == 0
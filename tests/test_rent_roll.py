@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+from utilities.rent_roll import rent_roll
+from utilities.Building_demo import Building
+
+
+def lease_frame():
+    return pd.DataFrame({'Address': ['1 Main St', '1 Main St', '5 Park Ave', '5 Park Ave', '9 Elm St'],
+                         'Start Date': pd.to_datetime(['2015-02-10', '2016-01-01', '2014-11-30', '2018-03-31',
+                                                       '2017-06-15']),
+                         'End Date': pd.to_datetime(['2019-06-30', '2017-12-31', '2016-03-30', '2021-01-01',
+                                                     '2017-07-15']),
+                         'Rent': [100., 50., 80., 120., 30.]})
+
+
+def loop_rent_roll(comps):
+    """ The rent roll show_lease_comps used to build, one date_range frame per lease. """
+    cq = pd.concat([pd.DataFrame({'Quarter': pd.date_range(row['Start Date'], row['End Date'], freq='QE'),
+                                  'Address': row.Address, 'Rent': row.Rent},
+                                 columns=['Quarter', 'Address', 'Rent']) for i, row in comps.iterrows()],
+                   ignore_index=True)
+    cq = cq.groupby(['Address', 'Quarter']).sum().reset_index()
+    cq = cq.pivot(index='Quarter', columns='Address', values='Rent')
+    cq.loc[:, "Area Average"] = cq.mean(axis=1)
+    return cq
+
+
+def test_rent_roll_matches_the_loop():
+    comps = lease_frame()
+    expected = loop_rent_roll(comps)
+    roll = rent_roll(comps)
+    # the lease ending 2017-07-15 covers no quarter end, the loop drops it as well
+    assert list(roll.columns) == list(expected.columns)
+    assert (roll.index.values == expected.index.values).all()
+    pd.testing.assert_frame_equal(roll, expected, check_names=False, check_freq=False, check_index_type=False)
+
+
+def test_show_lease_comps_plots_headless():
+    matplotlib = pytest.importorskip('matplotlib')
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    bldg = Building.__new__(Building)
+    comps = lease_frame()
+    bldg.surrounding_current_leases = comps.assign(**{'Starting Rate': comps.Rent, 'Size': 10.})
+    ax = bldg.show_lease_comps()
+    assert [line.get_label() for line in ax.get_lines()] == list(bldg.rent_roll.columns)
+    assert ax.get_xlim()[0] < ax.get_xlim()[1]
+    plt.close('all')
@@ -0,0 +1,54 @@
+import os
+import pandas as pd
+from sqlalchemy import create_engine, text
+from utilities.result_cache import ResultCache
+
+SQL = "SELECT tenant_name FROM leases_ck WHERE ry_id = :ry_id"
+
+
+def leases_engine():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE leases_ck (ry_id TEXT, tenant_name TEXT, touched_at TEXT)"))
+        conn.execute(text("INSERT INTO leases_ck VALUES ('1', 'A', '2026-01-01')"))
+    return engine
+
+
+def test_rows_touched_during_the_query_invalidate_it():
+    engine = leases_engine()
+    cache = ResultCache(path=None, mark_interval=0)
+    marks = cache.query_marks(engine, SQL)
+    with engine.connect() as conn:
+        frame = pd.read_sql(text(SQL), conn, params={'ry_id': '1'})
+    # a lease touched after the query ran, before its result is cached
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO leases_ck VALUES ('1', 'B', '2026-01-02')"))
+    cache.put(engine, 'leases', SQL, {'ry_id': '1'}, frame, marks=marks)
+    assert cache.get(engine, 'leases', SQL, {'ry_id': '1'}) is None
+
+
+def test_cached_until_touched():
+    engine = leases_engine()
+    cache = ResultCache(path=None, mark_interval=0)
+    frame = pd.DataFrame({'tenant_name': ['A']})
+    cache.put(engine, 'leases', SQL, {'ry_id': '1'}, frame, marks=cache.query_marks(engine, SQL))
+    assert cache.get(engine, 'leases', SQL, {'ry_id': '1'}).equals(frame)
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE leases_ck SET touched_at = '2026-02-01'"))
+    assert cache.get(engine, 'leases', SQL, {'ry_id': '1'}) is None
+
+
+def test_failed_parquet_write_leaves_no_temp_file(tmp_path, monkeypatch):
+    def partial_write(frame, path, *args, **kwargs):
+        with open(path, 'w') as f:
+            f.write("PAR1")
+        raise ValueError("can't convert")
+    monkeypatch.setattr(pd.DataFrame, 'to_parquet', partial_write)
+    engine = leases_engine()
+    cache = ResultCache(path=str(tmp_path))
+    frame = pd.DataFrame({'amenities': [{'gym': True}, 'none', 3]})
+    cache.put(engine, 'amenities', "SELECT 1", {}, frame)
+    # pickled instead
+    assert sorted(os.path.splitext(f)[1] for f in os.listdir(str(tmp_path))) == ['.json', '.pkl']
+    assert ResultCache(path=str(tmp_path)).get(engine, 'amenities', "SELECT 1", {}).amenities.tolist() == \
+        frame.amenities.tolist()
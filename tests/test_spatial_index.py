@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import geopandas
+import shapely
+import pytest
+from shapely.geometry import Point
+from utilities.Building_demo import Building
+from utilities.spatial_index import BldgIndex
+from conftest import grid_layer, make_finder
+
+# the scans compare distances in degrees, as the code they replaced did
+pytestmark = pytest.mark.filterwarnings("ignore:Geometry is in a geographic CRS")
+
+
+def overlapping_layer():
+    # the grid plus a few buildings overlapping it, so points hit several footprints
+    layer = grid_layer(n=100)
+    extra = geopandas.GeoDataFrame({'id': ['o0', 'o1', 'o2'], 'name': None},
+                                   geometry=[shapely.box(-0.1298, 51.5001, -0.1285, 51.5012),
+                                             shapely.box(-0.1265, 51.5031, -0.1262, 51.5032),
+                                             shapely.box(-0.1250, 51.5040, -0.1247, 51.5042)], crs="EPSG:4326")
+    return pd.concat([layer, extra], ignore_index=True)
+
+
+def probe_points(layer, n=150):
+    rng = np.random.default_rng(3)
+    points = list(shapely.points(rng.uniform(-0.1305, -0.1105, n), rng.uniform(51.4995, 51.5055, n)))
+    # on a corner, on an edge and inside of a footprint
+    points += [Point(-0.13, 51.5), Point(-0.12985, 51.5), Point(-0.1299, 51.5001)]
+    return points
+
+
+def scan_closest_finder(df, point):
+    """ BldgFinder._get_closest_bldg before the index: every intersecting row, else the nearest one. """
+    hits = df[df.geometry.intersects(point)]
+    if not hits.empty:
+        return hits.index.tolist()
+    distance = df.geometry.distance(point)
+    return [distance.index[int(np.argmin(distance.values))]]
+
+
+def scan_closest_building(df, location):
+    """ Building.get_closest_bldg before the index: the single row containing, else intersecting, else touching the
+    location, the nearest one otherwise. """
+    closest = df[df.geometry.contains(location)]
+    if closest.empty:
+        closest = df[df.geometry.intersects(location)]
+    if closest.empty:
+        closest = df[df.geometry.touches(location)]
+    if closest.empty or closest.shape[0] > 1:
+        distance = df.geometry.distance(location)
+        return [distance.index[int(np.argmin(distance.values))]]
+    return closest.index.tolist()
+
+
+def test_finder_matches_the_scan():
+    layer = overlapping_layer()
+    finder = make_finder(layer)
+    for point in probe_points(layer):
+        found = finder._get_closest_bldg({'geojson': {'type': 'Point', 'coordinates': [point.x, point.y]}})
+        assert found.index.tolist() == scan_closest_finder(layer, point), point
+
+
+def test_area_match_uses_the_nearest_centroid():
+    layer = overlapping_layer()
+    finder = make_finder(layer)
+    centroids = layer.geometry.centroid
+    for point in probe_points(layer, 50):
+        found = finder._get_closest_bldg({'geojson': {'type': 'Polygon'}, 'lon': point.x, 'lat': point.y})
+        assert found.index.tolist() == [int(np.argmin(centroids.distance(point).values))]
+
+
+def test_building_matches_the_scan():
+    layer = overlapping_layer()
+    bldg = Building.__new__(Building)
+    bldg.osm_data, bldg.osm_index = layer, BldgIndex(layer.geometry)
+    points = probe_points(layer)
+    for point in points:
+        bldg.location = point
+        assert bldg.get_closest_bldg().index.tolist() == scan_closest_building(layer, point), point
+    # the bulk version, as BuildingSet uses it
+    assert bldg.osm_index.closest_bulk(points).tolist() == [scan_closest_building(layer, p)[0] for p in points]
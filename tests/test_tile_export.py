@@ -0,0 +1,80 @@
+import os
+import json
+import threading
+import urllib.request
+import folium
+import shapely
+from utilities import tile_export
+from conftest import grid_layer
+
+
+def tile_ids(tile_dir, zoom):
+    ids = {}
+    for x in os.listdir(os.path.join(tile_dir, str(zoom))):
+        for name in os.listdir(os.path.join(tile_dir, str(zoom), x)):
+            with open(os.path.join(tile_dir, str(zoom), x, name)) as f:
+                ids[(int(x), int(name.split('.')[0]))] = [feature['id'] for feature in json.load(f)['features']]
+    return ids
+
+
+def test_export_tiles(tmp_path, layer):
+    # a long building across several tiles at zoom 17
+    layer.loc[0, 'geometry'] = shapely.box(-0.135, 51.5, -0.125, 51.5002)
+    tile_dir = str(tmp_path)
+    written = tile_export.export_tiles(layer, zooms=(15, 17), tile_dir=tile_dir)
+    with open(os.path.join(tile_dir, "tiles.json")) as f:
+        index = json.load(f)
+    assert index['zooms'] == [15, 17]
+    for zoom in (15, 17):
+        ids = tile_ids(tile_dir, zoom)
+        assert sorted(map(tuple, index['tiles'][str(zoom)])) == sorted(ids) and written[zoom] == len(ids)
+        # every building in every tile its bounding box touches, once per tile
+        for (x, y), features in ids.items():
+            assert len(features) == len(set(features))
+        assert set(i for features in ids.values() for i in features) == set(range(layer.shape[0]))
+    spanned = [t for t, features in tile_ids(tile_dir, 17).items() if 0 in features]
+    x0, _ = tile_export.tile_xy(-0.135, 51.5, 17)
+    x1, _ = tile_export.tile_xy(-0.125, 51.5, 17)
+    assert sorted(set(x for x, y in spanned)) == list(range(int(x0), int(x1) + 1))
+
+
+def test_tiles_are_served_with_cors(tmp_path, layer):
+    tile_export.export_tiles(layer, zooms=(16,), tile_dir=str(tmp_path))
+    server = tile_export.serve_tiles(str(tmp_path), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        r = urllib.request.urlopen("http://127.0.0.1:{}/tiles.json".format(server.server_address[1]))
+        assert r.headers['Access-Control-Allow-Origin'] == '*'
+        assert json.load(r)['zooms'] == [16]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_add_tiles_embeds_no_footprint():
+    fmap = folium.Map(location=[51.5, -0.13], zoom_start=16)
+    tile_export.add_tiles(fmap, "http://localhost:8001/", tooltip='id', popup_fields=['id', '<b>'])
+    page = fmap.get_root().render()
+    assert '"http://localhost:8001"' in page and "map.on('moveend', update)" in page
+    assert '"\\u0026lt;b\\u0026gt;"' in page or '&lt;b&gt;' in page
+    assert 'coordinates' not in page
+
+
+def test_exported_text_properties_are_escaped(tmp_path):
+    layer = grid_layer(n=4, names=['<b>Smith & Co</b>', None, 'Plain', 'x'])
+    tile_export.export_tiles(layer.assign(floors=[1, 2, 3, 4]), zooms=(16,), tile_dir=str(tmp_path),
+                             properties=('id', 'name', 'floors'))
+    features = {}
+    for x in os.listdir(os.path.join(str(tmp_path), "16")):
+        for name in os.listdir(os.path.join(str(tmp_path), "16", x)):
+            with open(os.path.join(str(tmp_path), "16", x, name)) as f:
+                features.update((feature['id'], feature['properties']) for feature in json.load(f)['features'])
+    assert features[0]['name'] == '&lt;b&gt;Smith &amp; Co&lt;/b&gt;'
+    assert features[1]['name'] is None and features[2]['name'] == 'Plain'
+    assert features[0]['floors'] == 1
+
+
+def test_add_buildings_escapes_tooltips():
+    fmap = folium.Map(location=[51.5, -0.13], zoom_start=16)
+    gj = tile_export.add_buildings(fmap, grid_layer(n=1), tooltips=['<script>x</script>'])
+    assert gj.data['features'][0]['properties']['tooltip'] == '&lt;script&gt;x&lt;/script&gt;'
@@ -1,8 +1,18 @@
+import json
+import threading
 import pandas as pd, numpy as np
 import requests
+from concurrent.futures import ThreadPoolExecutor
 import geopandas
 import folium
+import shapely
 from shapely.geometry import Polygon, Point
+from . import bldg_store
+from . import tile_export
+from .spatial_index import BldgIndex
+from .popups import PopupTemplate
+from .geocode_cache import default_cache
+from .local_geocoder import LocalGeocoder
 
 class BldgFinder:
     
@@ -15,21 +25,46 @@ class BldgFinder:
                           'Residential Area': '', 'Office Area': '', 'Retail Area': '',
                           'Factory Area': '', 'Garage Area': '', 'Storage Area': '',
                           'Other Area': '', 'Amenities': '', 'Photos': ''}
+    base_url_nominatim = "https://nominatim.openstreetmap.org/search"
     
-    def __init__(self, city):
+    def __init__(self, city, geocode_cache=None, geocoder=None, local_geocoder=True):
         try:
             self.city = city
             self.country = self.city_to_country_mapper[city.lower()]
         except KeyError as e:
             print("City not available. Try one of: Berlin, London, Amsterdam, Dublin, or Paris.\n{}".format(e))
         
+        # persistent cache of the Nominatim answers, shared with the other finders unless one is passed in
+        self.geocode_cache = geocode_cache if geocode_cache is not None else default_cache()
+        # geocoder replacing Nominatim (and its cache): a function of the address returning a Nominatim-like result,
+        # with lat, lon, display_name, address and geojson, or None when not found; e.g. a stub in tests
+        self.geocoder = geocoder
         self.bldg_data = self.get_bldg_data()
         self.bldg_data = self.make_data_geospatial(self.bldg_data)
+        # built once per loaded city, answers the point-in-polygon and closest-polygon lookups of every find
+        self.bldg_index = BldgIndex(self.bldg_data.geometry)
+        # only needed for addresses geocoded to an area, built on the first one; under a lock, as the finders of the
+        # match service are shared by its request threads
+        self._centroid_index = None
+        self._centroid_lock = threading.Lock()
+        self.popup_template = self.make_popup_template(self.bldg_data.columns)
+        # offline geocoding over the building names (and the OSM address extract of the country, when there is one, its
+        # index built once and kept next to it), tried before Nominatim; True builds it from the layer, False turns it off. An injected geocoder answers alone
+        if geocoder is not None:
+            local_geocoder = None
+        elif local_geocoder is True:
+            local_geocoder = LocalGeocoder.from_layer(self.bldg_data, self.country, self.city.lower(),
+                                                      extract=LocalGeocoder.default_extract(self.country))
+        self.local_geocoder = local_geocoder or None
         print("Retrieved {:,} bldgs in {}".format(self.bldg_data.shape[0], city.capitalize()))
         
         
     def get_bldg_data(self):
         try:
+            # pre-parsed country partition, written once by bldg_store.convert_csv(..., partition_col='country')
+            if bldg_store.has_partition(self.country):
+                return bldg_store.read_partition(self.country)
+            print("No building store found for {}, falling back to the csv. Run bldg_store.convert_csv once to speed this up.".format(self.country))
             comb = pd.read_csv("./data/de_gb_nl_ie_fr_bldgs.csv")
             comb = comb.loc[(comb.country == self.country)]
             return comb
@@ -39,35 +74,69 @@ class BldgFinder:
             
     def make_data_geospatial(self, df):
         try:
-            df.geo.update(df.geo.apply(eval))
-            # Making a Geopandas from bldg data
-            df.loc[:, "geometry"] = df.geo.apply(lambda x: Polygon(x['coordinates'][0]))
-            gdf = geopandas.GeoDataFrame(df, geometry=df.geometry)
-            ## Adding geo-inverted columns (for plotting with folium)
-            gdf.loc[:, "geo_inv"] = gdf.geo.apply(lambda c: [ [(a[1],a[0]) for a in b] for b in c['coordinates']][0])
-            ## Adding centroid column
-            # required to look for closest polygon when address does not intersect
-            gdf.loc[:, "centroid"] = gdf.geometry.centroid
+            if isinstance(df, geopandas.GeoDataFrame):
+                # loaded from the building store, geometry is already built
+                gdf = df
+            else:
+                # Making a Geopandas from bldg data, the footprint polygons replacing the parsed geojson; rows indexed by
+                # position, as the ones read from the building store
+                geometry = [Polygon(x['coordinates'][0]) for x in df.geo.apply(eval)]
+                gdf = geopandas.GeoDataFrame(df.drop('geo', axis=1).reset_index(drop=True), geometry=geometry,
+                                             crs="EPSG:4326")
             return gdf
         except Exception as e:
             print("Error while making bldg data geospatial.\n{}".format(e))
             
         
+    @property
+    def centroid_index(self):
+        """ Index over the footprint centroids, to look for the closest building of an address geocoded to an area. Built
+        on first use. """
+        with self._centroid_lock:
+            if self._centroid_index is None:
+                self._centroid_index = BldgIndex(shapely.centroid(np.asarray(self.bldg_data.geometry)))
+            return self._centroid_index
+
+
     def _search_address(self, addss):
-        base_url_nominatim = "https://nominatim.openstreetmap.org/search"
+        obj = self._search_local(addss)
+        return obj if obj is not None else self._search_remote(addss)
+
+
+    def _search_local(self, addss):
         try:
-            params = {"q": addss,
-                      "format":"json",
-                      "polygon_geojson":1,
-                      "addressdetails":1,
-                      "countrycodes":'{}'.format(self.country)}
-            r = requests.get(base_url_nominatim, params=params)
-            return r.json()[0]
-        except IndexError:
-            print("Address not found.\nMake sure the address ({}) belongs to {}, {}".format(addss, self.city.capitalize(), self.country.upper()))
+            return self.local_geocoder.lookup(addss) if self.local_geocoder is not None else None
+        except Exception as e:
+            print("Error while searching locally for address: {}.\n{}".format(addss, e))
+            return None
+
+
+    def _search_remote(self, addss):
+        try:
+            if self.geocoder is not None:
+                obj = self.geocoder(addss)
+            else:
+                obj = self.geocode_cache.lookup(addss, self.country, lambda: self._query_nominatim(addss),
+                                                service='nominatim')
+            if obj is None:
+                print("Address not found.\nMake sure the address ({}) belongs to {}, {}".format(addss, self.city.capitalize(), self.country.upper()))
+            return obj
         except Exception as e:
             print("Error while searching for addresses: {}.\n{}".format(addss, e))
             return np.nan
+
+
+    def _query_nominatim(self, addss):
+        params = {"q": addss,
+                  "format":"json",
+                  "polygon_geojson":1,
+                  "addressdetails":1,
+                  "countrycodes":'{}'.format(self.country)}
+        r = requests.get(self.base_url_nominatim, params=params)
+        r.raise_for_status()
+        results = r.json()
+        # None is cached as "not found"
+        return results[0] if results else None
     
     
     def _get_closest_bldg(self, obj):
@@ -75,52 +144,73 @@ class BldgFinder:
         try:
             gj = obj['geojson']
             if (gj['type'] == 'Point'):
-                closest_bldg = df[df.geometry.intersects(Point(gj['coordinates']))]
+                point = Point(gj['coordinates'])
+                hits = self.bldg_index.query(point, predicate='intersects')
 
-                if not closest_bldg.empty:
-                    return closest_bldg
+                if hits.shape[0] > 0:
+                    return df.iloc[hits]
                 else:
-                    closest_bldg = df.loc[df.geometry.distance(Point(gj['coordinates'])).sort_values(ascending=True)[:1].index, :]
-                    return closest_bldg
+                    pos, _ = self.bldg_index.nearest(point)
+                    return df.iloc[[pos]]
             else:
-                closest_bldg = df.loc[df.centroid.distance(Point(float(obj['lon']), float(obj['lat']))).sort_values(ascending=True)[:1].index, :]
-                return closest_bldg
+                pos, _ = self.centroid_index.nearest(Point(float(obj['lon']), float(obj['lat'])))
+                return df.iloc[[pos]]
         except Exception as e:
             print("Error while matching address to building: {}.\n{}".format(e))
             return np.nan
     
     
-    def _create_text_box(self, obj, dfdict):
-        try:
-            pophtml = """
-                <h3> {title} </h3>
-                <b>Baya ID:</b> {bid}<br>
-                Country: {country}<br>
-                """.format(title=', '.join(obj['display_name'].split(',')[:3]), 
-                           bid=dfdict['id'], country=obj['address']['country'])
-            for k,v in dfdict.items():
-                if ('id' not in k) and ('country' not in k):
-                    pophtml = pophtml + "{}: {}<br>".format(k,v)
-            for k,v in self.baya_cols_pop_dict.items():
-                pophtml = pophtml + "{}: {}<br>".format(k,v)
-            return pophtml
-        except Exception as e:
-            print("Error while creating pop-up box: {}.\n{}".format(e))
-            return np.nan
+    @classmethod
+    def make_popup_template(cls, columns):
+        """ Popup of the buildings of a layer with these columns: the title, Baya id and country, every other attribute
+        of the layer, then the Baya attributes still to collect. """
+        attrs = [c for c in columns if c != 'geometry' and ('id' not in c) and ('country' not in c)]
+        return PopupTemplate('title', [('Baya ID', 'id'), ('Country', 'country')] + [(c, c) for c in attrs],
+                             bold=['Baya ID'], blanks=list(cls.baya_cols_pop_dict))
 
 
-    def find(self, addss):
+    def popups(self, bldgs, titles, countries=None, table=False):
+        """
+        Popups of buildings of the layer, rendered all at once.
+
+        Parameters
+        ----------
+        bldgs : GeoDataFrame
+            Rows of bldg_data.
+        titles : list
+            Title of every building, e.g. the address it was matched to.
+        countries : list, optional
+            Country shown for every building. Defaults to the country column of the layer.
+        table : bool, optional
+            Return the escaped attribute table instead of the html, see popups.PopupTemplate.table.
+
+        Returns
+        -------
+        A Pandas Series of html strings, or a Pandas DataFrame with table, aligned with bldgs
+        """
+        frame = bldgs.drop('geometry', axis=1).assign(title=list(titles))
+        if countries is not None:
+            frame['country'] = list(countries)
+        return self.popup_template.table(frame) if table else self.popup_template.render(frame)
+
+
+    def find(self, addss, tiles_url=None):
+        """ Geocodes an address, matches it to a building and shows both on a map. With tiles_url, the URL the tiles of
+        tile_export.export_tiles are served at, the surrounding buildings are drawn too. """
         obj = self._search_address(addss)
         closest_bldg = self._get_closest_bldg(obj)
-        pophtml = self._create_text_box(obj, closest_bldg.iloc[:, :-3]\
-                                     .drop('geo', axis=1).dropna(axis=1).to_dict(orient='rows')[0])
         try:
             # creates map
             bldg_poly = None
             gj = obj['geojson']
             address = obj['address']
+            title = ', '.join(obj['display_name'].split(',')[:3])
+            pophtml = self.popups(closest_bldg, [title] * closest_bldg.shape[0],
+                                  [address['country']] * closest_bldg.shape[0]).tolist()
 
             test_map = folium.Map(location=[float(obj['lat']), float(obj['lon'])], zoom_start=16)
+            if tiles_url is not None:
+                tile_export.add_tiles(test_map, tiles_url)
 
             obj_point = folium.Marker(location = (float(obj['lat']), float(obj['lon'])), color='red')
             obj_point.add_to(test_map)
@@ -128,20 +218,96 @@ class BldgFinder:
 
             if (gj['type'] == 'Point'):
                 # delineates the surrounding/closest bldg polygon
-                bldg_poly = folium.Polygon(locations = closest_bldg.geo_inv.values.tolist(),
-                                           color="red", fill=True, fill_color='#FF0000',
-                                           tooltip=folium.Tooltip(', '.join(obj['display_name'].split(',')[:3])),
-                                           popup=folium.Popup(pophtml, max_width=300))
-                bldg_poly.add_to(test_map)
+                bldg_poly = tile_export.add_buildings(test_map, closest_bldg, zoom=16,
+                                                      tooltips=[title] * closest_bldg.shape[0], popups=pophtml)
 
             if (gj['type'] == 'Polygon' and not bldg_poly):
                 obj_poly = folium.Polygon(locations = [[ (a[1],a[0]) for a in b] for b in gj['coordinates']], 
                                           color="red", fill=True, fill_color='#FF0000',
-                                          tooltip=folium.Tooltip(', '.join(obj['display_name'].split(',')[:3])),
-                                          popup=folium.Popup(pophtml, max_width=300))
+                                          tooltip=folium.Tooltip(title),
+                                          popup=folium.Popup(pophtml[0], max_width=300))
                 obj_poly.add_to(test_map)
 
             display(test_map)
             
         except Exception as e:
             print("Error while displaying bldg on map.\n{}".format(e))
+
+
+    def find_many(self, addresses, max_workers=4, attributes=False):
+        """
+        Batch version of find: geocodes every address and matches it to a building, without rendering any map.
+
+        Parameters
+        ----------
+        addresses : list or Pandas Series
+            Address strings to match. The index of a Series is kept in the result.
+        max_workers : int, optional
+            Maximum number of geocoding requests in flight at once.
+        attributes : bool, optional
+            Add an attributes column, holding the layer attributes of every matched building as a dict (None when not
+            matched).
+
+        Returns
+        -------
+        A Pandas DataFrame, one row per address, with the matched Baya building id, the match type ('intersect' when the
+        geocoded point falls on a building, 'nearest' when it does not, 'nearest_centroid' when the address geocodes to an
+        area instead of a point, 'not_found' when it could not be geocoded) and the distance to the building, in degrees
+        """
+        addresses = pd.Series(addresses)
+        # the addresses answered offline first, only the others go to the geocoder / Nominatim
+        objs = [self._search_local(a) for a in addresses.tolist()]
+        misses = [i for i, obj in enumerate(objs) if obj is None]
+        if len(misses) > 1 and max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                remote = list(pool.map(self._search_remote, addresses.values[misses].tolist()))
+        else:
+            remote = [self._search_remote(a) for a in addresses.values[misses].tolist()]
+        for i, obj in zip(misses, remote):
+            objs[i] = obj
+        return self._match_many(addresses, objs, attributes)
+
+
+    def _match_many(self, addresses, objs, attributes=False):
+        found = np.array([isinstance(obj, dict) for obj in objs], dtype=bool)
+        is_point = np.array([found[i] and objs[i]['geojson']['type'] == 'Point' for i in range(len(objs))], dtype=bool)
+        lat = np.array([float(obj['lat']) if found[i] else np.nan for i, obj in enumerate(objs)])
+        lon = np.array([float(obj['lon']) if found[i] else np.nan for i, obj in enumerate(objs)])
+        # geojson point when the geocoder returned one, its lon/lat otherwise, as in _get_closest_bldg
+        xy = np.array([objs[i]['geojson']['coordinates'][:2] if is_point[i] else (lon[i], lat[i]) for i in range(len(objs))],
+                      dtype='float64').reshape(-1, 2)
+        points = shapely.points(xy)
+
+        bldg_pos = np.full(len(objs), -1, dtype='int64')
+        distance = np.full(len(objs), np.nan)
+        match_type = np.where(found, 'nearest_centroid', 'not_found').astype(object)
+
+        # point-in-polygon for every geocoded point in a single spatial join, first building of the layer on multiple hits
+        pt_pos = np.flatnonzero(is_point)
+        inp, rows = self.bldg_index.query_bulk(points[pt_pos], predicate='intersects')
+        inp, first = np.unique(inp, return_index=True)
+        bldg_pos[pt_pos[inp]] = rows[first]
+        distance[pt_pos[inp]] = 0.
+        match_type[pt_pos] = 'nearest'
+        match_type[pt_pos[inp]] = 'intersect'
+
+        # closest polygon for the points that fell on no building
+        miss_pos = pt_pos[bldg_pos[pt_pos] < 0]
+        bldg_pos[miss_pos], distance[miss_pos] = self.bldg_index.nearest_bulk(points[miss_pos])
+        # closest centroid for the addresses geocoded to an area
+        area_pos = np.flatnonzero(found & ~is_point)
+        bldg_pos[area_pos], distance[area_pos] = self.centroid_index.nearest_bulk(points[area_pos])
+
+        matched = bldg_pos >= 0
+        bldg_id = np.full(len(objs), np.nan, dtype=object)
+        bldg_id[matched] = self.bldg_data.id.values[bldg_pos[matched]]
+        matches = pd.DataFrame({"address": addresses.values, "bldg_id": bldg_id, "match_type": match_type,
+                                "distance": distance, "lat": lat, "lon": lon}, index=addresses.index)
+        if attributes:
+            # missing values as None, numpy scalars as python ones, as json would give them back
+            attrs = self.bldg_data.iloc[bldg_pos[matched], np.flatnonzero(self.bldg_data.columns != 'geometry')]
+            values = np.full(len(objs), None, dtype=object)
+            values[matched] = json.loads(attrs.to_json(orient='records', date_format='iso'))
+            matches['attributes'] = values
+        return matches
+
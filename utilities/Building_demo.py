@@ -1,10 +1,28 @@
 import os
+import itertools
+import threading
 import datetime as dt
+from collections import namedtuple
 from dateutil.relativedelta import relativedelta
 import pandas as pd, geopandas as gpd, numpy as np
-from sqlalchemy import create_engine
 import folium
 from shapely.geometry import Polygon, Point
+from shapely import wkt
+from . import bldg_store
+from . import tile_export
+from .spatial_index import BldgIndex
+from .popups import PopupTemplate
+from .db import get_engine
+from .lease_timeline import LeaseTimeline
+from .rent_roll import rent_roll
+from . import bldg_summary
+from . import nearby
+from . import queries
+from .decoding import decode, lease_dtypes, vacancy_dtypes
+from .bldg_summary import default_summary
+
+# footprints of the NYC buildings with their spatial index, one per process
+FootprintLayer = namedtuple('FootprintLayer', ['data', 'index'])
 
 
 class Building:
@@ -12,57 +30,170 @@ class Building:
     mean building rent, upcoming lease expirations, etc.) along with information about buildings & tenants nearby. """
     # TO-DO: check that, and respond appropriately, if the dfs are empty. # self.current_availabilities = result if not result.empty else None
 
-    def __init__(self, ry_id):
+    ck_by = {
+            "address": "Address",
+            "id": "Lease ID",
+            "suite": "Unit ID",
+            "tenant_name": "Company Name",
+            "floor_occupancies": "Floor",
+            "transaction_size": "Size",
+            "property_id": "Company ID",
+            "execution_date": "Signing Date",
+            "commencement_date": "Start Date",
+            "expiration_date": "End Date",
+            "starting_rent": "Starting Rate",
+            "current_rent": "Current Rate",
+            "avg_rent": "Average Rate",
+            "asking_rent": "Asking Rate",
+            "lease_escalations": "Rate Increase",
+            "break_option_dates": "Termination Dates",
+            "break_option_type": "Termination Type",
+            "renewal_options": "Extension Options",
+            "sublease": "Subleased",
+            "free_rent_type": "Concession Type",
+            "work_value": "Concession Work Value"
+            }
+    ry_by = {"reonomy_id":"Building ID",
+                "lot_area":"Lot ID",
+                "address":"Address",
+                "floors":"Floors",
+                "year_built":"Year Built",
+                "year_renovated":"Year Renovated",
+                "rsf":"Total Sqft",
+                "category":"Type",
+                "class":"Class",
+                "lot_frontage":"Frontage",
+                "lot_depth":"Depth",
+                "residential_area":"Residential Area",
+                "office_area":"Office Area",
+                "retail_area":"Retail Area",
+                "factory_area":"Factory Area",
+                "garage_area":"Garage Area",
+                "storage_area":"Storage Area",
+                "other_area":"Other Area"}
+    # popup of a building on maps, from its characteristics (ry_by names)
+    popup_template = PopupTemplate('Address',
+                                   [('Baya ID', 'Building ID')] + [(k, k) for k in ry_by.values()
+                                                                   if ('Address' not in k) and ('Building' not in k)],
+                                   bold=['Baya ID'], formatters={'Building ID': lambda ids: ids.astype(str).str[:8]})
+    basics_cols = ['address', 'address_city', 'neighborhood', 'zipcode', 'address_state', 'rsf', 'location', 'year_built',
+                   'year_renovated', 'perc_known', 'perc_vacant', 'perc_occupied']
+    # lease columns used by the Building methods: the ck_by ones plus the raw ones of the Baya layers
+    lease_cols = ['id', 'address', 'suite', 'tenant_name', 'floor_occupancies', 'transaction_size', 'property_id',
+                  'execution_date', 'commencement_date', 'expiration_date', 'starting_rent', 'current_rent', 'avg_rent',
+                  'asking_rent', 'lease_escalations', 'break_option_dates', 'break_option_type', 'renewal_options',
+                  'sublease', 'free_rent_type', 'work_value', 'submarket', 'effective_rent', 'space_type', 'touched_at']
+    vacancy_cols = ['floor', 'floor_order', 'unit', 'unit_type', 'size', 'rate_per_sqft_per_year', 'details', 'touched_at',
+                    'lease_expiration']
+    # properties_f42 / listings_f42 columns shown, transposed, by get_f42_bldg_data and get_f42_sales_data
+    f42_bldg_cols = ['property_id', 'name', 'address', 'city', 'state', 'zipcode', 'building_class', 'year_built',
+                     'floors', 'rsf', 'touched_at']
+    f42_sales_cols = ['property_id', 'floor', 'unit', 'unit_type', 'size', 'price', 'details', 'touched_at']
+    load_sections = ['metadata', 'characteristics', 'leases', 'vacancies', 'f42_bldg', 'f42_sales']
+    _footprint_layer = None
+    _footprint_lock = threading.Lock()
+
+    def __init__(self, ry_id, include=None):
         self.ry_id = ry_id
-        # Connection to DB, fixed for now.Connecting to our main DB. TO-DO. Connect to follow-up test DB.
-        self.db_engine = create_engine(os.environ["DATABASE_URL_silhouetted"])
-        self.set_bldg_metadata()
-        self.osm_data = self.get_osm_data()
-        self.osm_data = self.make_osm_data_geospatial(self.osm_data)
-        self.ck_by = {
-                        "address": "Address",
-                        "id": "Lease ID",
-                        "suite": "Unit ID",
-                        "tenant_name": "Company Name",
-                        "floor_occupancies": "Floor",
-                        "transaction_size": "Size",
-                        "property_id": "Company ID",
-                        "execution_date": "Signing Date",
-                        "commencement_date": "Start Date",
-                        "expiration_date": "End Date",
-                        "starting_rent": "Starting Rate",
-                        "current_rent": "Current Rate",
-                        "avg_rent": "Average Rate",
-                        "asking_rent": "Asking Rate",
-                        "lease_escalations": "Rate Increase", 
-                        "break_option_dates": "Termination Dates",
-                        "break_option_type": "Termination Type",
-                        "renewal_options": "Extension Options",
-                        "sublease": "Subleased",
-                        "free_rent_type": "Concession Type",
-                        "work_value": "Concession Work Value"
-                    }
+        # Connection to DB, shared by every instance of the process, see db.get_engine
+        self.db_engine = get_engine()
+        if include is None:
+            self.set_bldg_metadata()
+        else:
+            self.load_bldg_sections(include)
+        # every Building of the process references the same footprint layer instead of owning a copy
+        layer = self.get_footprint_layer()
+        self.osm_data = layer.data
+        self.osm_index = layer.index
+
+
+    @classmethod
+    def get_footprint_layer(cls):
+        """ Process-wide footprint layer, loaded lazily on first use and shared by every Building and BuildingSet of the
+        process. """
+        with cls._footprint_lock:
+            if cls._footprint_layer is None:
+                data = cls.make_osm_data_geospatial(cls.get_osm_data())
+                cls._footprint_layer = FootprintLayer(data, BldgIndex(data.geometry))
+            return cls._footprint_layer
+
+
+    @classmethod
+    def load(cls, ry_id, include=None):
+        """ Builds a Building fetching metadata plus the requested sections (all of load_sections by default) in a single
+        round trip, see load_bldg_sections. Per-section timings are left in load_timings. """
+        return cls(ry_id, include=include if include is not None else cls.load_sections)
+
+
+    def load_bldg_sections(self, include):
+        """ One query, one round trip: every section is a json aggregate of its own sub-select, all of them sharing the
+        ck_to_ry/f42_to_ry mappings of the building through CTEs. Metadata is always included. The clock_timestamp()
+        columns between sections give the server time spent on each one (Postgres evaluates the select list in order).
+        Sections are loaded in load_sections order. """
+        unknown = set(include) - set(self.load_sections)
+        assert not unknown, "unknown sections: {}. Try any of {}".format(unknown, self.load_sections)
+        include = [sec for sec in self.load_sections if sec == 'metadata' or sec in include]
+        # registered below, one prepared statement per combination of sections
+        name = sections_query_name(include)
+
+        self.load_timings = {}
+        t0 = dt.datetime.now()
+        row = queries.read(self.db_engine, name, {'ry_id': str(self.ry_id)}).iloc[0]
+        self.load_timings['round_trip'] = (dt.datetime.now() - t0).total_seconds()
+        prev = 't_start'
+        for sec in include:
+            t0 = dt.datetime.now()
+            records = row[sec] if isinstance(row[sec], list) else []
+            frame = pd.DataFrame.from_records(records)
+            if sec == 'metadata':
+                frame['location'] = frame.reindex(columns=['location_wkt']).location_wkt\
+                                        .apply(lambda w: wkt.loads(w) if isinstance(w, str) else np.nan)
+                self._set_bldg_metadata(frame)
+            elif sec == 'characteristics':
+                self._set_ry_data(frame)
+            elif sec == 'leases':
+                frame = decode(frame.reindex(columns=self.lease_cols), lease_dtypes)
+                self.all_leases = frame
+                self.lease_timeline = LeaseTimeline(frame)
+                self.current_leases = self._format_leases(self.lease_timeline.active_at())
+            elif sec == 'vacancies':
+                frame = decode(frame.reindex(columns=self.vacancy_cols), vacancy_dtypes)
+                self.all_vacancies = frame
+                still_vacant_assumption_date = dt.datetime.today() + relativedelta(months= -6)
+                self.current_vacancies = frame.loc[frame.touched_at > still_vacant_assumption_date].copy()
+                self._format_vacancies()
+            elif sec == 'f42_bldg':
+                self.f42_bldg_data = frame.reindex(columns=self.f42_bldg_cols).transpose()
+            elif sec == 'f42_sales':
+                self.f42_sales_data = frame.reindex(columns=self.f42_sales_cols).transpose()
+            server_time = (pd.Timestamp(row['t_' + sec]) - pd.Timestamp(row[prev])).total_seconds()
+            self.load_timings[sec] = {'server': server_time, 'decode': (dt.datetime.now() - t0).total_seconds()}
+            prev = 't_' + sec
+        return self.load_timings
         
 
-    def get_osm_data(self):
+    @staticmethod
+    def get_osm_data():
         try:
+            # pre-parsed footprints, written once by bldg_store.convert_csv("./data/nyc.csv", partition='nyc')
+            if bldg_store.has_partition('nyc'):
+                return bldg_store.read_partition('nyc')
             comb = pd.read_csv("./data/nyc.csv")
             return comb
         except KeyError as e:
-            print("Error while importing building data for {}.\n{}".format(self.country, e))
+            print("Error while importing building data for NYC.\n{}".format(e))
             
             
-    def make_osm_data_geospatial(self, df):
+    @staticmethod
+    def make_osm_data_geospatial(df):
         try:
-            df.geo.update(df.geo.apply(eval))
-            # Making a Geopandas from bldg data
-            df.loc[:, "geometry"] = df.geo.apply(lambda x: Polygon(x['coordinates'][0]))
-            gdf = gpd.GeoDataFrame(df, geometry=df.geometry)
-            ## Adding geo-inverted columns (for plotting with folium)
-            gdf.loc[:, "geo_inv"] = gdf.geo.apply(lambda c: [ [(a[1],a[0]) for a in b] for b in c['coordinates']][0])
-            ## Adding centroid column
-            # required to look for closest polygon when address does not intersect
-            gdf.loc[:, "centroid"] = gdf.geometry.centroid
+            if isinstance(df, gpd.GeoDataFrame):
+                # loaded from the building store, geometry is already built
+                gdf = df
+            else:
+                # Making a Geopandas from bldg data, the footprint polygons replacing the parsed geojson
+                geometry = [Polygon(x['coordinates'][0]) for x in df.geo.apply(eval)]
+                gdf = gpd.GeoDataFrame(df.drop('geo', axis=1).reset_index(drop=True), geometry=geometry, crs="EPSG:4326")
             return gdf
         except Exception as e:
             print("Error while making bldg data geospatial.\n{}".format(e))
@@ -70,10 +201,13 @@ class Building:
     
     def set_bldg_metadata(self):
         try:
-            bldg_basics_query = "SELECT address, address_city, neighborhood, zipcode, address_state, rsf, location, year_built, year_renovated, perc_known, perc_vacant, perc_occupied \
-                                    FROM properties_ry \
-                                    WHERE reonomy_id = '{}'".format(self.ry_id)
-            basics = gpd.GeoDataFrame.from_postgis(bldg_basics_query, con=self.db_engine, geom_col='location')
+            basics = queries.read(self.db_engine, 'bldg_basics', {'ry_id': str(self.ry_id)}, geom_col='location')
+            self._set_bldg_metadata(basics)
+        except Exception as e:
+            print("Error when setting bldg metadata: " + str(e))
+
+    def _set_bldg_metadata(self, basics):
+        try:
             self.address = basics.loc[0, 'address']
             self.city = basics.loc[0, 'address_city']
             self.neighborhood = basics.loc[0, 'neighborhood']
@@ -93,15 +227,8 @@ class Building:
     def get_closest_bldg(self):
         closest = None
         try:
-            closest = self.osm_data[self.osm_data.geometry.contains(self.location)]
-            if closest.empty:
-                closest = self.osm_data[self.osm_data.geometry.insersects(self.location)]
-            if closest.empty:
-                closest = self.osm_data[self.osm_data.geometry.touches(self.location)]
-            if closest.empty:
-                closest = self.osm_data[self.osm_data.geometry.insersects(self.location)]
-            if closest.empty or closest.shape[0] > 1:
-                closest = self.osm_data.loc[self.osm_data.geometry.distance(self.location).sort_values(ascending=True)[:1].index, :]
+            # contains, else intersects, else touches; nearest footprint on no or multiple hits
+            closest = self.osm_data.iloc[self.osm_index.closest_bulk([self.location])]
             self.closest_bldg = closest
             return self.closest_bldg
         except Exception as e:
@@ -109,31 +236,14 @@ class Building:
             return np.nan
 
     def get_bldg_data(self):
-        ry_data_query = "SELECT * FROM properties_ry WHERE reonomy_id = '{}'".format(self.ry_id)
-        self.ry_data = gpd.GeoDataFrame.from_postgis(ry_data_query, con=self.db_engine, geom_col='location').transpose()
+        return self._set_ry_data(queries.read(self.db_engine, 'bldg_characteristics', {'ry_id': str(self.ry_id)}))
+
+
+    def _set_ry_data(self, frame):
+        self.ry_data = frame.transpose()
         self.ry_data.columns = ['characteristics']
-        ry_by = {"reonomy_id":"Building ID",
-                    "lot_area":"Lot ID",
-                    "address":"Address",
-                    "floors":"Floors",
-                    "year_built":"Year Built",
-                    "year_renovated":"Year Renovated",
-                    "rsf":"Total Sqft",
-                    "category":"Type",
-                    "class":"Class",
-                    "lot_frontage":"Frontage",
-                    "lot_depth":"Depth",
-                    "residential_area":"Residential Area",
-                    "office_area":"Office Area",
-                    "retail_area":"Retail Area",
-                    "factory_area":"Factory Area",
-                    "garage_area":"Garage Area",
-                    "storage_area":"Storage Area",
-                    "other_area":"Other Area"}
-        self.ry_data = self.ry_data.loc[ry_by.keys(), :]
-        self.ry_data.rename(ry_by, axis=0, inplace=True)
-        self.ry_data.append(pd.DataFrame.from_dict({"Height": 849, "Vacancy Rate": 7, "Amenities":{"elevator": True, "gym": True} ,"Photos": "url"}
-                        , orient='index', columns=['characteristics']))
+        self.ry_data = self.ry_data.loc[self.ry_by.keys(), :]
+        self.ry_data.rename(self.ry_by, axis=0, inplace=True)
         self.ry_data = self.ry_data.loc[['Building ID',
                                             'Lot ID',
                                             'Address',
@@ -144,7 +254,7 @@ class Building:
                                             'Type',
                                             'Class',
                                             'Frontage',
-                                            'Depth'
+                                            'Depth',
                                             'Residential Area',
                                             'Office Area',
                                             'Retail Area',
@@ -158,7 +268,7 @@ class Building:
     def get_financials(self):
         if not hasattr(self, 'ry_data'):
             self.get_bldg_data()
-        return self.ry_data.iloc[34:51, :].append(self.ry_data.iloc[81:89, :])
+        return pd.concat([self.ry_data.iloc[34:51, :], self.ry_data.iloc[81:89, :]])
     
     def get_contacts(self):
         if not hasattr(self, 'ry_data'):
@@ -168,116 +278,129 @@ class Building:
 
     
     def get_f42_bldg_data(self):
-        f42_bldg_query = "SELECT * FROM properties_f42 AS f42 \
-                          JOIN f42_to_ry AS mt ON mt.f42_id = f42.property_id\
-                          WHERE ry_id = '{}'".format(self.ry_id)
-        self.f42_bldg_data = pd.read_sql(f42_bldg_query, con=self.db_engine).transpose()
+        self.f42_bldg_data = queries.read(self.db_engine, 'bldg_f42', {'ry_id': str(self.ry_id)}).transpose()
         return self.f42_bldg_data
 
 
     def get_f42_sales_data(self):
-        f42_sales_query = "SELECT * FROM listings_f42 AS lis \
-                          JOIN f42_to_ry AS mt ON mt.f42_id = lis.property_id \
-                          WHERE ry_id = '{}' \
-                          AND lis.type = 'Sale'".format(self.ry_id)
-        self.f42_sales_data = pd.read_sql(f42_sales_query, con=self.db_engine).transpose()
+        self.f42_sales_data = queries.read(self.db_engine, 'bldg_f42_sales', {'ry_id': str(self.ry_id)}).transpose()
         return self.f42_sales_data
 
 
-    def get_all_leases(self):
-        all_leases_query = "SELECT * FROM leases_ck AS lea \
-                            JOIN ck_to_ry AS mt ON mt.ck_id = lea.property_id \
-                            WHERE ry_id = '{}'".format(self.ry_id)
-        self.all_leases = pd.read_sql(all_leases_query, con=self.db_engine)
+    def get_all_leases(self, chunksize=None):
+        self.all_leases = queries.read(self.db_engine, 'bldg_leases', {'ry_id': str(self.ry_id)}, dtypes=lease_dtypes,
+                                       chunksize=chunksize)
+        # every lease is kept once in the timeline, current/upcoming leases and rents are answered from it
+        self.lease_timeline = LeaseTimeline(self.all_leases)
         return self.all_leases
+
+
+    def get_lease_timeline(self):
+        if not hasattr(self, 'lease_timeline'):
+            if hasattr(self, 'all_leases'):
+                self.lease_timeline = LeaseTimeline(self.all_leases)
+            else:
+                self.get_all_leases()
+        return self.lease_timeline
+
+
+    def refresh_leases(self):
+        """ Fetches only the leases touched since the last load and merges them into the timeline. """
+        timeline = self.get_lease_timeline()
+        if timeline.last_touched is None:
+            self.get_all_leases()
+            return len(self.lease_timeline)
+        changed = queries.read(self.db_engine, 'bldg_changed_leases',
+                               {'ry_id': str(self.ry_id), 'since': timeline.last_touched.to_pydatetime()},
+                               dtypes=lease_dtypes)
+        merged = timeline.refresh(changed)
+        self.all_leases = timeline.leases
+        if hasattr(self, 'current_leases'):
+            self.get_current_leases()
+        return merged
     
 
     def get_current_leases(self):
-        # TO-DO: optimize if all leases are queried, don't make another DB call for the current ones
-        # TO-DO: if all leases is an empty df, there are no leases for bldg, don't make call
         try:
-            today = dt.datetime.today().strftime('%Y-%m-%d')
-            current_leases_query = "SELECT * FROM leases_ck AS lea \
-                                JOIN ck_to_ry AS mt ON mt.ck_id = lea.property_id \
-                                WHERE ry_id = '{}' \
-                                AND lea.expiration_date > '{}' \
-                                AND lea.commencement_date <= '{}'".format(self.ry_id, today, today)
-            self.current_leases = pd.read_sql(current_leases_query, con=self.db_engine)
-
-            # self.current_leases.loc[:, "perc_of_bldg_size"] = self.current_leases["transaction_size"].multiply(100).divide(self.rsf))
-            # self.current_leases.current_rent.mask(self.current_leases.current_rent < 3, np.nan, inplace=True)
-            # self.current_leases.effective_rent.mask(self.current_leases.effective_rent < 3, np.nan, inplace=True)
-            
-            self.current_leases = self.current_leases.loc[:, self.ck_by.keys()]
-            self.current_leases.rename(self.ck_by, axis=1, inplace=True)
-            self.current_leases.loc[:, "Address"] = self.address
-            self.current_leases = self.current_leases.loc[:, [u'Lease ID', "Address", u'Company ID', "Company Name", u'Floor', u'Size', u'Unit ID',
-                                                    u'Starting Rate', u'Current Rate',  u'Average Rate',
-                                                    u'Signing Date', u'Start Date', u'End Date', u'Subleased',
-                                                    u'Extension Options', u'Termination Type', u'Termination Dates',
-                                                    u'Asking Rate', u'Rate Increase',
-                                                    u'Concession Type', u'Concession Work Value'
-                                                    ]].sort_values(by=['Start Date', 'Floor', 'Size'])
+            # from the lease timeline, no date-filtered query
+            self.current_leases = self._format_leases(self.get_lease_timeline().active_at())
             return self.current_leases
         except AttributeError as attr_error:
             return "Error while getting current leases: " + str(attr_error) + ". Try calling get_bldg_data() first."
     
 
+    def _format_leases(self, leases):
+        leases = leases.loc[:, self.ck_by.keys()]
+        leases.rename(self.ck_by, axis=1, inplace=True)
+        leases["Address"] = self.address
+        return leases.loc[:, [u'Lease ID', "Address", u'Company ID', "Company Name", u'Floor', u'Size', u'Unit ID',
+                                u'Starting Rate', u'Current Rate',  u'Average Rate',
+                                u'Signing Date', u'Start Date', u'End Date', u'Subleased',
+                                u'Extension Options', u'Termination Type', u'Termination Dates',
+                                u'Asking Rate', u'Rate Increase',
+                                u'Concession Type', u'Concession Work Value'
+                                ]].sort_values(by=['Start Date', 'Floor', 'Size'])
+    
+
     def get_all_vacancies(self):
-        all_vacancies_query = "SELECT * FROM listings_f42 AS lis \
-                                    JOIN f42_to_ry AS mt ON mt.f42_id = lis.property_id \
-                                    WHERE ry_id = '{}' \
-                                    AND lis.type = 'Lease'".format(self.ry_id)
-        self.all_vacancies = pd.read_sql(all_vacancies_query, con=self.db_engine)
+        self.all_vacancies = queries.read(self.db_engine, 'bldg_vacancies', {'ry_id': str(self.ry_id)},
+                                          dtypes=vacancy_dtypes)
         return self.all_vacancies
     
 
     def get_current_vacancies(self):
         try:
-            still_vacant_assumption_date = (dt.datetime.today() + relativedelta(months= -6)).strftime('%Y-%m-%d')
-            current_vacancies_query = "SELECT * FROM listings_f42 AS lis \
-                                            JOIN f42_to_ry AS mt on mt.f42_id = lis.property_id \
-                                            WHERE ry_id = '{}' \
-                                            AND lis.type = 'Lease' \
-                                            AND lis.touched_at > '{}'".format(self.ry_id, still_vacant_assumption_date)
-            self.current_vacancies = pd.read_sql(current_vacancies_query, con=self.db_engine)
-            
-            self.current_vacancies.loc[:, "perc_of_bldg_size"] = self.current_vacancies["size"].multiply(100).divide(self.rsf)
-            return self.current_vacancies.loc[:, ['floor', 'floor_order', 'unit', 'unit_type', 'size', 'perc_of_bldg_size', 'rate_per_sqft_per_year', 'details', 'touched_at', 'lease_expiration']]
+            still_vacant_assumption_date = dt.datetime.today() + relativedelta(months= -6)
+            self.current_vacancies = queries.read(self.db_engine, 'bldg_current_vacancies',
+                                                  {'ry_id': str(self.ry_id), 'since': still_vacant_assumption_date},
+                                                  dtypes=vacancy_dtypes)
+            return self._format_vacancies()
         except AttributeError as attr_error:
             return "Error while getting current leases: " + str(attr_error) + ". Try calling get_bldg_data() first."
 
 
+    def _format_vacancies(self):
+        self.current_vacancies.loc[:, "perc_of_bldg_size"] = self.current_vacancies["size"].multiply(100).divide(self.rsf)
+        return self.current_vacancies.loc[:, ['floor', 'floor_order', 'unit', 'unit_type', 'size', 'perc_of_bldg_size', 'rate_per_sqft_per_year', 'details', 'touched_at', 'lease_expiration']]
+
+
     ######################################################## Baya Layers ##################################################
     
     def get_upcoming_vacancies(self, months=12):
-        if not hasattr(self, 'current_leases'):
-            self.get_current_leases()
-        timeframe = (dt.datetime.today() + relativedelta(months= months)).date()
-        return self.current_leases.loc[self.current_leases.expiration_date <= timeframe, ['tenant_name', 'transaction_size', 'submarket', 'floor_occupancies', 'suite', 'perc_of_bldg_size', \
+        upcoming = self.get_lease_timeline().expiring_within(months).copy()
+        upcoming.loc[:, "perc_of_bldg_size"] = upcoming["transaction_size"].multiply(100).divide(self.rsf)
+        return upcoming.loc[:, ['tenant_name', 'transaction_size', 'submarket', 'floor_occupancies', 'suite', 'perc_of_bldg_size', \
                                             'current_rent', 'effective_rent', 'expiration_date', 'commencement_date', 'space_type']]
 
 
+    def get_summary(self):
+        """ KPIs of the building from the bldg summary snapshot, None when the snapshot is stale or doesn't hold it.
+        Only used while the leases of the building aren't loaded, live computation from them is as cheap. """
+        if hasattr(self, 'lease_timeline'):
+            return None
+        return default_summary().lookup(str(self.ry_id))
+
+
     def get_mean_rent(self):
-        if not hasattr(self, 'current_leases'):
-            self.get_current_leases()
-        if self.current_leases.empty:
-            return 0
-        else:
-            return self.current_leases.loc[:,  "current_rent" ].mean()
+        summary = self.get_summary()
+        if summary is not None:
+            return bldg_summary.mean_rent(summary)
+        return self.get_lease_timeline().mean_rent()
 
     
     def get_estimated_revenue(self, _rent, occupied_from_unknown = 0.75):
         # occupied_from_unknown is the fraction of unknwon sqft that is leased at market rent from the unknown sq footage.
-        if not hasattr(self, 'current_leases'):
-            self.get_current_leases()
+        summary = self.get_summary()
+        if summary is not None:
+            return bldg_summary.estimated_revenue(summary, _rent, occupied_from_unknown)
+        current_leases = self.get_lease_timeline().active_at()
         # revenue from known leases
-        if self.current_leases.empty:
+        if current_leases.empty:
             return 0
 
         # bldg_mean_rent = self.get_mean_rent()
         
-        rkl = self.current_leases.transaction_size.mul(self.current_leases.current_rent.fillna(_rent)).sum()
+        rkl = current_leases.transaction_size.mul(current_leases.current_rent.fillna(_rent)).sum()
         if self.perc_known >= 100:
             return rkl
   
@@ -306,24 +429,24 @@ class Building:
         return rcv
 
     
-    def get_surrounding_bldgs(self, radius=0.5, no_of_results=None):
-        """ For now the Area is defined as a circle centered at the bldg which method is called upon. Radius is a parameter. 
-        TO-DO: allow for Area to be a geojson, either pre-loaded or passed as argument. Area can then be a market, submarket defined by user.
+    def get_surrounding_bldgs(self, radius=0.5, no_of_results=None, area=None, offline=False):
+        """ Office buildings in Manhattan around the bldg which method is called upon, nearest first: within radius (in miles)
+        or, when given, within area, a polygon or geojson geometry/feature (e.g. a market or submarket). Only the
+        no_of_results nearest ones are fetched when given, see nearby.surrounding_sql. offline answers from the in-memory
+        index of properties_ry locations instead of the database.
         TO-DO: currently restricted to Manhattan, relax this constraint moving on. Also restricting to Office Category from Reonomy denomination. """
         try:
-            radius = radius*1600         # miles to meters conversion
-            bldgs_in_area_query = "SELECT reonomy_id, location FROM properties_ry AS ry \
-                                        WHERE ST_DWithin(ry.location, ST_SetSRID(ST_Point({}, {}), 4326), {}) \
-                                        AND address_city = 'MN' \
-                                        AND reonomy_id != '{}' \
-                                        AND category = 'Office'".format(self.location.x, self.location.y, radius, self.ry_id)
-            result = gpd.GeoDataFrame.from_postgis(bldgs_in_area_query, con=self.db_engine, geom_col='location')
-            result = result.loc[result.location.distance(self.location).sort_values(ascending=True).index, :]
-            result.columns = ['id', 'location']
+            radius = radius * nearby.METERS_PER_MILE
+            if offline:
+                result = nearby.default_location_index(self.db_engine).surrounding(self.location, radius, area,
+                                                                                  no_of_results, exclude=self.ry_id)
+            else:
+                result = nearby.surrounding_sql(self.db_engine, self.location, radius, area, no_of_results,
+                                                exclude=self.ry_id)
             if not no_of_results:
                 return result
             else:
-                return result[:no_of_results].id.tolist()
+                return result.id.tolist()
             
         except AttributeError as attr_error:
             return "Error while getting bldgs in area: " + str(attr_error) + ". Try calling get_bldg_data() first."
@@ -340,39 +463,39 @@ class Building:
             print("Error while displaying bldg on map.\n{}".format(e))
 
     
-    def show_surrounding_locations(self, surr_ids):
+    def show_surrounding_locations(self, surr_ids, tiles_url=None):
         try:
             test_map = folium.Map(location=[self.location.y, self.location.x], zoom_start=16)
+            if tiles_url is not None:
+                tile_export.add_tiles(test_map, tiles_url)
             obj_point = folium.Marker(location = (self.location.y, self.location.x), tooltip=self.address,
                                         popup=folium.Popup(self.create_text_box(self.ry_data.to_dict()['characteristics']), max_width=300)
                                     ).add_to(test_map)
             if not hasattr(self, 'ry_data'):
                 self.get_bldg_data()
-            bldg_info = self.ry_data.to_dict()['characteristics']
-            bldg_poly = folium.Polygon(locations = self.closest_bldg.geo_inv.values.tolist(),
-                                color="red", fill=True, fill_color='#FF0000',
-                                tooltip=folium.Tooltip(bldg_info['Address']),
-                                popup=folium.Popup(self.create_text_box(bldg_info),
-                                max_width=300)).add_to(test_map)
-
-            for b in surr_ids:
-                B = Building(b)
-                B_data = B.get_bldg_data().to_dict()['characteristics']
-                B.get_closest_bldg()
-                bldg_poly = folium.Polygon(locations = B.closest_bldg.geo_inv.values.tolist(),
-                                color="red", fill=True, fill_color='#FF0000',
-                                tooltip=folium.Tooltip(B_data['Address']),
-                                popup=folium.Popup(self.create_text_box(B_data), 
-                                max_width=300)).add_to(test_map)
+            # one popup per footprint drawn
+            bldgs, infos = [self.closest_bldg], [self.ry_data.to_dict()['characteristics']] * self.closest_bldg.shape[0]
+
+            # all the surrounding buildings in a few set-based queries, sharing this building's footprint layer, drawn
+            # as a single GeoJSON layer
+            for B in BuildingSet(surr_ids, db_engine=self.db_engine):
+                bldgs.append(B.closest_bldg)
+                infos += [B.ry_data.to_dict()['characteristics']] * B.closest_bldg.shape[0]
+            infos = pd.DataFrame(infos)
+            tile_export.add_buildings(test_map, pd.concat(bldgs), zoom=16, tooltips=infos['Address'].tolist(),
+                                      popups=self.create_text_boxes(infos).tolist())
             display(test_map)
         except Exception as e:
             print("Error while displaying surroundings buildings on map.\n{}".format(e))
 
-    def make_map(self):
+    def make_map(self, tiles_url=None):
     #    pophtml = self._create_text_box(obj, closest_bldg.iloc[:, :-3]\
     #                                  .drop('geo', axis=1).dropna(axis=1).to_dict(orient='rows')[0])
         self.get_closest_bldg()
         test_map = folium.Map(location=[self.location.y, self.location.x], zoom_start=16)
+        if tiles_url is not None:
+            # the buildings around, loaded by the browser from the exported tiles rather than embedded
+            tile_export.add_tiles(test_map, tiles_url)
 
         obj_point = folium.Marker(location = (self.location.y, self.location.x))
         obj_point.add_to(test_map)
@@ -381,58 +504,42 @@ class Building:
             self.get_bldg_data()
         bldg_info = self.ry_data.to_dict()['characteristics']
 
-        bldg_poly = folium.Polygon(locations = self.closest_bldg.geo_inv.values.tolist(),
-                                color="red", fill=True, fill_color='#FF0000',
-                                tooltip=folium.Tooltip(bldg_info['Address']),
-                                popup=folium.Popup(self.create_text_box(bldg_info),
-                                max_width=300))
-        bldg_poly.add_to(test_map)
+        n = self.closest_bldg.shape[0]
+        tile_export.add_buildings(test_map, self.closest_bldg, zoom=16, tooltips=[bldg_info['Address']] * n,
+                                  popups=[self.create_text_box(bldg_info)] * n)
         display(test_map)
 
 
     def create_text_box(self, bldg_data):
+        """ Popup html of a building, from its characteristics (a dict), see create_text_boxes. """
+        return self.create_text_boxes(pd.DataFrame([bldg_data])).iloc[0]
+
+    @classmethod
+    def create_text_boxes(cls, characteristics, table=False):
+        """
+        Popups of many buildings, rendered all at once with popup_template.
+
+        Parameters
+        ----------
+        characteristics : Pandas DataFrame
+            One row per building, with the ry_by names as columns (e.g. ry_data of every building, transposed).
+        table : bool, optional
+            Return the escaped attribute table instead of the html, see popups.PopupTemplate.table.
+
+        Returns
+        -------
+        A Pandas Series of html strings, or a Pandas DataFrame with table, aligned with characteristics
+        """
         try:
-            pophtml = """
-                <h3> {title} </h3>
-                <b>Baya ID:</b>   {bid}<br>
-                """.format(title=bldg_data['Address'], 
-                        bid=bldg_data['Building ID'][:8])
-            # pophtml = pophtml + """Lot ID: {Lot ID}<br>
-            #     Address: {Address}<br>
-            #     Floors: {Floors}<br>
-            #     Year Built: {Year Built}<br>
-            #     Year Renovated: {Year Renovated}<br>
-            #     Total Sqft: {Total Sqft}<br>
-            #     Type: {Type}<br>
-            #     Class: {Class}<br>
-            #     Frontage: {Frontage}<br>
-            #     Depth: {Depth}<br>
-            #     Residential Area: {Residential Area}<br>
-            #     Office Area: {Office Area}<br>
-            #     Retail Area: {Retail Area}<br>
-            #     Factory Area: {Factory Area}<br>
-            #     Garage Area: {Garage Area}<br>
-            #     Storage Area: {Storage Area}<br>
-            #     Other Area: {Other Area}<br>""".format(bldg_data)
-            for k,v in bldg_data.items():
-                if ('Address' not in k) and ('Building' not in k):
-                    pophtml = pophtml + "{}:   {}<br>".format(k,v)
-            return pophtml
+            return cls.popup_template.table(characteristics) if table else cls.popup_template.render(characteristics)
         except Exception as e:
-            print("Error while creating pop-up box: {}.\n{}".format(e))
+            print("Error while creating pop-up boxes.\n{}".format(e))
             return np.nan
 
-    def get_surrounding_current_leases(self, surr_ids):
-        today = dt.datetime.today().strftime('%Y-%m-%d')
-        market_rent_query = "SELECT * \
-                                FROM leases_ck AS lea \
-                                JOIN ck_to_ry AS mt on mt.ck_id = lea.property_id \
-                                JOIN (SELECT address, rsf, reonomy_id FROM properties_ry) as ryrsf ON ryrsf.reonomy_id = mt.ry_id \
-                                WHERE mt.ry_id IN {} \
-                                AND lea.expiration_date > '{}' \
-                                AND lea.commencement_date <= '{}'\
-                                ".format(tuple([str(b) for b in surr_ids]), today, today)
-        self.surrounding_current_leases = pd.read_sql(market_rent_query, con=self.db_engine)
+    def get_surrounding_current_leases(self, surr_ids, chunksize=None):
+        self.surrounding_current_leases = queries.read(self.db_engine, 'bldgs_current_leases',
+                                                       {'ry_ids': [str(b) for b in surr_ids], 'day': dt.date.today()},
+                                                       dtypes=lease_dtypes, chunksize=chunksize)
         # self.current_leases.current_rent.mask(self.current_leases.current_rent < 3, np.nan, inplace=True)
         # self.current_leases.effective_rent.mask(self.current_leases.effective_rent < 3, np.nan, inplace=True)
 
@@ -448,32 +555,28 @@ class Building:
                                                                                     u'Asking Rate', u'Rate Increase',
                                                                                     u'Concession Type', u'Concession Work Value'
                                                                                 ]].sort_values(by=['Start Date', 'Floor', 'Size'])
-        self.surrounding_current_leases = self.current_leases.append(self.surrounding_current_leases)
+        self.surrounding_current_leases = pd.concat([self.current_leases, self.surrounding_current_leases])
         return self.surrounding_current_leases
 
 
-    def show_lease_comps(self):
+    def get_rent_roll(self, freq='Q', escalation=None):
+        """ Quarterly (or monthly) rent of the lease comps around the building, one column per address, see rent_roll. """
         if not hasattr(self, 'surrounding_current_leases'):
             self.get_surrounding_current_leases(self.get_surrounding_bldgs(0.1, 5))
         comps = self.surrounding_current_leases
         comps = comps.loc[:, ["Address", "Starting Rate", "Size", "Start Date", "End Date"]]
         comps.loc[:, "Rent"] = comps["Starting Rate"].multiply(comps["Size"])
-        comps
-        cq = pd.concat([pd.DataFrame({'Quarter': pd.date_range(row['Start Date'], row['End Date'], freq='Q'),
-                                'Address': row.Address,
-                                'Rent': row.Rent
-                                }, columns=['Quarter', 'Address', 'Rent']
-                                ) for i, row in comps.iterrows()], ignore_index=True)
-        cq = cq.groupby(['Address', 'Quarter']).sum()
-        cq.reset_index(inplace=True)
-        cq = cq.pivot(index='Quarter', columns='Address', values='Rent')
-        cq.loc[:, "Area Average"] = cq.mean(axis=1)
+        self.rent_roll = rent_roll(comps, freq=freq, escalation=escalation)
+        return self.rent_roll
+
+    def show_lease_comps(self):
+        cq = self.get_rent_roll()
         ax = cq.plot(figsize=(18, 6), title="Received and Projected Rent", grid=True, 
-        xlim=(pd.datetime(2009, 1, 31), pd.datetime(2029, 3, 31)),
-        xticks=[pd.datetime(x, 1, 1) for x in np.arange(2009,2029,1)])
+        xlim=(pd.Timestamp(2009, 1, 31), pd.Timestamp(2029, 3, 31)),
+        xticks=[pd.Timestamp(x, 1, 1) for x in range(2009, 2029)])
         ax.set_xlabel("Year")
         ax.set_ylabel("Rent in Tens of Millions USD")
-        display()
+        return ax
         
      
 
@@ -493,3 +596,140 @@ class Building:
 
 
 
+######################################################## Queries ######################################################
+# explicit column lists, bound parameters; the lookups by reonomy_id / id array run as prepared statements, see queries
+
+_ry_cols = ', '.join('"{}"'.format(c) for c in Building.ry_by.keys())
+_lease_cols = ', '.join('lea.' + c for c in Building.lease_cols)
+queries.register('bldg_basics', "SELECT {} FROM properties_ry WHERE reonomy_id = :ry_id"\
+                    .format(', '.join(Building.basics_cols)), [('ry_id', 'text')])
+queries.register('bldg_characteristics', "SELECT {} FROM properties_ry WHERE reonomy_id = :ry_id".format(_ry_cols),
+                 [('ry_id', 'text')])
+queries.register('bldg_f42', "SELECT {} FROM properties_f42 AS f42 \
+                              JOIN f42_to_ry AS mt ON mt.f42_id = f42.property_id \
+                              WHERE mt.ry_id = :ry_id".format(', '.join('f42.' + c for c in Building.f42_bldg_cols)),
+                 [('ry_id', 'text')])
+queries.register('bldg_f42_sales', "SELECT {} FROM listings_f42 AS lis \
+                                    JOIN f42_to_ry AS mt ON mt.f42_id = lis.property_id \
+                                    WHERE mt.ry_id = :ry_id AND lis.type = 'Sale'"\
+                    .format(', '.join('lis.' + c for c in Building.f42_sales_cols)), [('ry_id', 'text')])
+queries.register('bldg_leases', "SELECT {}, mt.ry_id FROM leases_ck AS lea \
+                                 JOIN ck_to_ry AS mt ON mt.ck_id = lea.property_id \
+                                 WHERE mt.ry_id = :ry_id".format(_lease_cols), [('ry_id', 'text')])
+queries.register('bldg_changed_leases', "SELECT {}, mt.ry_id FROM leases_ck AS lea \
+                                         JOIN ck_to_ry AS mt ON mt.ck_id = lea.property_id \
+                                         WHERE mt.ry_id = :ry_id AND lea.touched_at > :since".format(_lease_cols),
+                 [('ry_id', 'text'), ('since', 'timestamp')])
+queries.register('bldg_vacancies', "SELECT {} FROM listings_f42 AS lis \
+                                    JOIN f42_to_ry AS mt ON mt.f42_id = lis.property_id \
+                                    WHERE mt.ry_id = :ry_id AND lis.type = 'Lease'"\
+                    .format(', '.join('lis.' + c for c in Building.vacancy_cols)), [('ry_id', 'text')])
+queries.register('bldg_current_vacancies', "SELECT {} FROM listings_f42 AS lis \
+                                            JOIN f42_to_ry AS mt ON mt.f42_id = lis.property_id \
+                                            WHERE mt.ry_id = :ry_id AND lis.type = 'Lease' AND lis.touched_at > :since"\
+                    .format(', '.join('lis.' + c for c in Building.vacancy_cols)), [('ry_id', 'text'), ('since', 'timestamp')])
+# the address of the leases is the one of their building
+queries.register('bldgs_current_leases', "SELECT {}, ry.address FROM leases_ck AS lea \
+                                          JOIN ck_to_ry AS mt ON mt.ck_id = lea.property_id \
+                                          JOIN properties_ry AS ry ON ry.reonomy_id = mt.ry_id \
+                                          WHERE mt.ry_id = ANY(:ry_ids) \
+                                          AND lea.expiration_date > :day AND lea.commencement_date <= :day"\
+                    .format(', '.join('lea.' + c for c in Building.ck_by.keys() if c != 'address')),
+                 [('ry_ids', 'text[]'), ('day', 'date')])
+queries.register('bldgs_basics', "SELECT reonomy_id, {} FROM properties_ry WHERE reonomy_id = ANY(:ry_ids)"\
+                    .format(', '.join(Building.basics_cols)), [('ry_ids', 'text[]')])
+queries.register('bldgs_characteristics', "SELECT {} FROM properties_ry WHERE reonomy_id = ANY(:ry_ids)".format(_ry_cols),
+                 [('ry_ids', 'text[]')])
+
+# load_bldg_sections: every section is a sub-select sharing the ck/f42 CTEs of the building
+_section_queries = {
+    'metadata': "SELECT {}, ST_AsText(location) AS location_wkt FROM properties_ry WHERE reonomy_id = :ry_id"\
+                    .format(', '.join(c for c in Building.basics_cols if c != 'location')),
+    'characteristics': "SELECT {} FROM properties_ry WHERE reonomy_id = :ry_id".format(_ry_cols),
+    'leases': "SELECT {} FROM leases_ck AS lea JOIN ck ON ck.ck_id = lea.property_id".format(_lease_cols),
+    'vacancies': "SELECT {} FROM listings_f42 AS lis JOIN f42 ON f42.f42_id = lis.property_id WHERE lis.type = 'Lease'"\
+                    .format(', '.join('lis.' + c for c in Building.vacancy_cols)),
+    'f42_bldg': "SELECT {} FROM properties_f42 AS f42_data JOIN f42 ON f42.f42_id = f42_data.property_id"\
+                    .format(', '.join('f42_data.' + c for c in Building.f42_bldg_cols)),
+    'f42_sales': "SELECT {} FROM listings_f42 AS lis JOIN f42 ON f42.f42_id = lis.property_id WHERE lis.type = 'Sale'"\
+                    .format(', '.join('lis.' + c for c in Building.f42_sales_cols))
+}
+
+
+def sections_query_name(include):
+    """ Name of the query of load_bldg_sections for the sections of include (in load_sections order), after their
+    positions in load_sections. """
+    return "bldg_sections_" + "".join(str(Building.load_sections.index(sec)) for sec in include)
+
+
+for _n in range(len(Building.load_sections)):
+    for _others in itertools.combinations(Building.load_sections[1:], _n):
+        _select_list = ["clock_timestamp() AS t_start"]
+        for _sec in ('metadata',) + _others:
+            _select_list.append("(SELECT json_agg(t) FROM ({}) AS t) AS {}".format(_section_queries[_sec], _sec))
+            _select_list.append("clock_timestamp() AS t_{}".format(_sec))
+        queries.register(sections_query_name(('metadata',) + _others),
+                         "WITH ck AS (SELECT ck_id FROM ck_to_ry WHERE ry_id = :ry_id), \
+                               f42 AS (SELECT f42_id FROM f42_to_ry WHERE ry_id = :ry_id) \
+                          SELECT {}".format(', '.join(_select_list)), [('ry_id', 'text')])
+
+
+class BuildingSet:
+    """ Set of buildings loaded together: metadata, characteristics and footprints of all of them come from a handful of
+    set-based queries and a single spatial join, instead of one full Building (engine, footprint layer, queries) per id.
+    Iterating, or indexing by ry_id, gives per-building views that are Building instances sharing the set's data. """
+
+    def __init__(self, ry_ids, osm_data=None, db_engine=None):
+        self.ry_ids = [str(b) for b in ry_ids]
+        self.db_engine = db_engine if db_engine is not None else get_engine()
+        self.set_bldgs_metadata()
+        self.set_bldgs_data()
+        if osm_data is None:
+            layer = Building.get_footprint_layer()
+            self.osm_data, self.osm_index = layer.data, layer.index
+        else:
+            self.osm_data = osm_data
+            self.osm_index = BldgIndex(self.osm_data.geometry)
+        self.set_closest_bldgs()
+        self._views = {}
+
+    def set_bldgs_metadata(self):
+        self.metadata = queries.read(self.db_engine, 'bldgs_basics', {'ry_ids': self.ry_ids}, geom_col='location')\
+                            .set_index('reonomy_id')
+        return self.metadata
+
+    def set_bldgs_data(self):
+        self.characteristics = queries.read(self.db_engine, 'bldgs_characteristics', {'ry_ids': self.ry_ids})
+        self.characteristics.index = self.characteristics.reonomy_id
+        return self.characteristics
+
+    def set_closest_bldgs(self):
+        # footprint of every building of the set, in one spatial join
+        self.closest_positions = pd.Series(self.osm_index.closest_bulk(self.metadata.location.values),
+                                           index=self.metadata.index)
+        return self.closest_positions
+
+    def __len__(self):
+        return len(self.ry_ids)
+
+    def __iter__(self):
+        for ry_id in self.ry_ids:
+            if ry_id in self.metadata.index:
+                yield self[ry_id]
+            else:
+                print("Building {} not found.".format(ry_id))
+
+    def __getitem__(self, ry_id):
+        if ry_id not in self._views:
+            B = Building.__new__(Building)
+            B.ry_id = ry_id
+            B.db_engine = self.db_engine
+            B._set_bldg_metadata(self.metadata.loc[[ry_id]].reset_index())
+            B._set_ry_data(self.characteristics.loc[[ry_id]].reset_index(drop=True))
+            B.osm_data = self.osm_data
+            B.osm_index = self.osm_index
+            pos = self.closest_positions[ry_id]
+            B.closest_bldg = self.osm_data.iloc[[pos]] if pos >= 0 else self.osm_data.iloc[[]]
+            self._views[ry_id] = B
+        return self._views[ry_id]
+
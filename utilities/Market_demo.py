@@ -1,55 +1,61 @@
 import os
 import datetime as dt
 import pandas as pd, geopandas as gpd, numpy as np
-from sqlalchemy import create_engine
+from .db import get_engine
+from .rent_roll import rent_roll
+from . import market_stats
+from . import bldg_summary
+from .portfolio import portfolio_revenue
+from . import queries
+from .decoding import lease_dtypes, market_lease_dtypes
 
 class Market:
     """ Market Class with utility functions to get interesting information for the set of bldgs that conform the market."""
     # TO-DO: 
 
-    def __init__(self, bldgs_ids):
+    ck_by = {
+        "address": "Address",
+        "id": "Lease ID",
+        "suite": "Unit ID",
+        "tenant_name": "Company Name",
+        "floor_occupancies": "Floor",
+        "transaction_size": "Size",
+        "property_id": "Company ID",
+        "execution_date": "Signing Date",
+        "commencement_date": "Start Date",
+        "expiration_date": "End Date",
+        "starting_rent": "Starting Rate",
+        "current_rent": "Current Rate",
+        "avg_rent": "Average Rate",
+        "asking_rent": "Asking Rate",
+        "lease_escalations": "Rate Increase", 
+        "break_option_dates": "Termination Dates",
+        "break_option_type": "Termination Type",
+        "renewal_options": "Extension Options",
+        "sublease": "Subleased",
+        "free_rent_type": "Concession Type",
+        "work_value": "Concession Work Value"
+    }
+
+    def __init__(self, bldgs_ids, leases=None, bldgs=None):
+        """ leases and bldgs, optional, are a local dataset of the market (see get_market_leases and get_market_bldgs):
+        when given, the aggregations run in pandas over it instead of in Postgres. """
         self.bldgs_ids = bldgs_ids
-        # Connection to DB, fixed for now. Connecting to our main DB. TO-DO. Connect to follow-up test DB.
-        self.db_engine = create_engine(os.environ["DATABASE_URL_silhouetted"])
+        # Connection to DB, shared by every instance of the process, see db.get_engine
+        self.db_engine = get_engine()
+        self.market_leases = leases
+        self.market_bldgs = bldgs
     
-    def get_current_leases(self):
-        today = dt.datetime.today().strftime('%Y-%m-%d')
-        market_rent_query = "SELECT * \
-                                FROM leases_ck AS lea \
-                                JOIN ck_to_ry AS mt on mt.ck_id = lea.property_id \
-                                JOIN (SELECT address, rsf, reonomy_id FROM properties_ry) as ryrsf ON ryrsf.reonomy_id = mt.ry_id \
-                                WHERE mt.ry_id IN {} \
-                                AND lea.expiration_date > '{}' \
-                                AND lea.commencement_date <= '{}'\
-                                ".format(tuple([str(b) for b in self.bldgs_ids]), today, today)
-        self.current_leases = pd.read_sql(market_rent_query, con=self.db_engine)
+    def get_current_leases(self, chunksize=None):
+        """ Current leases of the market, decoded into compact dtypes; chunksize streams them in chunks of that many rows.
+        See queries.memory_summary for their footprint. """
+        self.current_leases = queries.read(self.db_engine, 'market_current_leases',
+                                           {'ry_ids': [str(b) for b in self.bldgs_ids], 'day': dt.date.today()},
+                                           dtypes=lease_dtypes, chunksize=chunksize)
         # self.current_leases.current_rent.mask(self.current_leases.current_rent < 3, np.nan, inplace=True)
         # self.current_leases.effective_rent.mask(self.current_leases.effective_rent < 3, np.nan, inplace=True)
-        ck_by = {
-            "address": "Address",
-            "id": "Lease ID",
-            "suite": "Unit ID",
-            "tenant_name": "Company Name",
-            "floor_occupancies": "Floor",
-            "transaction_size": "Size",
-            "property_id": "Company ID",
-            "execution_date": "Signing Date",
-            "commencement_date": "Start Date",
-            "expiration_date": "End Date",
-            "starting_rent": "Starting Rate",
-            "current_rent": "Current Rate",
-            "avg_rent": "Average Rate",
-            "asking_rent": "Asking Rate",
-            "lease_escalations": "Rate Increase", 
-            "break_option_dates": "Termination Dates",
-            "break_option_type": "Termination Type",
-            "renewal_options": "Extension Options",
-            "sublease": "Subleased",
-            "free_rent_type": "Concession Type",
-            "work_value": "Concession Work Value"
-        }
-        self.current_leases = self.current_leases.loc[:, ck_by.keys()]
-        self.current_leases.rename(ck_by, axis=1, inplace=True)
+        self.current_leases = self.current_leases.loc[:, self.ck_by.keys()]
+        self.current_leases.rename(self.ck_by, axis=1, inplace=True)
         return self.current_leases.loc[:, [u'Lease ID', "Address", u'Company ID', "Company Name", u'Floor', u'Size', u'Unit ID',
                                                 u'Starting Rate', u'Current Rate',  u'Average Rate',
                                                 u'Signing Date', u'Start Date', u'End Date', u'Subleased',
@@ -59,10 +65,69 @@ class Market:
                                                 ]]
 
     def get_mean_rent(self):
+        # one aggregated row instead of every current lease
+        self.market_rent = self.get_rent_stats(group_by=None, percentiles=()).mean_rent.iloc[0]
+        return self.market_rent
+
+    def get_bldg_summaries(self):
+        """ KPIs of the buildings of the market (see bldg_summary), from the snapshot when it is fresh, the buildings it
+        doesn't hold computed live by one aggregated query. """
+        ry_ids = [str(b) for b in self.bldgs_ids]
+        summaries = bldg_summary.default_summary().lookup_many(ry_ids)
+        missing = [b for b in ry_ids if b not in summaries.index]
+        if missing:
+            summaries = pd.concat([summaries, bldg_summary.summary_sql(self.db_engine, missing)])
+        self.bldg_summaries = summaries.loc[[b for b in ry_ids if b in summaries.index]]
+        return self.bldg_summaries
+
+    def get_portfolio_revenue(self, rent=None, occupied_from_unknown=0.75, vacant_from_unknown=0.25):
+        """ Estimated revenue and Knotel revenue increase of every building of the market in one pass, at rent (the
+        market mean rent by default). Lists of assumptions give one column per scenario, see portfolio_revenue. """
+        rent = self.get_mean_rent() if rent is None else rent
+        return portfolio_revenue(self.get_bldg_summaries(), rent, occupied_from_unknown, vacant_from_unknown)
+
+    def get_market_leases(self, chunksize=None):
+        """ Local dataset of the market leases: every lease of its buildings, with only the columns the aggregations use. """
+        self.market_leases = queries.read(self.db_engine, 'market_leases', {'ry_ids': [str(b) for b in self.bldgs_ids]},
+                                          dtypes=market_lease_dtypes, chunksize=chunksize)
+        return self.market_leases
+
+    def get_market_bldgs(self):
+        """ Local dataset of the market buildings, with their rsf. """
+        self.market_bldgs = queries.read(self.db_engine, 'market_bldgs', {'ry_ids': [str(b) for b in self.bldgs_ids]})
+        return self.market_bldgs
+
+    def get_rent_stats(self, group_by='building', percentiles=(0.25, 0.5, 0.75), date=None):
+        """ Count, leased sf, mean, median and percentiles of the rent of the current leases, by building, submarket
+        and/or space type. See market_stats.rent_stats_sql. """
+        if self.market_leases is not None:
+            return market_stats.rent_stats_local(self.market_leases, group_by, percentiles, date)
+        return market_stats.rent_stats_sql(self.db_engine, self.bldgs_ids, group_by, percentiles, date)
+
+    def get_occupancy(self, by_building=True, date=None):
+        """ Leased sf of the current leases over the rsf, per building or for the whole market. See
+        market_stats.occupancy_sql. """
+        if self.market_leases is not None:
+            if self.market_bldgs is None:
+                self.get_market_bldgs()
+            return market_stats.occupancy_local(self.market_leases, self.market_bldgs, by_building, date)
+        return market_stats.occupancy_sql(self.db_engine, self.bldgs_ids, by_building, date)
+
+    def get_expiring_sf(self, group_by=None, months=24, date=None):
+        """ Sf of the current leases expiring within the following months, by quarter of expiration, optionally by
+        building, submarket and/or space type. See market_stats.expiring_sf_sql. """
+        if self.market_leases is not None:
+            return market_stats.expiring_sf_local(self.market_leases, group_by, months, date)
+        return market_stats.expiring_sf_sql(self.db_engine, self.bldgs_ids, group_by, months, date)
+
+    def get_rent_roll(self, freq='Q', escalation=None):
+        """ Quarterly (or monthly) rent of the current leases of the market, one column per address, see rent_roll. """
         if not hasattr(self, 'current_leases'):
             self.get_current_leases()
-        self.market_rent = self.current_leases.current_rent.mean()
-        return self.market_rent
+        leases = self.current_leases.loc[:, ["Address", "Starting Rate", "Size", "Start Date", "End Date"]]
+        leases.loc[:, "Rent"] = leases["Starting Rate"].multiply(leases["Size"])
+        self.rent_roll = rent_roll(leases, freq=freq, escalation=escalation)
+        return self.rent_roll
         
 
 
@@ -80,4 +145,19 @@ class Market:
     
 
 
-
+######################################################## Queries ######################################################
+# explicit column lists, bound parameters, run as prepared statements, see queries
+
+# the address of the leases is the one of their building
+queries.register('market_current_leases', "SELECT {}, ry.address FROM leases_ck AS lea \
+                                           JOIN ck_to_ry AS mt ON mt.ck_id = lea.property_id \
+                                           JOIN properties_ry AS ry ON ry.reonomy_id = mt.ry_id \
+                                           WHERE mt.ry_id = ANY(:ry_ids) \
+                                           AND lea.expiration_date > :day AND lea.commencement_date <= :day"\
+                    .format(', '.join('lea.' + c for c in Market.ck_by.keys() if c != 'address')),
+                 [('ry_ids', 'text[]'), ('day', 'date')])
+queries.register('market_leases', "SELECT mt.ry_id, {} {}"\
+                    .format(', '.join('lea.' + c for c in market_stats.lease_cols if c != 'ry_id'),
+                            market_stats.market_leases_from), [('ry_ids', 'text[]')])
+queries.register('market_bldgs', "SELECT {} FROM properties_ry WHERE reonomy_id = ANY(:ry_ids)"\
+                    .format(', '.join(market_stats.bldg_cols)), [('ry_ids', 'text[]')])
@@ -7,6 +7,11 @@ import requests
 import os
 import pandas as pd, numpy as np
 import json
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from .geocode_cache import default_cache
+from .ry_client import BatchClient
+from .batch_sink import BatchSink
 
 # list of 500 common address abbreviations published by the United States Postal Service (USPS) https://pe.usps.com/text/pub28/28apc_002.htm
 with open(os.path.join(os.path.dirname(__file__),"usps_abbreviations.json"), "r") as read_file:
@@ -18,6 +23,17 @@ usps_abbreviations['e'] = 'East'
 usps_abbreviations['s'] = 'South'
 usps_abbreviations['w'] = 'West'
 
+# precompiled once instead of on every token
+_non_word = re.compile(r'[^\w\s]')
+
+
+# memoized on the raw token, so the common ones are cleaned & looked up only once; bounded, as every house number and
+# street name is a token too
+@lru_cache(maxsize=2**16)
+def _expand_token(abbv):
+    key = _non_word.sub('', abbv).lower()
+    return usps_abbreviations[key] if key in usps_abbreviations else abbv
+
 
 def expand_abbv(address, separator=None, index_of_abbv=-1):
     """ 
@@ -44,10 +60,7 @@ def expand_abbv(address, separator=None, index_of_abbv=-1):
         # splitting on whitespace
         add_parts = address.split(separator)
         # checking if the lowercased, purely alphanumeric, address piece is a known abbreviation, if so expand it
-        abbvs = [usps_abbreviations[re.sub('[^\w\s]', '', abbv).lower()]
-                 if re.sub('[^\w\s]', '', abbv).lower() in usps_abbreviations.keys() 
-                 else abbv 
-                 for abbv in add_parts]
+        abbvs = [_expand_token(abbv) for abbv in add_parts]
         # joining by whitespace the words of the address
         expanded_address = ' '.join(abbvs)
         return expanded_address
@@ -80,7 +93,7 @@ state_comps = ['StateName']
 zip_comps = ['ZipCode']
 
 
-def parse_address(address):
+def parse_address(address, verbose=True):
     """ 
     Parses address strings and categorizes into conveninent components for Baya common functions.
 
@@ -88,6 +101,8 @@ def parse_address(address):
     ----------
     address : str
         Address string typical formed by a street number, street name, city, zipcode.
+    verbose : bool, optional
+        Prints the street part of the address.
 
     Returns
     -------
@@ -100,7 +115,8 @@ def parse_address(address):
         if len(ord_dict.keys()) > 0:
             res = {}
             street_values = [ord_dict[key] for key in ord_dict if key in street_comps]
-            print(' '.join(street_values))
+            if verbose:
+                print(' '.join(street_values))
             if len(street_values) > 0:
                 res['address'] = expand_abbv(' '.join(street_values))
             if 'PlaceName' in ord_dict.keys():
@@ -120,6 +136,73 @@ def parse_address(address):
         return e, e.args
 
 
+@lru_cache(maxsize=2**16)
+def _parse_address_memo(address):
+    return parse_address(address, verbose=False)
+
+
+def _parse_address_quiet(address):
+    # memoized on the address string, unhashable or non-string inputs go straight through (and fail the same way)
+    if type(address) is not str:
+        return parse_address(address, verbose=False)
+    return _parse_address_memo(address)
+
+
+def _fresh(res):
+    # results of repeated addresses come from the memo, callers get their own copy of the dict
+    return dict(res) if isinstance(res, dict) else res
+
+
+def expand_abbv_series(addresses, separator=None):
+    """ 
+    Bulk version of expand_abbv: expands the abbreviations of a whole Series of address strings, with identical output.
+    Every distinct address is expanded once.
+
+    Parameters
+    ----------
+    addresses : Pandas Series
+        Address strings
+    separator : str, optional
+        Separator used to break up the strings, input to str.split(). Defaults to whitespace.
+
+    Returns
+    -------
+    A Pandas Series of expanded addresses, with the index of the input
+    """
+    addresses = pd.Series(addresses)
+    uniques = pd.unique(addresses.values)
+    expanded = {a: expand_abbv(a, separator) for a in uniques}
+    return pd.Series([expanded[a] for a in addresses.values], index=addresses.index, name=addresses.name, dtype=object)
+
+
+def parse_address_series(addresses, processes=None, chunksize=500):
+    """ 
+    Bulk version of parse_address: parses a whole Series of address strings, with identical output and without the
+    prints. Distinct addresses are parsed once and memoized across calls; they can be spread over a process pool.
+
+    Parameters
+    ----------
+    addresses : Pandas Series
+        Address strings, as passed to parse_address. As with parse_address, non-string values raise an AssertionError.
+    processes : int, optional
+        Number of worker processes to parse with. Defaults to parsing in this process.
+    chunksize : int, optional
+        Number of addresses sent to a worker process at once.
+
+    Returns
+    -------
+    A Pandas Series of parse_address results, with the index of the input
+    """
+    addresses = pd.Series(addresses)
+    uniques = pd.unique(addresses.values)
+    if processes is not None and processes > 1 and len(uniques) > chunksize:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            parsed = dict(zip(uniques, pool.map(_parse_address_quiet, uniques, chunksize=chunksize)))
+    else:
+        parsed = {a: _parse_address_quiet(a) for a in uniques}
+    return pd.Series([_fresh(parsed[a]) for a in addresses.values], index=addresses.index, name=addresses.name, dtype=object)
+
+
 def make_req_obj_from_dict(d, idx=None):
     """ 
     Takes a parsed address dictionary and creates the reonomy-formatted object the get ry_id call
@@ -158,35 +241,99 @@ def make_req_obj_from_dict(d, idx=None):
 match_endpoint = "https://api.reonomy.com/v1/nyc/properties/matches"
 credentials = ('baya', os.environ["RY_API_KEY"])
 
-def get_ry_id_for_address(address):
+def get_ry_id_for_address(address, cache=None):
     """ 
-    Calls RY match endpoint to retrieve the reonomny ID of the inputted address. Leverages functions above
+    Calls RY match endpoint to retrieve the reonomny ID of the inputted address. Leverages functions above.
+    Answers, including "no match", are kept in the persistent geocode cache.
 
     Parameters
     ----------
     address: string
         input address string of the building to be matched
+    cache: GeocodeCache, optional
+        cache to read from and write to, defaults to the process-wide one
     Returns
     -------
     On success: the reonomy_id for the building at the inputted address
     Otherwise: "no matching building found"
     """
     try:
-        parsed_address = parse_address(address)
-        req_obj = make_req_obj_from_dict(parsed_address)
-        params = {'params': [req_obj]}
-        r = requests.post(match_endpoint, auth=credentials, json=params)
-        if 'property_id' in r.json()['matches'][0].keys():
-            return r.json()['matches'][0]['property_id']
+        cache = cache if cache is not None else default_cache()
+        property_id = cache.lookup(address, 'us', lambda: _match_address(address), service='reonomy_match')
+        if property_id is not None:
+            return property_id
         else: 
             return "No matching building found"
     except Exception as e:
         return e, e.args
 
 
-def get_ry_id_for_df(dataframe, address_col_name='address'):
+def _match_address(address):
+    parsed_address = parse_address(address, verbose=False)
+    req_obj = make_req_obj_from_dict(parsed_address)
+    params = {'params': [req_obj]}
+    r = requests.post(match_endpoint, auth=credentials, json=params)
+    r.raise_for_status()
+    match = r.json()['matches'][0]
+    # None is cached as "no match"
+    return match['property_id'] if 'property_id' in match.keys() else None
+
+
+def iter_ry_id_batches(dataframe, address_col_name='address', client=None, skip_batches=(), processes=None):
+    """ 
+    Generator behind get_ry_id_for_df: calls RY match endpoint in batches of 100 addresses and yields, per batch, its
+    number and a DataFrame of records (original_idx, property_id), in the order of the received addresses.
+
+    Parameters
+    ----------
+    dataframe: Pandas DataFrame
+        a dataframe containing a column, or various, with the addresses fo the bldgs to be matched to RY ids. 
+    address_col_name: string
+        name of the column containing the addresses, defaults to 'address'.
+    client: BatchClient, optional
+        batch engine to post with. Batches that failed even after retries are not yielded, they are left in client.failures.
+    skip_batches: collection, optional
+        batch numbers not to request, e.g. the ones already written by a previous run.
+    processes: int, optional
+        number of worker processes the addresses are parsed with, see parse_address_series.
+    """
+    client = client if client is not None else BatchClient(auth=credentials)
+    addresses = dataframe.loc[:, address_col_name]
+    todo = [b for b in range(int(np.ceil(dataframe.shape[0] / 100))) if b not in skip_batches]
+    # the distinct addresses of every batch to post parsed at once, so they can be spread over a process pool; anything
+    # but a string is left to fail its own batch, as parse_address does
+    rows = addresses.iloc[np.concatenate([np.arange(b*100, min(b*100+100, addresses.shape[0])) for b in todo])] if todo \
+        else addresses.iloc[:0]
+    strings = pd.unique(rows[rows.map(lambda a: type(a) is str)].values)
+    parsed = dict(zip(strings, parse_address_series(strings, processes=processes)))
+
+    def make_batch(i):
+        # the 100 parsed addresses of a batch to RY endpoint
+        address_df = pd.DataFrame(addresses.iloc[i:i+100].map(
+            lambda a: _fresh(parsed[a]) if type(a) is str else parse_address(a, verbose=False)))
+        address_df.index.name = 'original_idx'
+        address_df.reset_index(inplace=True)
+        # making req objects
+        req_obj_serie = address_df.apply(lambda x: make_req_obj_from_dict(x[address_col_name], x['original_idx']), axis=1)
+        # grouping req objects for batch call
+        return {"params": req_obj_serie.tolist()}
+
+    for res in client.run(match_endpoint, [(lambda i=b*100: make_batch(i)) for b in todo], batch_ids=todo):
+        batch = res.batch
+        if res.error is not None:
+            print("error on the {}'s".format(batch * 100))
+            continue
+        # getting the original id and matched property for each item of the result object
+        records = [{"original_idx": int(m['params']['custom_id']), "property_id": m.get('property_id', np.nan)}
+                   for m in res.result['matches']]
+        print("The {}'s are running".format(batch * 100))
+        yield batch, pd.DataFrame(records, columns=['original_idx', 'property_id'])
+
+
+def get_ry_id_for_df(dataframe, address_col_name='address', client=None, output_path=None, processes=None):
     """ 
     Calls RY match endpoint in batches of 100 addresses, returns a Series of reonomny ID in the order of the received addresses.
+    Batches are posted concurrently over a pooled session, see ry_client.BatchClient.
 
     Parameters
     ----------
@@ -194,35 +341,33 @@ def get_ry_id_for_df(dataframe, address_col_name='address'):
         a dataframe containing a column, or various, with the addresses fo the bldgs to be matched to RY ids. 
     address_col_name: string
         name of the column containing the addresses, defaults to 'address'.
+    client: BatchClient, optional
+        batch engine to post with, e.g. to set the number of batches in flight. Batches that failed even after retries
+        are left in client.failures.
+    output_path: string, optional
+        streaming mode: every batch is written there as soon as it is matched (a .csv file, or else a directory of parquet
+        files, see batch_sink.BatchSink). Re-running with the same dataframe and output_path resumes the job, skipping
+        the batches already written.
+    processes: int, optional
+        number of worker processes the addresses are parsed with before posting, for large dataframes. Defaults to
+        parsing in this process.
     Returns
     -------
     On success: A Pandas Serie with the Reonomy ID of the inputted addresses, in order. In case of no match, NaN
     -------
     TO-DO: add support for address to be separated in various columns e.g. city_col, zipcode_col, instead of all the address string in a single column.
     """
-    results = pd.DataFrame(columns=['params', 'property_id'])
-    for i in np.arange(0, dataframe.shape[0], 100):
-        try:
-            # getting and parsing 100 addresses from the DF to batch RY endpoint
-            address_df = pd.DataFrame(dataframe.loc[:, address_col_name].iloc[i :i+100].apply(parse_address))
-            address_df.index.name = 'original_idx'
-            address_df.reset_index(inplace=True)
-
-            # making req objects
-            req_obj_serie = address_df.apply(lambda x: make_req_obj_from_dict(x[address_col_name], x['original_idx']), axis=1)
-            # grouping req objects for batch call
-            great_params = {"params": req_obj_serie.tolist()}
-            r = requests.post(match_endpoint, auth=credentials, json=great_params)
-            # stacking each item of result object
-            results = results.append(pd.DataFrame.from_dict(r.json()['matches']), sort=True, ignore_index=False)
-            # getting the original id for each row
-            results.set_index(results.params.apply(lambda x: int(x['custom_id'])), inplace=True)
-            results.index.name = 'original_idx'
-            print("The {}'s are running".format(i))
-        except Exception as e:
-            results = results.append({'params': str(e)+ ' ' + str(e.args), 'property_id': np.nan}, ignore_index=False)
-            print("error on the {}'s".format(i)) #'property_id': "ERROR on match call b/w rows {} & {}".format(100*i,100*i+100)}
-    return results.property_id
+    if output_path is None:
+        frames = [frame for _, frame in iter_ry_id_batches(dataframe, address_col_name, client, processes=processes)]
+    else:
+        sink = BatchSink(output_path)
+        for batch, frame in iter_ry_id_batches(dataframe, address_col_name, client, skip_batches=sink.done_batches(),
+                                               processes=processes):
+            sink.write(batch, frame)
+        frames = [frame for frame in [sink.read()] if not frame.empty]
+    # the final frame is assembled once
+    results = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['original_idx', 'property_id'])
+    return results.set_index('original_idx').property_id
 
 
 
@@ -235,31 +380,65 @@ body = {
 }
 
 
-def get_all_addresses_for_ry_id(dataframe, ry_id_col_name='ry_id'):
+def iter_addresses_for_ry_id_batches(dataframe, ry_id_col_name='ry_id', client=None, skip_batches=()):
+    """
+    Generator behind get_all_addresses_for_ry_id: calls RY's Get Multiple endpoint in batches of 100 ry_ids and yields,
+    per batch, its number and a DataFrame of records (ry_id, addresses).
+
+    Parameters
+    ----------
+    dataframe: Pandas DataFrame
+        a dataframe containing a column, with the ry_ids.
+    ry_id_col_name: string
+        name of the column containing the ry_ids, defaults to 'ry_id'.
+    client: BatchClient, optional
+        batch engine to post with. Batches that failed even after retries are not yielded, they are left in client.failures.
+    skip_batches: collection, optional
+        batch numbers not to request, e.g. the ones already written by a previous run.
+    """
+    client = client if client is not None else BatchClient(auth=credentials)
+    todo = [b for b in range(int(np.ceil(dataframe.shape[0] / 100))) if b not in skip_batches]
+    # a body per batch, the batches are in flight at the same time
+    batches = [dict(body, property_ids=dataframe.iloc[b*100:b*100+100].loc[:, ry_id_col_name].tolist()) for b in todo]
+    for res in client.run(get_multiple_endpoint, batches, batch_ids=todo):
+        batch = res.batch
+        if res.error is not None:
+            print("error on the {}'s".format(batch * 100))
+            continue
+        sin = [{"ry_id": prop['id'], 
+                "addresses": [dic['line1'] for dic in prop['addresses']] } for prop in res.result['properties']]
+        print("The {}'s are running".format(batch * 100))
+        yield batch, pd.DataFrame(sin, columns=['ry_id', 'addresses'])
+
+
+def get_all_addresses_for_ry_id(dataframe, ry_id_col_name='ry_id', client=None, output_path=None):
     """
     Calls RY's Get Multiple endpoint in batches of 100 ry_ids; gets and returns all addresses associated with each ry_id.
-    Takes ~1min for every 300 ry_ids. 
+    Batches are posted concurrently over a pooled session, see ry_client.BatchClient.
     
     Parameters
     ----------
     dataframe: Pandas DataFrame
         a dataframe containing a column, with the ry_ids.
-    address_col_name: string
+    ry_id_col_name: string
         name of the column containing the ry_ids, defaults to 'ry_id'.
+    client: BatchClient, optional
+        batch engine to post with, e.g. to set the number of batches in flight. Batches that failed even after retries
+        are left in client.failures.
+    output_path: string, optional
+        streaming mode: every batch is written there as soon as it is fetched (a .csv file, or else a directory of parquet
+        files, see batch_sink.BatchSink). Re-running with the same dataframe and output_path resumes the job, skipping
+        the batches already written.
     Returns
     -------
     On success: A Pandas DataFrame with the Reonomy ID inputted, and a list of addresses associated with each
     """
-    results = pd.DataFrame(columns=['ry_id', 'addresses'])
-    for i in np.arange(0, dataframe.shape[0], 100):
-        try:
-            body["property_ids"] = dataframe.iloc[i:i+100].loc[:, ry_id_col_name].tolist()
-            r = requests.post(get_multiple_endpoint, auth=credentials, json=body)   
-            sin = [{"ry_id": prop['id'], 
-                    "addresses": [dic['line1'] for dic in prop['addresses']] } for prop in r.json()['properties']]
-            results = results.append(pd.DataFrame(sin), sort=True)
-            print("The {}'s are running".format(i))
-        except Exception as e:
-            results = results.append({'params': str(e)+ ' ' + str(e.args), 'property_id': np.nan}, ignore_index=True)
-            print("error on the {}'s".format(i))
-    return results
\ No newline at end of file
+    if output_path is None:
+        frames = [frame for _, frame in iter_addresses_for_ry_id_batches(dataframe, ry_id_col_name, client)]
+    else:
+        sink = BatchSink(output_path, list_cols=['addresses'])
+        for batch, frame in iter_addresses_for_ry_id_batches(dataframe, ry_id_col_name, client, skip_batches=sink.done_batches()):
+            sink.write(batch, frame)
+        frames = [frame.drop('batch', axis=1) for frame in [sink.read()] if not frame.empty]
+    # the final frame is assembled once
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['ry_id', 'addresses'])
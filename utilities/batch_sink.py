@@ -0,0 +1,95 @@
+# Incremental on-disk output for the batch jobs of address_tools_demo.
+# Every completed batch is written as soon as it comes back, tagged with its batch number, so a crash doesn't lose the
+# batches already done and a re-run of the same job skips them.
+#   - a path ending in .csv appends the rows of each batch to a single csv, and then the batch number and the size of
+#     the csv after it to <path>.batches. Only the batches listed there count as done: on opening, the csv is truncated
+#     back to the size of the last one listed, dropping the rows of a batch the crash left half written
+#   - any other path is a directory holding one parquet file per batch, written atomically
+# List-valued columns (e.g. the addresses of a ry_id) are stored as json strings in the csv and decoded back on read.
+
+import os
+import json
+import pandas as pd
+
+
+class BatchSink:
+
+    def __init__(self, path, list_cols=()):
+        self.path = path
+        self.list_cols = list(list_cols)
+        self.is_csv = path.endswith('.csv')
+        self.manifest_path = path + ".batches"
+        if self.is_csv:
+            self._recover()
+        else:
+            os.makedirs(path, exist_ok=True)
+
+    def _manifest(self):
+        """ (batch, csv size after it) of every batch completely written to the csv. """
+        if not os.path.exists(self.manifest_path):
+            return []
+        entries = []
+        with open(self.manifest_path) as f:
+            for line in f:
+                # the last line may itself be half written
+                fields = line.split(',')
+                if line.endswith('\n') and len(fields) == 2:
+                    entries.append((int(fields[0]), int(fields[1])))
+        return entries
+
+    def _recover(self):
+        """ Cuts the csv back to its last complete batch. """
+        entries = self._manifest()
+        size = entries[-1][1] if entries else 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) > size:
+            with open(self.path, 'rb+') as f:
+                f.truncate(size)
+        with open(self.manifest_path, 'w') as f:
+            f.write(''.join("{},{}\n".format(batch, end) for batch, end in entries))
+
+    def _part_path(self, batch):
+        return os.path.join(self.path, "part-{:06d}.parquet".format(batch))
+
+    def done_batches(self):
+        """ Set of the batch numbers already written. """
+        if self.is_csv:
+            return set(batch for batch, _ in self._manifest())
+        return set(int(f[5:11]) for f in os.listdir(self.path) if f.startswith("part-") and f.endswith(".parquet"))
+
+    def write(self, batch, frame):
+        frame = frame.assign(batch=batch)
+        if self.is_csv:
+            for col in self.list_cols:
+                frame[col] = frame[col].apply(json.dumps)
+            header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a') as f:
+                f.write(frame.to_csv(index=False, header=header))
+                f.flush()
+                os.fsync(f.fileno())
+            end = os.path.getsize(self.path)
+            # the batch counts as done only once all its rows are on disk
+            with open(self.manifest_path, 'a') as f:
+                f.write("{},{}\n".format(batch, end))
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            tmp = self._part_path(batch) + ".tmp"
+            frame.to_parquet(tmp, index=False)
+            os.replace(tmp, self._part_path(batch))
+
+    def read(self):
+        """ Every batch written so far, as one DataFrame ordered by batch. """
+        if self.is_csv:
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                return pd.DataFrame()
+            frame = pd.read_csv(self.path)
+            for col in self.list_cols:
+                frame[col] = frame[col].apply(json.loads)
+        else:
+            parts = sorted(f for f in os.listdir(self.path) if f.startswith("part-") and f.endswith(".parquet"))
+            if not parts:
+                return pd.DataFrame()
+            frame = pd.concat([pd.read_parquet(os.path.join(self.path, f)) for f in parts], ignore_index=True)
+            for col in self.list_cols:
+                frame[col] = frame[col].apply(list)
+        return frame.sort_values('batch', kind='mergesort').reset_index(drop=True)
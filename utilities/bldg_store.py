@@ -0,0 +1,129 @@
+# Columnar, pre-parsed building store.
+# The raw OSM building csvs carry each footprint as a python-repr geojson string, which has to be eval'd and polygonized
+# row by row every time a city is loaded. The functions below run that parsing once and write every partition (a country
+# for the European data, 'nyc' for the NYC footprints) as:
+#   <store_dir>/<partition>/attrs.parquet   -> every non-geometry column, columnar
+#   <store_dir>/<partition>/coords.npy      -> float64 (n_points, 2) array with the exterior ring of every footprint, lon/lat
+#   <store_dir>/<partition>/offsets.npy     -> int64 (n_bldgs + 1,) array, ring i spans coords[offsets[i]:offsets[i+1]]
+# Reading a partition back is then a parquet read plus one vectorized polygon construction, no eval, no python loop.
+
+import os
+import ast
+import numpy as np, pandas as pd, geopandas
+import shapely
+
+STORE_DIR = "./data/bldgs_store"
+
+
+def partition_path(partition, store_dir=STORE_DIR):
+    return os.path.join(store_dir, str(partition))
+
+
+def has_partition(partition, store_dir=STORE_DIR):
+    path = partition_path(partition, store_dir)
+    return all(os.path.exists(os.path.join(path, f)) for f in ("attrs.parquet", "coords.npy", "offsets.npy"))
+
+
+def write_partition(df, partition, store_dir=STORE_DIR):
+    """
+    Writes a building DataFrame, as read from the raw csvs (with its geojson string 'geo' column), as a store partition.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        Building data with a 'geo' column holding geojson Polygons, either as dicts or as their python-repr strings.
+    partition : str
+        Name of the partition, e.g. the country code.
+    store_dir : str, optional
+        Root directory of the store.
+
+    Returns
+    -------
+    The path of the written partition
+    """
+    path = partition_path(partition, store_dir)
+    os.makedirs(path, exist_ok=True)
+    # ast.literal_eval instead of eval: same result on the repr strings, without executing anything
+    geos = df.geo.apply(lambda g: ast.literal_eval(g) if isinstance(g, str) else g)
+    # only the exterior ring is kept, as BldgFinder and Building always did with Polygon(x['coordinates'][0])
+    rings = [np.asarray(g['coordinates'][0], dtype='float64')[:, :2] for g in geos]
+    offsets = np.zeros(len(rings) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([r.shape[0] for r in rings])
+    coords = np.concatenate(rings) if rings else np.empty((0, 2), dtype='float64')
+    np.save(os.path.join(path, "coords.npy"), coords)
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    attrs = df.drop('geo', axis=1).reset_index(drop=True)
+    attrs.to_parquet(os.path.join(path, "attrs.parquet"), index=False)
+    return path
+
+
+def convert_csv(csv_path, partition_col=None, partition=None, store_dir=STORE_DIR):
+    """
+    One-time conversion of a raw building csv into the store. Either splits the csv on a column, e.g. 'country' for
+    de_gb_nl_ie_fr_bldgs.csv, or writes it whole as a single named partition, e.g. 'nyc' for nyc.csv.
+
+    Parameters
+    ----------
+    csv_path : str
+        Path to the raw csv.
+    partition_col : str, optional
+        Column to partition the rows on.
+    partition : str, optional
+        Name of the single partition to write, when partition_col is not given.
+    store_dir : str, optional
+        Root directory of the store.
+
+    Returns
+    -------
+    List of the partitions written
+    """
+    assert (partition_col is not None) or (partition is not None), "either partition_col or partition is required"
+    df = pd.read_csv(csv_path)
+    if partition_col is None:
+        write_partition(df, partition, store_dir)
+        return [partition]
+    written = []
+    for key, part in df.groupby(partition_col, sort=False):
+        write_partition(part, key, store_dir)
+        written.append(key)
+        print("Wrote {:,} bldgs to partition {}".format(part.shape[0], key))
+    return written
+
+
+def polygons_from_arrays(coords, offsets):
+    """ Builds all the footprint polygons of a partition in one vectorized call from its flat coordinate arrays. """
+    ring_ids = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+    rings = shapely.linearrings(np.asarray(coords), indices=ring_ids)
+    return shapely.polygons(rings)
+
+
+def read_partition(partition, store_dir=STORE_DIR, columns=None):
+    """
+    Opens a single partition of the store as a GeoDataFrame.
+
+    Parameters
+    ----------
+    partition : str
+        Name of the partition, e.g. the country code.
+    store_dir : str, optional
+        Root directory of the store.
+    columns : list, optional
+        Subset of the attribute columns to read. Defaults to all.
+
+    Returns
+    -------
+    A GeoDataFrame with the partition attributes and a polygon 'geometry' column, in EPSG:4326
+    """
+    path = partition_path(partition, store_dir)
+    attrs = pd.read_parquet(os.path.join(path, "attrs.parquet"), columns=columns)
+    coords = np.load(os.path.join(path, "coords.npy"))
+    offsets = np.load(os.path.join(path, "offsets.npy"))
+    return geopandas.GeoDataFrame(attrs, geometry=polygons_from_arrays(coords, offsets), crs="EPSG:4326")
+
+
+def exterior_coords_inv(geometry):
+    """ Exterior ring of every polygon as a list of (lat, lon) tuples, the layout folium expects. """
+    rings = shapely.get_exterior_ring(np.asarray(geometry))
+    counts = shapely.get_num_coordinates(rings)
+    coords = shapely.get_coordinates(rings)[:, ::-1]
+    return [list(map(tuple, c.tolist())) for c in np.split(coords, np.cumsum(counts)[:-1])]
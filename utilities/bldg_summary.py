@@ -0,0 +1,192 @@
+# Per-building KPI snapshot.
+# The KPIs Building recomputes from its raw lease rows on every call (mean rent, revenue from known leases,
+# perc_known/perc_vacant...) are computed for a whole portfolio by one aggregated query and kept in a local parquet
+# snapshot, indexed by ry_id, with a json sidecar holding its bookkeeping:
+#   - as_of: the date the current leases were evaluated at
+#   - leases_touched_at: the touched_at high-water mark of leases_ck at build time
+#   - refreshed_at: the time of the last build or refresh
+# refresh() recomputes only the buildings whose leases were touched since the mark, or started or ended since as_of,
+# and drops the ones of them gone from properties_ry. Lookups are O(1) while the snapshot is fresh (evaluated today and
+# refreshed within max_age); callers fall back to live computation otherwise.
+# perc_known/perc_vacant/perc_occupied are read from properties_ry, which has no touched_at: a building picks up their
+# changes when it is recomputed, a full build() picks up all of them. No KPI reads the listings.
+# The queries run through queries.read, like the Building and Market ones.
+
+import os
+import json
+import datetime as dt
+import pandas as pd, numpy as np
+from . import queries
+from .market_stats import market_leases_from, current_filter
+
+DEFAULT_PATH = "./data/bldg_summary.parquet"
+
+# KPI columns, after ry_id
+summary_cols = ['rsf', 'perc_known', 'perc_vacant', 'perc_occupied', 'current_leases', 'leased_sf', 'mean_rent',
+                'known_rent_revenue', 'unknown_rent_sf']
+
+no_mark = '1900-01-01'
+
+queries.register('bldg_summary', "WITH bldgs AS (SELECT reonomy_id AS ry_id, rsf, perc_known, perc_vacant, perc_occupied \
+                                     FROM properties_ry WHERE reonomy_id = ANY(:ry_ids)), \
+                           cur AS (SELECT mt.ry_id, COUNT(*) AS current_leases, \
+                                          SUM(lea.transaction_size) AS leased_sf, \
+                                          AVG(lea.current_rent) AS mean_rent, \
+                                          SUM(lea.transaction_size * lea.current_rent) AS known_rent_revenue, \
+                                          SUM(CASE WHEN lea.current_rent IS NULL THEN lea.transaction_size END) AS unknown_rent_sf \
+                                   {} AND {} GROUP BY mt.ry_id) \
+                      SELECT b.ry_id, b.rsf, b.perc_known, b.perc_vacant, b.perc_occupied, \
+                             COALESCE(c.current_leases, 0) AS current_leases, COALESCE(c.leased_sf, 0) AS leased_sf, \
+                             c.mean_rent, COALESCE(c.known_rent_revenue, 0) AS known_rent_revenue, \
+                             COALESCE(c.unknown_rent_sf, 0) AS unknown_rent_sf \
+                      FROM bldgs AS b LEFT JOIN cur AS c ON c.ry_id = b.ry_id".format(market_leases_from, current_filter),
+                 [('ry_ids', 'text[]'), ('day', 'date')])
+
+queries.register('bldg_summary_marks', "SELECT MAX(touched_at) AS leases_touched_at FROM leases_ck")
+
+queries.register('bldg_summary_changed', "SELECT DISTINCT mt.ry_id {} \
+                                          AND (lea.touched_at > :leases_since \
+                                               OR (lea.commencement_date > :as_of AND lea.commencement_date <= :day) \
+                                               OR (lea.expiration_date > :as_of AND lea.expiration_date <= :day))"\
+                    .format(market_leases_from),
+                 [('ry_ids', 'text[]'), ('day', 'date'), ('as_of', 'date'), ('leases_since', 'timestamp')])
+
+
+def summary_sql(engine, ry_ids, date=None):
+    """
+    KPIs of the buildings, computed live by one aggregated query.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy Engine
+        Connection to the database.
+    ry_ids : list
+        Reonomy ids of the buildings.
+    date : date, optional
+        Date the leases are current at. Defaults to today.
+
+    Returns
+    -------
+    A Pandas DataFrame indexed by ry_id with the summary_cols columns
+    """
+    day = dt.date.today() if date is None else pd.Timestamp(date).date()
+    summary = queries.read(engine, 'bldg_summary', {'ry_ids': [str(b) for b in ry_ids], 'day': day})
+    return summary.set_index('ry_id').loc[:, summary_cols]
+
+
+def _perc(value):
+    return 0 if pd.isnull(value) else value
+
+
+def mean_rent(kpis):
+    """ Building.get_mean_rent out of the KPIs of a building: 0 when it has no current lease. """
+    return kpis['mean_rent'] if kpis['current_leases'] else 0
+
+
+def estimated_revenue(kpis, _rent, occupied_from_unknown=0.75):
+    """ Building.get_estimated_revenue out of the KPIs of a building: current leases without a known rent are counted at
+    _rent, and the unknown sqft at _rent for its occupied_from_unknown fraction. """
+    if not kpis['current_leases']:
+        return 0
+    rkl = kpis['known_rent_revenue'] + kpis['unknown_rent_sf'] * _rent
+    perc_known = _perc(kpis['perc_known'])
+    if perc_known >= 100:
+        return rkl
+    return rkl + kpis['rsf'] * (1 - perc_known/100) * occupied_from_unknown * _rent
+
+
+class BldgSummary:
+
+    def __init__(self, path=DEFAULT_PATH, max_age=dt.timedelta(days=1)):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            Parquet file of the snapshot; its bookkeeping goes to the same path plus .json.
+        max_age : timedelta, optional
+            Time after the last build or refresh past which the snapshot is stale.
+        """
+        self.path = path
+        self.max_age = max_age
+        self.frame = None
+        self.meta = {}
+        if os.path.exists(self.path) and os.path.exists(self.path + ".json"):
+            self.frame = pd.read_parquet(self.path)
+            with open(self.path + ".json") as f:
+                self.meta = json.load(f)
+
+    def _marks(self, engine):
+        mark = queries.read(engine, 'bldg_summary_marks').leases_touched_at.iloc[0]
+        return {'leases_touched_at': str(mark) if not pd.isnull(mark) else no_mark}
+
+    def _save(self, frame, meta):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        frame.to_parquet(tmp)
+        os.replace(tmp, self.path)
+        with open(self.path + ".json.tmp", 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+        self.frame = frame
+        self.meta = meta
+
+    def build(self, engine, ry_ids):
+        """ Computes the KPIs of every building in ry_ids and writes the snapshot. Returns the number of buildings. """
+        # marks taken before the computation, changes made meanwhile are picked up by the next refresh
+        marks = self._marks(engine)
+        day = dt.date.today()
+        frame = summary_sql(engine, ry_ids, day)
+        self._save(frame, dict(marks, as_of=day.isoformat(), refreshed_at=dt.datetime.now().isoformat()))
+        return frame.shape[0]
+
+    def refresh(self, engine):
+        """ Recomputes the buildings of the snapshot changed since the last build or refresh. Returns their number. """
+        if self.frame is None:
+            print("No bldg summary at {}, call build() first.".format(self.path))
+            return 0
+        marks = self._marks(engine)
+        day = dt.date.today()
+        ry_ids = self.frame.index.tolist()
+        changed = queries.read(engine, 'bldg_summary_changed',
+                               {'ry_ids': ry_ids, 'day': day, 'as_of': dt.date.fromisoformat(self.meta['as_of']),
+                                'leases_since': pd.Timestamp(self.meta['leases_touched_at']).to_pydatetime()})\
+                        .ry_id.tolist()
+        frame = self.frame
+        if changed:
+            updated = summary_sql(engine, changed, day)
+            # changed buildings not recomputed are gone from properties_ry, and from the snapshot
+            frame = pd.concat([frame.drop(frame.index.intersection(changed)), updated])
+            frame = frame.loc[[b for b in ry_ids if b in frame.index]]
+        self._save(frame, dict(marks, as_of=day.isoformat(), refreshed_at=dt.datetime.now().isoformat()))
+        return len(changed)
+
+    def is_fresh(self):
+        """ True when the snapshot was evaluated today and refreshed within max_age. """
+        if self.frame is None:
+            return False
+        refreshed_at = dt.datetime.fromisoformat(self.meta['refreshed_at'])
+        return self.meta['as_of'] == dt.date.today().isoformat() and dt.datetime.now() - refreshed_at <= self.max_age
+
+    def lookup(self, ry_id):
+        """ KPIs of a building as a Pandas Series, None when the snapshot is stale or doesn't hold it. """
+        if not self.is_fresh() or ry_id not in self.frame.index:
+            return None
+        return self.frame.loc[ry_id]
+
+    def lookup_many(self, ry_ids):
+        """ KPIs of the buildings held by a fresh snapshot, an empty frame when it is stale. """
+        if not self.is_fresh():
+            return pd.DataFrame(columns=summary_cols)
+        return self.frame.loc[self.frame.index.intersection([str(b) for b in ry_ids])]
+
+
+_default_summary = None
+
+
+def default_summary():
+    """ Process-wide snapshot at DEFAULT_PATH, read by Building and Market. """
+    global _default_summary
+    if _default_summary is None:
+        _default_summary = BldgSummary()
+    return _default_summary
@@ -0,0 +1,135 @@
+# Process-wide database engines.
+# Building, BuildingSet and Market used to create their own engine, hence their own connection pool and handshakes, per
+# instance. get_engine() lazily creates one engine per database url and hands the same one to every caller. Pool sizing
+# and pre-ping are configurable, pool activity is counted for pool_metrics(), and set_engine() injects any engine in
+# place of the default one, e.g. a local SQLite or PostGIS stand-in for tests.
+
+import os
+import time
+import threading
+from sqlalchemy import create_engine, event
+
+DEFAULT_URL_ENV = "DATABASE_URL_silhouetted"
+
+pool_settings = {"pool_size": 5,
+                 "max_overflow": 10,
+                 "pool_timeout": 30,
+                 "pool_recycle": 1800,
+                 "pool_pre_ping": True}
+
+# key of the default database engine, the one of DATABASE_URL_silhouetted or the one injected by set_engine
+DEFAULT = "default"
+
+_engines = {}
+_metrics = {}
+_lock = threading.Lock()
+
+
+def configure_pool(**settings):
+    """ Updates the pool settings of the engines created from now on, e.g. configure_pool(pool_size=20). """
+    pool_settings.update(settings)
+
+
+def _instrument(engine):
+    metrics = {"checkouts": 0, "checkins": 0, "connects": 0, "connect_time": 0., "hold_time": 0.}
+    pending = threading.local()
+
+    @event.listens_for(engine, "do_connect")
+    def _before_connect(dialect, conn_rec, cargs, cparams):
+        pending.start = time.perf_counter()
+
+    @event.listens_for(engine, "connect")
+    def _after_connect(dbapi_conn, conn_rec):
+        metrics["connects"] += 1
+        metrics["connect_time"] += time.perf_counter() - getattr(pending, "start", time.perf_counter())
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_conn, conn_rec, conn_proxy):
+        metrics["checkouts"] += 1
+        conn_rec.info["checked_out_at"] = time.perf_counter()
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_conn, conn_rec):
+        metrics["checkins"] += 1
+        metrics["hold_time"] += time.perf_counter() - conn_rec.info.pop("checked_out_at", time.perf_counter())
+
+    _metrics[engine] = metrics
+    return engine
+
+
+def get_engine(url=None, **settings):
+    """
+    Shared engine for the database at url, created on first use.
+
+    Parameters
+    ----------
+    url : str, optional
+        Database url. Defaults to the engine injected by set_engine, or else the DATABASE_URL_silhouetted environment
+        variable.
+    settings : optional
+        Overrides of pool_settings for this engine, only used when it gets created.
+
+    Returns
+    -------
+    A SQLAlchemy Engine, the same one for every call with the same url
+    """
+    with _lock:
+        if url is None:
+            if DEFAULT in _engines:
+                return _engines[DEFAULT]
+            url = os.environ[DEFAULT_URL_ENV]
+            _engines[DEFAULT] = _create(url, settings)
+            return _engines[DEFAULT]
+        return _create(url, settings)
+
+
+def _create(url, settings):
+    # engine of url, created unless there is one already; called under the lock
+    if url not in _engines:
+        kwargs = dict(pool_settings, **settings)
+        if url.startswith("sqlite"):
+            # sqlite engines don't use a sized queue pool
+            kwargs = {k: v for k, v in kwargs.items() if k == "pool_pre_ping"}
+        _engines[url] = _instrument(create_engine(url, **kwargs))
+    return _engines[url]
+
+
+def set_engine(engine, url=None):
+    """ Registers an already created engine as the shared one for url, or as the default one, returned by get_engine()
+    whether DATABASE_URL_silhouetted is set or not. """
+    url = url if url is not None else DEFAULT
+    with _lock:
+        if engine not in _metrics:
+            _instrument(engine)
+        _engines[url] = engine
+    return engine
+
+
+def dispose_engines():
+    """ Closes the pooled connections of every shared engine and forgets them. """
+    with _lock:
+        # the default engine is also registered under its url
+        for engine in set(_engines.values()):
+            engine.dispose()
+        _engines.clear()
+
+
+def pool_metrics(engine=None):
+    """
+    Pool activity of a shared engine (the default one if not given).
+
+    Returns
+    -------
+    A dictionary with the pool status, the number of checkouts and checkins, of new connections and their mean connect
+    latency, and the mean time a connection was held between checkout and checkin, in seconds
+    """
+    engine = engine if engine is not None else get_engine()
+    m = _metrics.get(engine, {})
+    pool = engine.pool
+    return {"pool": pool.status(),
+            "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "checkouts": m.get("checkouts", 0),
+            "checkins": m.get("checkins", 0),
+            "connects": m.get("connects", 0),
+            "mean_connect_time": m["connect_time"] / m["connects"] if m.get("connects") else 0.,
+            "mean_hold_time": m["hold_time"] / m["checkins"] if m.get("checkins") else 0.}
@@ -0,0 +1,93 @@
+# Typed decoding of query results.
+# Rows come back from the driver as python objects: dates as datetime.date, numerics as Decimal/float, repeated strings
+# (tenant, space type, submarket, building address) as one str object per row. decode() turns the columns of a schema
+# into compact dtypes right after the fetch, one chunk at a time when streaming, so the object version of a large result
+# never has to be held whole. memory_bytes() measures a frame, for the before/after footprint queries.read records.
+
+import pandas as pd
+
+DATE = 'datetime64[ns]'
+
+# leases_ck columns, as displayed / aggregated per building. Rents and sizes stay float64: they are summed into revenues
+# (get_estimated_revenue, rent_roll), which have to match the ones of bldg_summary; only repeated strings shrink
+lease_dtypes = {'execution_date': DATE,
+                'commencement_date': DATE,
+                'expiration_date': DATE,
+                'touched_at': DATE,
+                'transaction_size': 'float64',
+                'starting_rent': 'float64',
+                'current_rent': 'float64',
+                'avg_rent': 'float64',
+                'asking_rent': 'float64',
+                'effective_rent': 'float64',
+                'work_value': 'float64',
+                'address': 'category',
+                'tenant_name': 'category',
+                'space_type': 'category',
+                'submarket': 'category',
+                'break_option_type': 'category',
+                'free_rent_type': 'category',
+                'ry_id': 'category'}
+
+# local dataset of market_stats, float64 too so its aggregates match the ones of Postgres
+market_lease_dtypes = {'commencement_date': DATE,
+                       'expiration_date': DATE,
+                       'transaction_size': 'float64',
+                       'current_rent': 'float64',
+                       'space_type': 'category',
+                       'submarket': 'category',
+                       'ry_id': 'category'}
+
+# listings_f42 lease listings
+vacancy_dtypes = {'touched_at': DATE,
+                  'size': 'float64',
+                  'rate_per_sqft_per_year': 'float64',
+                  'unit_type': 'category'}
+
+
+def memory_bytes(frame):
+    """ Memory used by a frame, counting the python objects it holds. """
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+def decode(frame, dtypes):
+    """
+    Converts the columns of frame listed in dtypes, in place. Missing columns are skipped, unparseable values become
+    NaN/NaT.
+
+    Parameters
+    ----------
+    frame : Pandas DataFrame
+        Raw query result.
+    dtypes : dict
+        Column name -> 'datetime64[ns]', 'category' or a numeric dtype.
+
+    Returns
+    -------
+    The frame
+    """
+    for col, dtype in dtypes.items():
+        if col not in frame:
+            continue
+        if dtype == DATE:
+            frame[col] = pd.to_datetime(frame[col], errors='coerce')
+        elif dtype == 'category':
+            frame[col] = frame[col].astype('category')
+        else:
+            frame[col] = pd.to_numeric(frame[col], errors='coerce').astype(dtype)
+    return frame
+
+
+def concat_decoded(chunks):
+    """ Concatenates decoded chunks, keeping categorical columns categorical (over the union of the categories). """
+    first = chunks[0]
+    cat_cols = [c for c in first.columns if isinstance(first[c].dtype, pd.CategoricalDtype)]
+    # categories in order of appearance, as object: a chunk with no value in a column comes back with empty float64
+    # categories, which don't combine with the str ones of the others
+    categories = dict((c, pd.Index(pd.unique(pd.concat([pd.Series(chunk[c].cat.categories, dtype=object)
+                                                         for chunk in chunks], ignore_index=True)), dtype=object))
+                      for c in cat_cols)
+    for chunk in chunks:
+        for c in cat_cols:
+            chunk[c] = pd.Categorical(chunk[c], categories=categories[c])
+    return pd.concat(chunks, ignore_index=True)
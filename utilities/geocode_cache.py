@@ -0,0 +1,136 @@
+# Persistent cache for geocoding / address matching calls (Nominatim in BldgFinder, Reonomy's match endpoint in
+# address_tools_demo), so re-running a notebook doesn't re-pay every network round trip and rate limit.
+# Entries live in a SQLite file, keyed on the service, the normalized address and the country. They expire after a TTL,
+# the least recently used ones are evicted past max_entries, and "not found" answers are cached too (with their own TTL).
+
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_PATH = "./data/geocode_cache.sqlite"
+
+_non_word = re.compile(r'[^\w\s]')
+_whitespace = re.compile(r'\s+')
+
+
+def normalize_address(address):
+    """ Lowercased address, punctuation turned into whitespace, whitespace collapsed. """
+    return _whitespace.sub(' ', _non_word.sub(' ', str(address).lower())).strip()
+
+
+class GeocodeCache:
+
+    def __init__(self, path=DEFAULT_PATH, ttl=30*24*3600, negative_ttl=24*3600, max_entries=100000):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            SQLite file holding the cache. ':memory:' keeps it in memory.
+        ttl : int, optional
+            Seconds a found result stays valid.
+        negative_ttl : int, optional
+            Seconds a "not found" result stays valid.
+        max_entries : int, optional
+            Size bound of the cache; the least recently used entries are evicted past it.
+        """
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # a single connection shared by the threads of find_many, serialized by the lock
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("CREATE TABLE IF NOT EXISTS geocodes ( \
+                                service TEXT, address TEXT, country TEXT, result TEXT, \
+                                created_at REAL, last_access REAL, \
+                                PRIMARY KEY (service, address, country))")
+        self._con.execute("CREATE INDEX IF NOT EXISTS geocodes_last_access ON geocodes (last_access)")
+        self._con.commit()
+
+    def get(self, address, country, service='nominatim'):
+        """
+        Returns
+        -------
+        (True, result) on a fresh hit, result being None for a cached "not found". (False, None) on a miss.
+        """
+        key = (service, normalize_address(address), str(country).lower())
+        now = time.time()
+        with self._lock:
+            row = self._con.execute("SELECT result, created_at FROM geocodes \
+                                        WHERE service = ? AND address = ? AND country = ?", key).fetchone()
+            if row is not None:
+                result = json.loads(row[0])
+                ttl = self.ttl if result is not None else self.negative_ttl
+                if now - row[1] <= ttl:
+                    self._con.execute("UPDATE geocodes SET last_access = ? \
+                                        WHERE service = ? AND address = ? AND country = ?", (now,) + key)
+                    self._con.commit()
+                    self.hits += 1
+                    return True, result
+            self.misses += 1
+            return False, None
+
+    def set(self, address, country, result, service='nominatim'):
+        """ Stores a json-serializable result; None stands for "not found". """
+        key = (service, normalize_address(address), str(country).lower())
+        now = time.time()
+        with self._lock:
+            self._con.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?)",
+                              key + (json.dumps(result), now, now))
+            excess = self._con.execute("SELECT COUNT(*) FROM geocodes").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._con.execute("DELETE FROM geocodes WHERE rowid IN \
+                                    (SELECT rowid FROM geocodes ORDER BY last_access ASC LIMIT ?)", (excess,))
+            self._con.commit()
+
+    def lookup(self, address, country, fetch, service='nominatim'):
+        """
+        Cached result for the address if there is a fresh one, otherwise calls fetch() and caches what it returns.
+        fetch must return None when the address is not found; exceptions it raises are not cached.
+        """
+        hit, result = self.get(address, country, service)
+        if hit:
+            return result
+        result = fetch()
+        self.set(address, country, result, service)
+        return result
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            self._con.execute("DELETE FROM geocodes WHERE (result != 'null' AND created_at < ?) \
+                                                       OR (result = 'null' AND created_at < ?)",
+                              (now - self.ttl, now - self.negative_ttl))
+            self._con.commit()
+
+    def clear(self):
+        with self._lock:
+            self._con.execute("DELETE FROM geocodes")
+            self._con.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._con.execute("SELECT COUNT(*) FROM geocodes").fetchone()[0]
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": entries,
+                "hit_rate": self.hits / total if total else 0.}
+
+
+_default_cache = None
+
+
+def default_cache():
+    """ Process-wide cache at DEFAULT_PATH, shared by BldgFinder and address_tools_demo. """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = GeocodeCache()
+    return _default_cache
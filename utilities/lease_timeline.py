@@ -0,0 +1,112 @@
+# In-memory lease timeline of a building (or any set of leases).
+# Every lease is stored once, with its commencement and expiration dates kept as two sorted datetime64 arrays (plus the
+# permutations back to the rows), so "active at date D", "expiring within N months" and rent aggregates are answered
+# with binary searches over the arrays instead of new date-filtered queries. A lease is active at D when
+# commencement <= D < expiration, as in the current leases queries. Leases changed since the last load are merged in
+# by id, using the touched_at high-water mark.
+
+import datetime as dt
+from dateutil.relativedelta import relativedelta
+import pandas as pd, numpy as np
+
+
+def _day(date):
+    date = dt.date.today() if date is None else date
+    return np.datetime64(pd.Timestamp(date).normalize().to_datetime64(), 'D')
+
+
+class LeaseTimeline:
+
+    def __init__(self, leases, id_col='id', start_col='commencement_date', end_col='expiration_date',
+                 touched_col='touched_at'):
+        """
+        Parameters
+        ----------
+        leases : Pandas DataFrame
+            All the leases, with the raw leases_ck columns.
+        id_col, start_col, end_col, touched_col : str, optional
+            Columns holding the lease id, its commencement and expiration dates and its last update time.
+        """
+        self.id_col = id_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self.touched_col = touched_col
+        self._build(leases)
+
+    def _build(self, leases):
+        self.leases = leases.reset_index(drop=True)
+        self._start = pd.to_datetime(self.leases[self.start_col]).values.astype('datetime64[D]')
+        self._end = pd.to_datetime(self.leases[self.end_col]).values.astype('datetime64[D]')
+        # sorted copies and their permutations; NaT sorts last, so leases without dates never match a range
+        self._by_start = np.argsort(self._start, kind='mergesort')
+        self._start_sorted = self._start[self._by_start]
+        self._by_end = np.argsort(self._end, kind='mergesort')
+        self._end_sorted = self._end[self._by_end]
+        if self.touched_col in self.leases and self.leases[self.touched_col].notna().any():
+            self.last_touched = pd.to_datetime(self.leases[self.touched_col]).max()
+        else:
+            self.last_touched = None
+
+    def __len__(self):
+        return self.leases.shape[0]
+
+    def _active_positions(self, day):
+        # leases commenced by day, i.e. a prefix of the commencement order, still running at day
+        started = self._by_start[:np.searchsorted(self._start_sorted, day, side='right')]
+        return np.sort(started[self._end[started] > day])
+
+    def active_at(self, date=None):
+        """ Leases active at date (defaults to today), in their original order. """
+        return self.leases.iloc[self._active_positions(_day(date))]
+
+    def expiring_within(self, months=12, date=None):
+        """ Leases active at date (defaults to today) that expire within the following months. """
+        day = _day(date)
+        horizon = _day(pd.Timestamp(day) + relativedelta(months=months))
+        # expiration in (day, horizon], a contiguous range of the expiration order
+        ending = self._by_end[np.searchsorted(self._end_sorted, day, side='right'):
+                              np.searchsorted(self._end_sorted, horizon, side='right')]
+        return self.leases.iloc[np.sort(ending[self._start[ending] <= day])]
+
+    def mean_rent(self, date=None, rent_col='current_rent'):
+        """ Mean rent of the leases active at date, 0 when there are none. """
+        active = self.active_at(date)
+        return active[rent_col].mean() if not active.empty else 0
+
+    def rent_stats(self, date=None, rent_col='current_rent', size_col='transaction_size'):
+        """ Rent aggregates of the leases active at date: count, leased size, mean, size-weighted mean, min and max rent. """
+        active = self.active_at(date)
+        rents = active[rent_col].astype('float64')
+        sizes = active[size_col].astype('float64')
+        known = rents.notna() & sizes.notna()
+        return {"leases": active.shape[0],
+                "leased_size": sizes.sum(),
+                "mean_rent": rents.mean(),
+                "weighted_rent": (rents[known] * sizes[known]).sum() / sizes[known].sum() if sizes[known].sum() else np.nan,
+                "min_rent": rents.min(),
+                "max_rent": rents.max()}
+
+    def refresh(self, changed):
+        """
+        Merges leases added or updated since the last load: rows of changed replace the stored leases with the same id,
+        the others are added. Only the sorted arrays are rebuilt, no lease is re-fetched.
+
+        Parameters
+        ----------
+        changed : Pandas DataFrame
+            Leases with touched_at after last_touched, with the same columns as the stored ones.
+
+        Returns
+        -------
+        The number of leases merged
+        """
+        if changed is None or changed.empty:
+            return 0
+        kept = self.leases.loc[~self.leases[self.id_col].isin(changed[self.id_col])]
+        merged = pd.concat([kept, changed.reindex(columns=self.leases.columns)], ignore_index=True)
+        # concat falls back to object for categoricals with different categories
+        for col in self.leases.columns:
+            if isinstance(self.leases[col].dtype, pd.CategoricalDtype) and not isinstance(merged[col].dtype, pd.CategoricalDtype):
+                merged[col] = merged[col].astype('category')
+        self._build(merged)
+        return changed.shape[0]
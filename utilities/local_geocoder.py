@@ -0,0 +1,343 @@
+# Offline geocoding of addresses and building names.
+# Answers the lookups of BldgFinder locally, before any Nominatim round trip, from two sources:
+#   - the names of the buildings of the layer ('The Nadler', 'Soho House'), located on their footprint
+#   - optionally an OSM address extract of the city: one row per address point, with its house number, street and
+#     lon/lat (and optionally a name), as csv or parquet, e.g. exported with osmium from a Geofabrik extract. Columns
+#     may carry the OSM tag names (addr:housenumber, addr:street) or the short ones (housenumber, street).
+# Queries and keys are normalized the same way: lowercased, accents and punctuation removed, street abbreviations
+# expanded (st -> street, str -> strasse), the city and country words dropped. A query with a house number is looked up
+# as "number street", exactly, then among the streets closest to it that have this number; a query without one is looked
+# up as a name, exactly, then among the closest names. Closeness is the Jaccard similarity of the character trigrams,
+# looked up in an inverted index. Answers are shaped like the Nominatim ones, so the matching downstream is unchanged.
+# A country extract takes a while to normalize and index, so its index is built once and kept next to it, as
+#   <extract>.<city>.index/names.parquet, addresses.parquet -> key, lon, lat and label of every name and address
+#   <extract>.<city>.index/streets.npz                       -> trigram index of the streets
+#   <extract>.<city>.index/meta.json                         -> size and mtime of the extract it was built from
+# and rebuilt only when the extract changes.
+
+import os
+import re
+import json
+import unicodedata
+import numpy as np, pandas as pd
+import shapely
+from .geocode_cache import normalize_address
+
+DEFAULT_EXTRACT_DIR = "./data/osm_addresses"
+
+abbreviations = {'st': 'street', 'rd': 'road', 'ave': 'avenue', 'av': 'avenue', 'sq': 'square', 'pl': 'place',
+                 'ln': 'lane', 'ct': 'court', 'gdns': 'gardens', 'blvd': 'boulevard', 'bd': 'boulevard',
+                 'str': 'strasse'}
+# country words dropped from the queries and the keys, besides the city
+country_words = {'de': ['germany', 'deutschland', 'de'],
+                 'gb': ['uk', 'gb', 'united', 'kingdom', 'england'],
+                 'nl': ['netherlands', 'nederland', 'holland', 'nl'],
+                 'ie': ['ireland', 'eire', 'ie'],
+                 'fr': ['france', 'fr']}
+
+_housenumber = re.compile(r'^\d{1,4}[a-z]?$')
+_has_digit = re.compile(r'\d')
+
+
+def normalize_tokens(text):
+    """ Words of an address or a name, lowercased, without accents nor punctuation, abbreviations expanded. """
+    text = unicodedata.normalize('NFKD', str(text).lower().replace('ß', 'ss'))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    tokens = []
+    for t in normalize_address(text).split():
+        t = abbreviations.get(t, t)
+        # German compounds, Mittelstr -> mittelstrasse
+        if len(t) > 3 and t.endswith('str'):
+            t += 'asse'
+        tokens.append(t)
+    return tokens
+
+
+def trigrams(text):
+    padded = ' {} '.format(text)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def _join(strings):
+    # strings, none holding a newline, as one utf-8 byte array
+    return np.frombuffer('\n'.join(strings).encode('utf-8'), dtype='uint8')
+
+
+def _split(array):
+    return array.tobytes().decode('utf-8').split('\n') if array.shape[0] else []
+
+
+class TrigramIndex:
+    """ Inverted index of the character trigrams of a list of strings, for fuzzy lookups. """
+
+    def __init__(self, strings, postings=None, sizes=None):
+        self.strings = list(strings)
+        if postings is not None:
+            self.postings, self.sizes = postings, sizes
+            return
+        postings = {}
+        self.sizes = np.zeros(len(self.strings), dtype='int32')
+        for i, s in enumerate(self.strings):
+            grams = trigrams(s)
+            self.sizes[i] = len(grams)
+            for g in grams:
+                postings.setdefault(g, []).append(i)
+        self.postings = dict((g, np.array(ids, dtype='int32')) for g, ids in postings.items())
+
+    def save(self, path):
+        """ Writes the index as flat arrays to a .npz file. """
+        grams = list(self.postings)
+        ids = [self.postings[g] for g in grams]
+        offsets = np.zeros(len(ids) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([a.shape[0] for a in ids])
+        np.savez(path, strings=_join(self.strings), grams=_join(grams), sizes=self.sizes, offsets=offsets,
+                 ids=np.concatenate(ids) if ids else np.empty(0, dtype='int32'))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            grams = _split(arrays['grams'])
+            postings = dict(zip(grams, np.split(arrays['ids'], arrays['offsets'][1:-1]))) if grams else {}
+            return cls(_split(arrays['strings']), postings, arrays['sizes'])
+
+    def search(self, text, min_score=0.6, limit=5):
+        """ Up to limit (position, score) of the strings closest to text, best first, scores (Jaccard similarity of the
+        trigrams) of at least min_score. """
+        grams = trigrams(text)
+        hits = [self.postings[g] for g in grams if g in self.postings]
+        if not hits:
+            return []
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.strings))
+        score = shared / (len(grams) + self.sizes - shared)
+        candidates = np.flatnonzero(score >= min_score)
+        best = candidates[np.argsort(-score[candidates], kind='mergesort')[:limit]]
+        return [(int(i), float(score[i])) for i in best]
+
+
+def read_address_extract(path):
+    """
+    Reads an OSM address extract.
+
+    Parameters
+    ----------
+    path : str
+        csv or parquet file, one row per address point, with housenumber, street, lon and lat columns (or their OSM tag
+        names addr:housenumber and addr:street), and optionally name.
+
+    Returns
+    -------
+    A Pandas DataFrame with the housenumber, street, name, lon and lat columns
+    """
+    frame = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path, dtype={'addr:housenumber': str,
+                                                                                           'housenumber': str})
+    frame = frame.rename(columns={'addr:housenumber': 'housenumber', 'addr:street': 'street'})
+    if 'name' not in frame:
+        frame['name'] = None
+    return frame[['housenumber', 'street', 'name', 'lon', 'lat']]
+
+
+class LocalGeocoder:
+    """ Offline geocoder over the building names of a layer and an optional address extract. """
+
+    def __init__(self, places, country, city=None, min_score=0.6, name_score=0.8, base=None):
+        """
+        Parameters
+        ----------
+        places : Pandas DataFrame
+            One row per place: name, housenumber, street (any of them missing), lon and lat.
+        country : str
+            Country code of the places, e.g. 'gb'.
+        city : str, optional
+            City of the places, dropped from the queries and added to the display names.
+        min_score : float, optional
+            Lowest trigram similarity of a street a house number is looked for in.
+        name_score : float, optional
+            Lowest trigram similarity of a name answered by fuzzy match. Lower ones are left to the remote geocoder, as a
+            name that close is as often another building ('Kings Place', 'Kings Palace') as a typo.
+        base : LocalGeocoder, optional
+            Geocoder of the same country and city whose names and addresses come after the ones of places, e.g. the one
+            of the address extract (see from_extract).
+        """
+        self._configure(country, city, min_score, name_score)
+        # name -> first place of that name; keys and queries both without the city and country words, so "The London
+        # Eye" and "5 London Road" are found from "the london eye" and "5 london road, london"
+        names, addresses = self._tables(places)
+        street_index = None
+        if base is not None:
+            assert base.stop_tokens == self.stop_tokens, "the base geocoder is of another country or city"
+            # the streets of the base are indexed already
+            street_index = base.street_index if addresses.empty else None
+            names = pd.concat([names, base.names_table], ignore_index=True).drop_duplicates('key')
+            addresses = pd.concat([addresses, base.addresses_table], ignore_index=True).drop_duplicates('key')
+        self._index(names, addresses, street_index)
+
+    def _configure(self, country, city, min_score, name_score):
+        self.country = country
+        self.city = city
+        self.min_score = min_score
+        self.name_score = name_score
+        self.stop_tokens = set(country_words.get(country, [])) | set(normalize_tokens(city) if city else [])
+        self.hits = 0
+        self.misses = 0
+
+    def _tables(self, places):
+        """ key, lon, lat and label (the name of the place or its address) of the names and of the "number street"
+        addresses of places, the first place of every key. """
+        places = places.reset_index(drop=True)
+        labels = np.where(places.name.map(lambda name: isinstance(name, str)), places.name,
+                          places.housenumber.astype(str) + ' ' + places.street.astype(str)).astype(object)
+        named = np.flatnonzero(places.name.map(lambda name: isinstance(name, str)).values)
+        names = pd.DataFrame({'key': [self._key(name) for name in places.name.values[named]],
+                              'lon': places.lon.values[named], 'lat': places.lat.values[named],
+                              'label': labels[named]}, columns=['key', 'lon', 'lat', 'label'])
+        located = np.flatnonzero((places.housenumber.notna() & places.street.notna()).values)
+        numbers = [''.join(normalize_tokens(number)) for number in places.housenumber.values[located]]
+        streets = [self._key(street) for street in places.street.values[located]]
+        addresses = pd.DataFrame({'key': [n + ' ' + s if n and s else '' for n, s in zip(numbers, streets)],
+                                  'lon': places.lon.values[located], 'lat': places.lat.values[located],
+                                  'label': labels[located]}, columns=['key', 'lon', 'lat', 'label'])
+        return tuple(table.loc[table.key != ''].drop_duplicates('key') for table in (names, addresses))
+
+    def _index(self, names, addresses, street_index=None):
+        self.names_table = names.reset_index(drop=True)
+        self.addresses_table = addresses.reset_index(drop=True)
+        n = self.names_table.shape[0]
+        self.lon = np.concatenate([self.names_table.lon.values, self.addresses_table.lon.values]).astype('float64')
+        self.lat = np.concatenate([self.names_table.lat.values, self.addresses_table.lat.values]).astype('float64')
+        self.labels = np.concatenate([self.names_table.label.values, self.addresses_table.label.values]).astype(object)
+        self.names = dict(zip(self.names_table.key, range(n)))
+        self.name_index = TrigramIndex(self.names_table.key)
+        # "number street" -> first place at that address
+        self.addresses = dict(zip(self.addresses_table.key, range(n, n + self.addresses_table.shape[0])))
+        if street_index is None:
+            street_index = TrigramIndex(sorted(self.addresses_table.key.str.split(' ', n=1).str[1].unique())
+                                        if self.addresses else [])
+        self.street_index = street_index
+
+    def _tokens(self, text):
+        return [t for t in normalize_tokens(text) if t not in self.stop_tokens]
+
+    def _key(self, text):
+        return ' '.join(self._tokens(text))
+
+    def save(self, path):
+        """ Writes the names, addresses and street index to the directory path, see load. """
+        os.makedirs(path, exist_ok=True)
+        self.names_table.to_parquet(os.path.join(path, "names.parquet"), index=False)
+        self.addresses_table.to_parquet(os.path.join(path, "addresses.parquet"), index=False)
+        self.street_index.save(os.path.join(path, "streets.npz"))
+
+    @classmethod
+    def load(cls, path, country, city=None, min_score=0.6, name_score=0.8):
+        """ Geocoder saved to the directory path, for the same country and city. """
+        geocoder = cls.__new__(cls)
+        geocoder._configure(country, city, min_score, name_score)
+        geocoder._index(pd.read_parquet(os.path.join(path, "names.parquet")),
+                        pd.read_parquet(os.path.join(path, "addresses.parquet")),
+                        TrigramIndex.load(os.path.join(path, "streets.npz")))
+        return geocoder
+
+    @classmethod
+    def from_extract(cls, path, country, city=None, **kwargs):
+        """
+        Geocoder over an address extract file (see read_address_extract), read from its index <path>.<city>.index when
+        that was built from the extract as it is now, else built and written there for the next time.
+        """
+        index_path = "{}.{}.index".format(path, city or 'all')
+        meta_path = os.path.join(index_path, "meta.json")
+        source = os.stat(path)
+        meta = {'size': source.st_size, 'mtime': source.st_mtime, 'country': country, 'city': city}
+        try:
+            with open(meta_path) as f:
+                if json.load(f) == meta:
+                    return cls.load(index_path, country, city, **kwargs)
+        except (OSError, ValueError):
+            pass
+        geocoder = cls(read_address_extract(path), country, city, **kwargs)
+        try:
+            # meta.json last, so a half written index is never read
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            geocoder.save(index_path)
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        except OSError as e:
+            print("Error while writing the index of {}.\n{}".format(path, e))
+        return geocoder
+
+    @classmethod
+    def from_layer(cls, bldg_data, country, city=None, extract=None, **kwargs):
+        """
+        Geocoder over the named buildings of a layer, each located on its footprint, plus the address extract when
+        given: a path, indexed once (see from_extract), or its DataFrame.
+        """
+        named = bldg_data.loc[bldg_data['name'].notna()] if 'name' in bldg_data else bldg_data.iloc[:0]
+        # a point inside every footprint, so the match downstream intersects the named building
+        points = shapely.point_on_surface(np.asarray(named.geometry))
+        places = pd.DataFrame({'name': named['name'].values, 'housenumber': None, 'street': None,
+                               'lon': shapely.get_x(points), 'lat': shapely.get_y(points)})
+        base = None
+        if isinstance(extract, str):
+            base = cls.from_extract(extract, country, city, **kwargs)
+        elif extract is not None:
+            places = pd.concat([places, extract], ignore_index=True)
+        return cls(places, country, city, base=base, **kwargs)
+
+    @staticmethod
+    def default_extract(country, extract_dir=DEFAULT_EXTRACT_DIR):
+        """ Path of the address extract of a country, <extract_dir>/<country>.parquet (or .csv), None when missing. """
+        for ext in ('.parquet', '.csv'):
+            path = os.path.join(extract_dir, country + ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _result(self, i, query, match, score):
+        lon, lat = float(self.lon[i]), float(self.lat[i])
+        return {'lat': str(lat), 'lon': str(lon),
+                'display_name': self.labels[i] + (', ' + self.city.capitalize() if self.city else ''),
+                'address': {'country': self.country.upper()},
+                'geojson': {'type': 'Point', 'coordinates': [lon, lat]},
+                'source': 'local', 'match': match, 'score': score, 'query': query}
+
+    def lookup(self, query):
+        """
+        Geocodes an address or a building name.
+
+        Returns
+        -------
+        A Nominatim-like result (lat, lon, display_name, address, geojson), plus the match ('address', 'name',
+        'fuzzy_address' or 'fuzzy_name') and its score, or None when nothing is close enough
+        """
+        tokens = self._tokens(query)
+        numbers = [t for t in tokens if _housenumber.match(t)]
+        result = None
+        if numbers:
+            number = numbers[0]
+            # postcodes and other numbers left out of the street
+            street = ' '.join(t for t in tokens if not _has_digit.search(t))
+            if number + ' ' + street in self.addresses:
+                result = self._result(self.addresses[number + ' ' + street], query, 'address', 1.)
+            else:
+                for pos, score in self.street_index.search(street, self.min_score):
+                    key = number + ' ' + self.street_index.strings[pos]
+                    if key in self.addresses:
+                        result = self._result(self.addresses[key], query, 'fuzzy_address', score)
+                        break
+        elif tokens:
+            name = ' '.join(tokens)
+            if name in self.names:
+                result = self._result(self.names[name], query, 'name', 1.)
+            else:
+                found = self.name_index.search(name, self.name_score, limit=1)
+                if found:
+                    result = self._result(self.names[self.name_index.strings[found[0][0]]], query, 'fuzzy_name',
+                                          found[0][1])
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def stats(self):
+        return {"names": len(self.names), "addresses": len(self.addresses), "hits": self.hits, "misses": self.misses}
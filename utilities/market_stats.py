@@ -0,0 +1,278 @@
+# Market-wide lease aggregates.
+# Every aggregate exists twice: as one GROUP BY / window query run by Postgres, so only the aggregated rows travel to the
+# client, and as the same computation in pandas over a local dataset (the raw leases and buildings of the market, see
+# Market.get_market_leases). Both give the same columns, in the same order, with the same semantics:
+#   - a lease is current at date D when commencement_date <= D < expiration_date, as in the current leases queries
+#   - percentiles are continuous (linear interpolation), i.e. percentile_cont in Postgres and quantile in pandas
+#   - NULL rents and sizes are ignored by the aggregates, and leases with a NULL group value form their own group
+#   - groups are ordered by their values, NULL last
+# The queries run through queries.read (timed, served by the result cache), registered once per variant (groups,
+# percentiles) under a name spelling it out.
+
+import datetime as dt
+from dateutil.relativedelta import relativedelta
+import pandas as pd, numpy as np
+from . import queries
+
+# groups the aggregates can be computed by: output column and the expression giving it in the leases query
+group_exprs = {'building': ('ry_id', 'mt.ry_id'),
+               'submarket': ('submarket', 'lea.submarket'),
+               'space_type': ('space_type', 'lea.space_type')}
+
+# raw columns of the local dataset
+lease_cols = ['ry_id', 'current_rent', 'transaction_size', 'commencement_date', 'expiration_date', 'submarket',
+              'space_type']
+bldg_cols = ['reonomy_id', 'rsf']
+
+market_leases_from = "FROM leases_ck AS lea JOIN ck_to_ry AS mt ON mt.ck_id = lea.property_id \
+                      WHERE mt.ry_id = ANY(:ry_ids)"
+current_filter = "lea.commencement_date <= :day AND lea.expiration_date > :day"
+
+
+def _groups(group_by):
+    """ List of group names out of None, one name or a list of them. """
+    groups = [] if group_by is None else [group_by] if isinstance(group_by, str) else list(group_by)
+    unknown = set(groups) - set(group_exprs)
+    assert not unknown, "unknown groups: {}. Try any of {}".format(unknown, list(group_exprs))
+    return groups
+
+
+def _day(date):
+    return pd.Timestamp(dt.date.today() if date is None else date).date()
+
+
+def _percentile_name(q):
+    return "p{:g}".format(q * 100)
+
+
+def _params(ry_ids, day, **params):
+    return dict(params, ry_ids=[str(b) for b in ry_ids], day=day)
+
+
+def _read(engine, name, sql, params, param_types):
+    """ Runs sql through queries.read, registered under name on first use. """
+    if name not in queries.queries:
+        queries.register(name, sql, param_types)
+    return queries.read(engine, name, params)
+
+
+def _variant(prefix, groups, *parts):
+    # query name of a variant, a valid identifier
+    return '_'.join([prefix] + (groups or ['all']) + [str(p).replace('.', 'd') for p in parts])
+
+
+def _current(leases, day):
+    day = pd.Timestamp(day)
+    return leases.loc[(pd.to_datetime(leases.commencement_date) <= day) & (pd.to_datetime(leases.expiration_date) > day)]
+
+
+def _grouped(frame, cols):
+    # plain object keys, so categorical columns don't add unobserved groups
+    return frame.astype(dict((c, object) for c in cols)).groupby(cols, dropna=False, sort=True)
+
+
+def rent_stats_query(group_by='building', percentiles=(0.25, 0.5, 0.75)):
+    """ SQL of rent_stats_sql, with :ry_ids and :day parameters. """
+    groups = _groups(group_by)
+    select_list = ["{} AS {}".format(group_exprs[g][1], group_exprs[g][0]) for g in groups]
+    select_list += ["COUNT(*) AS leases",
+                    "SUM(lea.transaction_size) AS leased_sf",
+                    "AVG(lea.current_rent) AS mean_rent",
+                    "percentile_cont(0.5) WITHIN GROUP (ORDER BY lea.current_rent) AS median_rent"]
+    select_list += ['percentile_cont({!r}) WITHIN GROUP (ORDER BY lea.current_rent) AS "{}"'.format(float(q), _percentile_name(q))
+                    for q in percentiles]
+    query = "SELECT {} {} AND {}".format(', '.join(select_list), market_leases_from, current_filter)
+    if groups:
+        query += " GROUP BY {0} ORDER BY {0}".format(', '.join(group_exprs[g][1] for g in groups))
+    return query
+
+
+def rent_stats_sql(engine, ry_ids, group_by='building', percentiles=(0.25, 0.5, 0.75), date=None):
+    """
+    Rent aggregates of the leases current at date, computed by Postgres.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy Engine
+        Connection to the database.
+    ry_ids : list
+        Reonomy ids of the buildings of the market.
+    group_by : str or list, optional
+        Any of 'building', 'submarket' and 'space_type', or None for one row over the whole market.
+    percentiles : tuple, optional
+        Rent percentiles to compute, as fractions.
+    date : date, optional
+        Date the leases are current at. Defaults to today.
+
+    Returns
+    -------
+    A Pandas DataFrame with the group columns, the number of leases, the leased sf, the mean and median rent and a
+    p<percentile> column per percentile
+    """
+    name = _variant('market_rent_stats', _groups(group_by), *[_percentile_name(q) for q in percentiles])
+    return _read(engine, name, rent_stats_query(group_by, percentiles), _params(ry_ids, _day(date)),
+                 [('ry_ids', 'text[]'), ('day', 'date')])
+
+
+def rent_stats_local(leases, group_by='building', percentiles=(0.25, 0.5, 0.75), date=None):
+    """ Same as rent_stats_sql, computed in pandas over the raw leases of the market (lease_cols columns). """
+    groups = [group_exprs[g][0] for g in _groups(group_by)]
+    current = _current(leases, _day(date))
+    rents = current.current_rent.astype('float64')
+    sizes = current.transaction_size.astype('float64')
+    if not groups:
+        stats = {"leases": [current.shape[0]],
+                 "leased_sf": [sizes.sum(min_count=1)],
+                 "mean_rent": [rents.mean()],
+                 "median_rent": [rents.quantile(0.5)]}
+        stats.update({_percentile_name(q): [rents.quantile(q)] for q in percentiles})
+        return pd.DataFrame(stats)
+    frame = current.loc[:, groups].assign(current_rent=rents, transaction_size=sizes)
+    by_group = _grouped(frame, groups)
+    stats = pd.DataFrame({"leases": by_group.size(),
+                          "leased_sf": by_group.transaction_size.sum(min_count=1),
+                          "mean_rent": by_group.current_rent.mean(),
+                          "median_rent": by_group.current_rent.quantile(0.5)})
+    for q in percentiles:
+        stats[_percentile_name(q)] = by_group.current_rent.quantile(q)
+    return stats.reset_index()
+
+
+def occupancy_query(by_building=True):
+    """ SQL of occupancy_sql, with :ry_ids and :day parameters. """
+    per_bldg = "WITH bldgs AS (SELECT reonomy_id, rsf FROM properties_ry WHERE reonomy_id = ANY(:ry_ids)), \
+                     leased AS (SELECT mt.ry_id, COUNT(*) AS leases, SUM(lea.transaction_size) AS leased_sf \
+                                {} AND {} GROUP BY mt.ry_id), \
+                     occ AS (SELECT b.reonomy_id AS ry_id, b.rsf, COALESCE(l.leases, 0) AS leases, \
+                                    COALESCE(l.leased_sf, 0) AS leased_sf \
+                             FROM bldgs AS b LEFT JOIN leased AS l ON l.ry_id = b.reonomy_id) "\
+                .format(market_leases_from, current_filter)
+    if by_building:
+        query = per_bldg + "SELECT ry_id, rsf, leases, leased_sf, leased_sf / NULLIF(rsf, 0) AS occupancy, \
+                                   leased_sf / NULLIF(SUM(leased_sf) OVER (), 0) AS share_of_leased_sf \
+                            FROM occ ORDER BY ry_id"
+    else:
+        query = per_bldg + "SELECT COUNT(*) AS bldgs, SUM(rsf) AS rsf, SUM(leases) AS leases, \
+                                   SUM(leased_sf) AS leased_sf, SUM(leased_sf) / NULLIF(SUM(rsf), 0) AS occupancy \
+                            FROM occ"
+    return query
+
+
+def occupancy_sql(engine, ry_ids, by_building=True, date=None):
+    """
+    Occupancy of the buildings of the market at date, computed by Postgres: the sf of the leases current at date over
+    the building rsf.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy Engine
+        Connection to the database.
+    ry_ids : list
+        Reonomy ids of the buildings of the market.
+    by_building : bool, optional
+        One row per building, with its share of the leased sf of the market, or a single row for the whole market.
+    date : date, optional
+        Date the leases are current at. Defaults to today.
+
+    Returns
+    -------
+    A Pandas DataFrame with the rsf, the number of current leases, the leased sf and the occupancy
+    """
+    return _read(engine, 'market_occupancy' if by_building else 'market_occupancy_all', occupancy_query(by_building),
+                 _params(ry_ids, _day(date)), [('ry_ids', 'text[]'), ('day', 'date')])
+
+
+def occupancy_local(leases, bldgs, by_building=True, date=None):
+    """ Same as occupancy_sql, computed in pandas over the raw leases and buildings of the market (lease_cols and
+    bldg_cols columns). """
+    current = _current(leases, _day(date))
+    leased = current.assign(ry_id=current.ry_id.astype(str), transaction_size=current.transaction_size.astype('float64'))\
+                    .groupby('ry_id')\
+                    .agg(leases=('transaction_size', 'size'), leased_sf=('transaction_size', 'sum'))
+    occ = pd.DataFrame({"ry_id": bldgs.reonomy_id.astype(str).values, "rsf": bldgs.rsf.astype('float64').values})
+    occ = occ.join(leased, on='ry_id')
+    occ["leases"] = occ.leases.fillna(0).astype('int64')
+    occ["leased_sf"] = occ.leased_sf.fillna(0.)
+    if by_building:
+        occ = occ.sort_values('ry_id', kind='mergesort').reset_index(drop=True)
+        occ["occupancy"] = occ.leased_sf / occ.rsf.replace(0, np.nan)
+        total = occ.leased_sf.sum()
+        occ["share_of_leased_sf"] = occ.leased_sf / total if total else np.nan
+        return occ
+    rsf = occ.rsf.sum(min_count=1)
+    leased_sf = occ.leased_sf.sum(min_count=1)
+    return pd.DataFrame({"bldgs": [occ.shape[0]],
+                         "rsf": [rsf],
+                         "leases": [occ.leases.sum(min_count=1)],
+                         "leased_sf": [leased_sf],
+                         "occupancy": [leased_sf / rsf if rsf else np.nan]})
+
+
+def expiring_sf_query(group_by=None):
+    """ SQL of expiring_sf_sql, with :ry_ids, :day and :horizon parameters. """
+    groups = _groups(group_by)
+    group_list = [group_exprs[g][1] for g in groups]
+    select_list = ["{} AS {}".format(group_exprs[g][1], group_exprs[g][0]) for g in groups]
+    select_list += ["date_trunc('quarter', lea.expiration_date)::date AS quarter",
+                    "COUNT(*) AS leases",
+                    "SUM(lea.transaction_size) AS expiring_sf",
+                    "SUM(SUM(lea.transaction_size)) OVER ({}ORDER BY date_trunc('quarter', lea.expiration_date)) AS cumulative_sf"\
+                        .format("PARTITION BY {} ".format(', '.join(group_list)) if groups else "")]
+    query = "SELECT {} {} AND {} AND lea.expiration_date <= :horizon GROUP BY {} ORDER BY {}"\
+                .format(', '.join(select_list), market_leases_from, current_filter,
+                        ', '.join(group_list + ["date_trunc('quarter', lea.expiration_date)"]),
+                        ', '.join(group_list + ["quarter"]))
+    return query
+
+
+def _horizon(day, months):
+    return day + relativedelta(months=months)
+
+
+def expiring_sf_sql(engine, ry_ids, group_by=None, months=24, date=None):
+    """
+    Sf of the leases current at date that expire within the following months, by quarter of expiration, computed by
+    Postgres.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy Engine
+        Connection to the database.
+    ry_ids : list
+        Reonomy ids of the buildings of the market.
+    group_by : str or list, optional
+        Any of 'building', 'submarket' and 'space_type', on top of the quarter.
+    months : int, optional
+        Horizon, in months after date.
+    date : date, optional
+        Date the leases are current at. Defaults to today.
+
+    Returns
+    -------
+    A Pandas DataFrame with the group columns, the first day of the quarter, the number of leases and the sf expiring in
+    the quarter, and the sf expiring up to the end of the quarter
+    """
+    day = _day(date)
+    return _read(engine, _variant('market_expiring_sf', _groups(group_by)), expiring_sf_query(group_by),
+                 _params(ry_ids, day, horizon=_horizon(day, months)),
+                 [('ry_ids', 'text[]'), ('day', 'date'), ('horizon', 'date')])
+
+
+def expiring_sf_local(leases, group_by=None, months=24, date=None):
+    """ Same as expiring_sf_sql, computed in pandas over the raw leases of the market (lease_cols columns). """
+    groups = [group_exprs[g][0] for g in _groups(group_by)]
+    day = _day(date)
+    current = _current(leases, day)
+    ends = pd.to_datetime(current.expiration_date)
+    expiring = current.loc[ends <= pd.Timestamp(_horizon(day, months))]
+    frame = expiring.loc[:, groups].assign(
+        quarter=pd.to_datetime(expiring.expiration_date).dt.to_period('Q').dt.start_time.dt.date,
+        transaction_size=expiring.transaction_size.astype('float64'))
+    by_quarter = _grouped(frame, groups + ['quarter'])
+    result = pd.DataFrame({"leases": by_quarter.size(),
+                           "expiring_sf": by_quarter.transaction_size.sum(min_count=1)}).reset_index()
+    # running sum over the quarters of every group, NULL until the first quarter with a known sf (as SUM OVER does)
+    running = _grouped(result.assign(sf=result.expiring_sf.fillna(0.), known=result.expiring_sf.notna()), groups) \
+                if groups else result.assign(sf=result.expiring_sf.fillna(0.), known=result.expiring_sf.notna())
+    result["cumulative_sf"] = running.sf.cumsum().where(running.known.cumsum() > 0)
+    return result
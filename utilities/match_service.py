@@ -0,0 +1,185 @@
+# Address-to-building lookup service.
+# A long-running http server (standard library only) wrapping BldgFinder: the cities are loaded once at start, with their
+# spatial indexes, and shared by every request, so an analyst gets a match without paying for a city load or a map.
+#   GET  /match?address=...&city=...     -> one match
+#   POST /match_batch                    -> body {"addresses": [...], "city": ...}, the matches in the same order
+#   GET  /stats                          -> requests and latency percentiles (p50, p99, in ms) by endpoint
+#   GET  /health                         -> cities loaded
+# A match is {"address", "bldg_id", "match_type", "distance", "lat", "lon", "attributes"}, as in BldgFinder.find_many.
+# city can be left out when a single city is loaded. Requests are served by one thread each (ThreadingHTTPServer); the
+# finders only read their indexes, so they are shared as is. Geocoding goes through each finder (Nominatim, cached, or
+# the geocoder the service is given, e.g. a stub in tests).
+#     python -m utilities.match_service london berlin --port 8080
+
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from .BldgFinder import BldgFinder
+
+
+class BadRequest(ValueError):
+    """ Bad request: missing address, unknown city. """
+
+
+class MatchService:
+    """ Finders of the loaded cities, the matching they answer, and the latencies of the requests served. """
+
+    def __init__(self, finders, max_workers=4, window=10000):
+        """
+        Parameters
+        ----------
+        finders : dict
+            City name -> loaded BldgFinder.
+        max_workers : int, optional
+            Geocoding requests in flight at once, per batch.
+        window : int, optional
+            Number of latest requests, by endpoint, the latency percentiles are computed over.
+        """
+        self.finders = dict((city.lower(), finder) for city, finder in finders.items())
+        self.max_workers = max_workers
+        self.latencies = {}
+        self.window = window
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, cities, geocoder=None, **kwargs):
+        """ Service over freshly loaded finders of cities, geocoding with geocoder when given. """
+        return cls(dict((city, BldgFinder(city, geocoder=geocoder)) for city in cities), **kwargs)
+
+    def finder(self, city=None):
+        if city is None:
+            if len(self.finders) != 1:
+                raise BadRequest("city is required, one of: {}".format(', '.join(sorted(self.finders))))
+            return next(iter(self.finders.values()))
+        try:
+            return self.finders[city.lower()]
+        except KeyError:
+            raise BadRequest("City {} not loaded, one of: {}".format(city, ', '.join(sorted(self.finders))))
+
+    def match_batch(self, addresses, city=None):
+        """ Matches of addresses, as a list of dicts. """
+        if not isinstance(addresses, list) or not all(isinstance(a, str) for a in addresses):
+            raise BadRequest("addresses has to be a list of strings")
+        if not addresses:
+            return []
+        matches = self.finder(city).find_many(addresses, max_workers=self.max_workers, attributes=True)
+        # missing values as null
+        return json.loads(matches.to_json(orient='records'))
+
+    def match(self, address, city=None):
+        """ Match of a single address, as a dict. """
+        if not address:
+            raise BadRequest("address is required")
+        return self.match_batch([address], city)[0]
+
+    def record(self, endpoint, seconds):
+        with self._lock:
+            self.latencies.setdefault(endpoint, deque(maxlen=self.window)).append(seconds)
+
+    def stats(self):
+        """ Requests served and p50 / p99 / max latency, in milliseconds, by endpoint. """
+        with self._lock:
+            latencies = dict((endpoint, np.array(values)) for endpoint, values in self.latencies.items())
+        return dict((endpoint, {"requests": int(values.shape[0]),
+                                "p50_ms": float(np.percentile(values, 50) * 1000),
+                                "p99_ms": float(np.percentile(values, 99) * 1000),
+                                "max_ms": float(values.max() * 1000)})
+                    for endpoint, values in latencies.items())
+
+
+class MatchHandler(BaseHTTPRequestHandler):
+    """ Http endpoints of the MatchService of the server. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _serve(self, endpoint, answer):
+        t0 = time.perf_counter()
+        try:
+            status, body = 200, answer()
+        except BadRequest as e:
+            status, body = 400, {"error": str(e)}
+        except Exception as e:
+            print("Error while serving {}.\n{}".format(endpoint, e))
+            status, body = 500, {"error": str(e)}
+        # recorded before answering, so the stats a client asks for next count its request
+        if endpoint in ('/match', '/match_batch'):
+            self.server.service.record(endpoint, time.perf_counter() - t0)
+        self._send(status, body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        service = self.server.service
+        if url.path == '/match':
+            self._serve(url.path, lambda: service.match(query.get('address'), query.get('city')))
+        elif url.path == '/stats':
+            self._serve(url.path, service.stats)
+        elif url.path == '/health':
+            self._serve(url.path, lambda: {"cities": sorted(service.finders)})
+        else:
+            self._send(404, {"error": "Not found: {}".format(url.path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/match_batch':
+            self._send(404, {"error": "Not found: {}".format(url.path)})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+
+        def answer():
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                raise BadRequest("body has to be json")
+            if isinstance(body, list):
+                body = {"addresses": body}
+            if not isinstance(body, dict):
+                raise BadRequest("body has to be a json object or list")
+            return self.server.service.match_batch(body.get('addresses'), body.get('city'))
+        self._serve(url.path, answer)
+
+    def log_message(self, format, *args):
+        # one line per request would dominate the output of a busy service; errors are printed by _serve
+        pass
+
+
+def make_server(service, host='127.0.0.1', port=8080):
+    """ Http server answering with service, not started yet (serve_forever, or in a thread). port 0 picks a free one. """
+    server = ThreadingHTTPServer((host, port), MatchHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Address-to-building lookup service.")
+    parser.add_argument('cities', nargs='+', help="cities to load, e.g. london berlin")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-workers', type=int, default=4, help="geocoding requests in flight per batch")
+    args = parser.parse_args()
+    server = make_server(MatchService.load(args.cities, max_workers=args.max_workers), args.host, args.port)
+    print("Serving {} on http://{}:{}".format(', '.join(args.cities), *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
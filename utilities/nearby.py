@@ -0,0 +1,178 @@
+# Buildings around a location, nearest first.
+# Online, the search runs in PostGIS: candidates are restricted by ST_DWithin on geography (so the radius is in metres
+# rather than degrees of a 4326 geometry) or by an arbitrary area polygon, ordered by the <-> KNN operator and cut with
+# LIMIT, so only the requested buildings travel to the client. The KNN ordering is index-assisted with a geography index:
+#     CREATE INDEX ON properties_ry USING gist ((location::geography));
+# Offline, LocationIndex holds the properties_ry locations of a city and category in memory, behind an STRtree, and
+# answers the same searches; default_location_index keeps one per city and category.
+# Distances are great-circle distances on the sphere, in metres, in both modes.
+
+import os
+import threading
+import numpy as np, pandas as pd, geopandas as gpd
+from shapely.geometry import box, shape
+from sqlalchemy import text
+from .spatial_index import BldgIndex
+from . import queries
+
+DEFAULT_PATH = "./data/properties_ry_locations.parquet"
+
+METERS_PER_MILE = 1609.344
+# mean radius of the sphere PostGIS geography uses when use_spheroid is false
+EARTH_RADIUS = 6371008.7714
+
+location_cols = ['reonomy_id', 'address_city', 'category', 'location']
+
+
+def as_area(area):
+    """ Shapely geometry out of a shapely geometry or a GeoJSON-like dict (a geometry or a feature). """
+    if area is None or hasattr(area, 'geom_type'):
+        return area
+    return shape(area.get('geometry', area))
+
+
+def great_circle_distance(lon, lat, lon0, lat0):
+    """ Distance in metres from (lon0, lat0) to every (lon, lat), on the sphere. """
+    lon, lat, lon0, lat0 = [np.radians(np.asarray(v, dtype='float64')) for v in (lon, lat, lon0, lat0)]
+    a = np.sin((lat - lat0)/2)**2 + np.cos(lat0) * np.cos(lat) * np.sin((lon - lon0)/2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0., 1.)))
+
+
+def surrounding_query(area=False, limit=False):
+    """ Query of surrounding_sql, with :lon, :lat, :exclude, :city, :category and :radius or :area (WKT) and :limit
+    parameters. Returns its name in the queries registry. """
+    query = "SELECT reonomy_id AS id, location, \
+                    ST_Distance(location::geography, ST_SetSRID(ST_Point(:lon, :lat), 4326)::geography, false) AS distance \
+             FROM properties_ry AS ry \
+             WHERE {} \
+             AND address_city = :city \
+             AND reonomy_id != :exclude \
+             AND category = :category \
+             ORDER BY location::geography <-> ST_SetSRID(ST_Point(:lon, :lat), 4326)::geography"\
+        .format("ST_Intersects(ry.location, ST_GeomFromText(:area, 4326))" if area else
+                "ST_DWithin(ry.location::geography, ST_SetSRID(ST_Point(:lon, :lat), 4326)::geography, :radius, false)")
+    param_types = [('lon', 'float8'), ('lat', 'float8'), ('exclude', 'text'), ('city', 'text'), ('category', 'text'),
+                   ('area', 'text') if area else ('radius', 'float8')]
+    if limit:
+        query += " LIMIT :limit"
+        param_types.append(('limit', 'int'))
+    return queries.register("surrounding_{}{}".format('area' if area else 'radius', '_knn' if limit else ''), query,
+                            param_types)
+
+
+def surrounding_sql(engine, point, radius=None, area=None, limit=None, exclude='', city='MN', category='Office'):
+    """
+    Buildings around point, nearest first, searched by PostGIS.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy Engine
+        Connection to the database.
+    point : shapely Point
+        Location searched around, in lon/lat.
+    radius : float, optional
+        Search radius, in metres. Ignored when area is given.
+    area : shapely geometry or dict, optional
+        Polygon (or GeoJSON geometry/feature) the buildings must lie in, e.g. a market or submarket.
+    limit : int, optional
+        Number of nearest buildings to return. All of them when None.
+    exclude : str, optional
+        reonomy_id left out of the results, e.g. the building searched around.
+    city, category : str, optional
+        Reonomy city and category of the buildings.
+
+    Returns
+    -------
+    A GeoDataFrame with the id, location and distance (in metres) of the buildings, ordered by distance
+    """
+    area = as_area(area)
+    params = {'lon': point.x, 'lat': point.y, 'exclude': str(exclude), 'city': city, 'category': category}
+    if area is not None:
+        params['area'] = area.wkt
+    else:
+        params['radius'] = radius
+    if limit:
+        params['limit'] = int(limit)
+    return queries.read(engine, surrounding_query(area is not None, bool(limit)), params, geom_col='location')
+
+
+class LocationIndex:
+    """ In-memory index over properties_ry locations, answering the searches of surrounding_sql offline. """
+
+    def __init__(self, locations):
+        """
+        Parameters
+        ----------
+        locations : GeoDataFrame
+            One point per building, with the location_cols columns.
+        """
+        self.locations = locations.reset_index(drop=True)
+        self.index = BldgIndex(self.locations.location.values)
+        self.lon = self.locations.location.x.values
+        self.lat = self.locations.location.y.values
+
+    @classmethod
+    def from_db(cls, engine, city='MN', category='Office'):
+        """ Index over the buildings of a Reonomy city and category, loaded with one query. """
+        locations_query = text("SELECT {} FROM properties_ry WHERE address_city = :city AND category = :category \
+                                AND location IS NOT NULL".format(', '.join(location_cols)))
+        return cls(gpd.GeoDataFrame.from_postgis(locations_query, con=engine, geom_col='location',
+                                                 params={'city': city, 'category': category}))
+
+    @classmethod
+    def read(cls, path=DEFAULT_PATH):
+        return cls(gpd.read_parquet(path))
+
+    def write(self, path=DEFAULT_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.locations.to_parquet(path)
+
+    def surrounding(self, point, radius=None, area=None, limit=None, exclude='', city='MN', category='Office'):
+        """ Same as surrounding_sql, from the index. """
+        area = as_area(area)
+        if area is not None:
+            candidates = self.index.query(area, predicate='intersects')
+        else:
+            # bounding box of the radius in degrees, then exact distances
+            dlat = np.degrees(radius / EARTH_RADIUS)
+            dlon = dlat / max(np.cos(np.radians(point.y)), 1e-12)
+            candidates = self.index.query(box(point.x - dlon, point.y - dlat, point.x + dlon, point.y + dlat),
+                                          predicate='intersects')
+        found = self.locations.iloc[candidates]
+        keep = (found.reonomy_id.astype(str).values != str(exclude)) & (found.address_city.values == city) & \
+               (found.category.values == category)
+        found = found.loc[keep]
+        distance = great_circle_distance(self.lon[candidates[keep]], self.lat[candidates[keep]], point.x, point.y)
+        if area is None:
+            found, distance = found.loc[distance <= radius], distance[distance <= radius]
+        order = np.argsort(distance, kind='mergesort')[:limit]
+        result = gpd.GeoDataFrame({'id': found.reonomy_id.values[order], 'location': found.location.values[order],
+                                   'distance': distance[order]}, geometry='location', crs=self.locations.crs)
+        return result
+
+
+def location_path(city='MN', category='Office'):
+    """ Where the locations of a Reonomy city and category are kept, next to DEFAULT_PATH. """
+    root, ext = os.path.splitext(DEFAULT_PATH)
+    return "{}_{}_{}{}".format(root, city, category, ext)
+
+
+# (city, category) -> LocationIndex
+_default_index = {}
+_default_lock = threading.Lock()
+
+
+def default_location_index(engine=None, city='MN', category='Office'):
+    """ Process-wide LocationIndex of a Reonomy city and category, read from location_path(city, category), or loaded
+    from the database (with engine) and written there on first use. """
+    with _default_lock:
+        key = (city, category)
+        if key not in _default_index:
+            path = location_path(city, category)
+            if os.path.exists(path):
+                _default_index[key] = LocationIndex.read(path)
+            else:
+                _default_index[key] = LocationIndex.from_db(engine, city, category)
+                _default_index[key].write(path)
+        return _default_index[key]
@@ -0,0 +1,92 @@
+# Popups of buildings on maps, many at a time.
+# A PopupTemplate is compiled once, from the column of the title and the (label, column) pairs of the lines below it,
+# then renders a whole frame of buildings column by column: every value is turned to text and html-escaped with
+# vectorized string operations, and missing values leave their line out. render() gives the popup html of every
+# building; table() gives just the escaped values under their labels, a compact attribute table that the map client lays
+# out itself (folium.GeoJsonPopup, see tile_export.add_buildings), without repeating the markup for every building.
+
+import html
+import numpy as np, pandas as pd
+
+# order matters: & first, so the entities of the others aren't escaped again
+_entities = [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ("'", '&#x27;')]
+
+
+def _escape_text(text):
+    for char, entity in _entities:
+        text = text.str.replace(char, entity, regex=False)
+    return text
+
+
+def escape(values):
+    """ Values of a Series as html-escaped text, NaN where missing. Building attributes repeat a lot (types, years,
+    floors), so only the distinct values are formatted and escaped. """
+    try:
+        codes, uniques = pd.factorize(values)
+    except TypeError:
+        # unhashable values, e.g. dicts of amenities
+        return _escape_text(values.astype(str)).where(~values.isna())
+    text = _escape_text(pd.Series(np.asarray(uniques, dtype=object)).astype(str)).to_numpy(dtype=object)
+    # missing values have code -1, i.e. the NaN appended last
+    return pd.Series(np.append(text, np.nan)[codes], index=values.index)
+
+
+class PopupTemplate:
+    """ Popup of a building: a title, then one 'label: value' line per field with a value, then the blank lines. """
+
+    def __init__(self, title, fields, bold=(), blanks=(), formatters=None):
+        """
+        Parameters
+        ----------
+        title : str
+            Column of the title.
+        fields : list
+            (label, column) pairs of the lines, in order.
+        bold : iterable, optional
+            Labels shown in bold.
+        blanks : iterable, optional
+            Labels of lines always shown without a value, after the fields (attributes not collected yet).
+        formatters : dict, optional
+            Column -> function turning its Series into the Series displayed, e.g. to truncate ids.
+        """
+        self.title = title
+        self.fields = list(fields)
+        self.formatters = formatters or {}
+        # the markup around the values, escaped and assembled once
+        self.prefixes = [(("<b>{}:</b> " if label in bold else "{}: ").format(html.escape(label)), column)
+                         for label, column in self.fields]
+        self.tail = ''.join("{}: <br>".format(html.escape(label)) for label in blanks)
+
+    def _escaped(self, frame, column):
+        values = frame[column]
+        if column in self.formatters:
+            values = self.formatters[column](values)
+        return escape(values)
+
+    def render(self, frame):
+        """
+        Popup html of every building of frame.
+
+        Parameters
+        ----------
+        frame : Pandas DataFrame
+            One row per building, with the title and field columns. Missing field columns are left out.
+
+        Returns
+        -------
+        A Pandas Series of html strings, aligned with frame
+        """
+        popups = "<h3> " + self._escaped(frame, self.title).fillna('') + " </h3>"
+        for prefix, column in self.prefixes:
+            if column in frame:
+                popups = popups + (prefix + self._escaped(frame, column) + "<br>").fillna('')
+        return popups + self.tail
+
+    def table(self, frame):
+        """ Escaped values of every building of frame under the field labels (the title under its column name), '' where
+        missing: the attribute table a map client formats. """
+        table = pd.DataFrame({self.title: self._escaped(frame, self.title)}, index=frame.index)
+        for label, column in self.fields:
+            if column in frame:
+                table[label] = self._escaped(frame, column)
+        return table.fillna('')
@@ -0,0 +1,105 @@
+# Portfolio-level revenue estimates.
+# Building.get_estimated_revenue and get_knotel_revenue_increase, computed for many buildings in one NumPy pass out of
+# their KPIs (see bldg_summary), instead of one Building, its queries and scalar arithmetic per candidate. The
+# occupied_from_unknown / vacant_from_unknown assumptions can be arrays of scenarios: they are broadcast as trailing
+# dimensions, so a sweep over S values gives (buildings, S) results in the same pass.
+
+import pandas as pd, numpy as np
+
+
+def _bldg_array(values, n_scenario_dims):
+    # building values along the first axis, broadcastable against the scenario dimensions
+    values = np.asarray(values, dtype='float64')
+    return values.reshape(values.shape + (1,) * n_scenario_dims)
+
+
+def estimated_revenue(rsf, perc_known, current_leases, known_rent_revenue, unknown_rent_sf, rent,
+                      occupied_from_unknown=0.75):
+    """
+    Vectorized Building.get_estimated_revenue.
+
+    Parameters
+    ----------
+    rsf, perc_known, current_leases, known_rent_revenue, unknown_rent_sf : array-like
+        KPIs of the buildings, one value per building (see bldg_summary.summary_cols). NaN perc_known counts as 0.
+    rent : float or array-like
+        Rent the unknown sqft and the leases without a known rent are valued at, one for all or one per building.
+    occupied_from_unknown : float or array-like, optional
+        Fraction of the unknown sqft assumed leased, or an array of scenarios.
+
+    Returns
+    -------
+    A NumPy array of shape (buildings,) + shape of occupied_from_unknown
+    """
+    occupied = np.asarray(occupied_from_unknown, dtype='float64')
+    dims = occupied.ndim
+    rsf, current_leases, known_rent_revenue, unknown_rent_sf = [_bldg_array(v, dims) for v in
+                                                                 (rsf, current_leases, known_rent_revenue, unknown_rent_sf)]
+    perc_known = np.nan_to_num(_bldg_array(perc_known, dims), nan=0.)
+    rent = _bldg_array(np.broadcast_to(rent, rsf.shape[:1]), dims)
+    # revenue from known leases, leases without a known rent valued at rent
+    rkl = known_rent_revenue + unknown_rent_sf * rent
+    # revenue estimated from the unknown square footage, none when everything is known
+    rusf = np.where(perc_known >= 100, 0., rsf * (1 - perc_known/100) * occupied * rent)
+    return np.where(current_leases > 0, rkl + rusf, 0.)
+
+
+def knotel_revenue_increase(rsf, perc_known, perc_vacant, rent, vacant_from_unknown=0.25):
+    """
+    Vectorized Building.get_knotel_revenue_increase.
+
+    Parameters
+    ----------
+    rsf, perc_known, perc_vacant : array-like
+        KPIs of the buildings, one value per building. NaN percentages count as 0.
+    rent : float or array-like
+        Rent the vacant space gets filled at, one for all or one per building.
+    vacant_from_unknown : float or array-like, optional
+        Fraction of the unknown sqft assumed vacant, or an array of scenarios.
+
+    Returns
+    -------
+    A NumPy array of shape (buildings,) + shape of vacant_from_unknown
+    """
+    vacant = np.asarray(vacant_from_unknown, dtype='float64')
+    dims = vacant.ndim
+    rsf = _bldg_array(rsf, dims)
+    perc_known = np.nan_to_num(_bldg_array(perc_known, dims), nan=0.)
+    perc_vacant = np.nan_to_num(_bldg_array(perc_vacant, dims), nan=0.)
+    rent = _bldg_array(np.broadcast_to(rent, rsf.shape[:1]), dims)
+    # total estimated vacant space, from availabilities (F42), plus the unknown one when not everything is known
+    tevs = rsf * (perc_vacant/100 + np.where(perc_known >= 100, 0., (1 - perc_known/100) * vacant))
+    return np.where(perc_known == 0, 0., tevs * rent)
+
+
+def portfolio_revenue(summaries, rent, occupied_from_unknown=0.75, vacant_from_unknown=0.25):
+    """
+    Both estimates for every building of a KPI frame.
+
+    Parameters
+    ----------
+    summaries : Pandas DataFrame
+        KPIs indexed by ry_id, as given by bldg_summary (BldgSummary.frame, summary_sql, Market.get_bldg_summaries).
+    rent : float or Pandas Series
+        Rent to value space at, one for all or a series indexed by ry_id (e.g. the market rent of every building).
+    occupied_from_unknown, vacant_from_unknown : float or list, optional
+        Assumptions, or lists of scenarios.
+
+    Returns
+    -------
+    A Pandas DataFrame indexed by ry_id with estimated_revenue and knotel_revenue_increase columns. With lists of
+    scenarios, the columns are (estimate, assumption value) pairs
+    """
+    if isinstance(rent, pd.Series):
+        rent = rent.reindex(summaries.index).values
+    estimated = estimated_revenue(summaries.rsf.values, summaries.perc_known.values, summaries.current_leases.values,
+                                  summaries.known_rent_revenue.values, summaries.unknown_rent_sf.values, rent,
+                                  occupied_from_unknown)
+    increase = knotel_revenue_increase(summaries.rsf.values, summaries.perc_known.values, summaries.perc_vacant.values,
+                                       rent, vacant_from_unknown)
+    if estimated.ndim == 1 and increase.ndim == 1:
+        return pd.DataFrame({"estimated_revenue": estimated, "knotel_revenue_increase": increase}, index=summaries.index)
+    columns = [("estimated_revenue", v) for v in np.atleast_1d(occupied_from_unknown)] + \
+              [("knotel_revenue_increase", v) for v in np.atleast_1d(vacant_from_unknown)]
+    return pd.DataFrame(np.hstack([estimated.reshape(estimated.shape[0], -1), increase.reshape(increase.shape[0], -1)]),
+                        index=summaries.index, columns=pd.MultiIndex.from_tuples(columns))
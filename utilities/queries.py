@@ -0,0 +1,186 @@
+# Named, parameterized queries.
+# Building and Market register their queries here once, with :name bound parameters and explicit column lists, and run
+# them through read() instead of formatting values into SQL strings. Lists are bound as arrays (= ANY(:ry_ids)), which
+# also works for a single id, unlike IN {} with a python tuple.
+# Queries registered with parameter types are the hot lookups: on Postgres they are PREPAREd once per pooled connection
+# and run with EXECUTE, so the server parses and plans them once per connection instead of on every call. The
+# connections they are prepared on are tracked in the pool's per-connection info, which is cleared when a connection is
+# replaced. (Server-side prepared statements don't survive a transaction-pooling pgbouncer; run without them there by
+# setting use_prepared to False.)
+# Every read is timed: the last timings are kept in timings (see timing_summary) and passed to the callables of
+# timing_hooks, and explain() gives the plan of any registered query.
+# Reads given a dtypes schema decode their result into compact dtypes (see decoding), optionally streaming it in chunks
+# from a server-side cursor; their memory footprint before and after decoding is recorded too (see memory_summary).
+# A result cache (see result_cache) plugged in with set_cache() is looked up before every read and filled after it.
+
+import re
+import time
+from collections import deque, namedtuple
+import pandas as pd, geopandas as gpd
+from sqlalchemy import text
+from .decoding import decode, concat_decoded, memory_bytes
+
+# sql with :name parameters; param_types, a list of (name, postgres type) in PREPARE order, or None for queries not
+# prepared
+Query = namedtuple('Query', ['sql', 'param_types'])
+# one timed read: query name, seconds, rows returned, whether it ran as a prepared statement, and for decoded reads the
+# bytes of the raw and of the decoded result (None otherwise), whether it was served by the result cache
+Timing = namedtuple('Timing', ['name', 'seconds', 'rows', 'prepared', 'raw_bytes', 'bytes', 'cached'])
+
+queries = {}
+timings = deque(maxlen=10000)
+timing_hooks = []
+use_prepared = True
+cache = None
+
+_bind = re.compile(r'(?<!:):(\w+)')
+
+
+def register(name, sql, param_types=None):
+    """
+    Registers a named query.
+
+    Parameters
+    ----------
+    name : str
+        Name of the query, also the name of its prepared statement. Has to be a valid SQL identifier.
+    sql : str
+        The query, with :name bound parameters.
+    param_types : list, optional
+        (parameter name, postgres type) pairs, e.g. [('ry_id', 'text'), ('ry_ids', 'text[]')], for queries to run as
+        prepared statements.
+
+    Returns
+    -------
+    The name
+    """
+    queries[name] = Query(sql, param_types)
+    return name
+
+
+def _prepared_call(conn, name, query):
+    """ EXECUTE statement of a query, PREPAREd first if this DBAPI connection hasn't seen it yet. """
+    prepared = conn.connection.info.setdefault('prepared_statements', set())
+    positions = dict((p, i + 1) for i, (p, _) in enumerate(query.param_types))
+    if name not in prepared:
+        conn.exec_driver_sql("PREPARE {} ({}) AS {}".format(
+            name, ', '.join(t for _, t in query.param_types),
+            _bind.sub(lambda m: "${}".format(positions[m.group(1)]), query.sql)))
+        prepared.add(name)
+    return text("EXECUTE {} ({})".format(name, ', '.join(':' + p for p, _ in query.param_types)))
+
+
+def set_cache(result_cache):
+    """ Plugs a result_cache.ResultCache in front of every read (None to remove it). Returns the previous one. """
+    global cache
+    previous, cache = cache, result_cache
+    return previous
+
+
+def _record(timing):
+    timings.append(timing)
+    for hook in timing_hooks:
+        hook(timing)
+
+
+def _chunks(conn, statement, params, chunksize):
+    # rows streamed from a server-side cursor, chunksize at a time; at least one (maybe empty) frame
+    result = conn.execution_options(stream_results=True).execute(statement, params)
+    columns = list(result.keys())
+    rows = result.fetchmany(chunksize)
+    yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+    while rows:
+        rows = result.fetchmany(chunksize)
+        if rows:
+            yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+def read(engine, name, params=None, geom_col=None, dtypes=None, chunksize=None):
+    """
+    Runs a registered query.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy Engine
+        Connection to the database.
+    name : str
+        Name the query was registered with.
+    params : dict, optional
+        Values of its parameters.
+    geom_col : str, optional
+        Geometry column, to get a GeoDataFrame back.
+    dtypes : dict, optional
+        Schema the result is decoded with, see decoding.decode.
+    chunksize : int, optional
+        Rows fetched and decoded at a time, for large results. Not used with geom_col.
+
+    Returns
+    -------
+    A Pandas DataFrame, or GeoDataFrame with geom_col
+    """
+    query = queries[name]
+    params = params or {}
+    t0 = time.perf_counter()
+    if cache is not None:
+        result = cache.get(engine, name, query.sql, params)
+        if result is not None:
+            _record(Timing(name, time.perf_counter() - t0, result.shape[0], False, None, None, True))
+            return result
+        # before the query runs, so the rows touched while it does invalidate its result
+        marks = cache.query_marks(engine, query.sql)
+    prepare = use_prepared and query.param_types is not None and engine.dialect.name == 'postgresql'
+    with engine.connect() as conn:
+        statement = _prepared_call(conn, name, query) if prepare else text(query.sql)
+        if geom_col is not None:
+            chunks = [gpd.GeoDataFrame.from_postgis(statement, con=conn, geom_col=geom_col, params=params)]
+        elif chunksize:
+            chunks = _chunks(conn, statement, params, chunksize)
+        else:
+            chunks = [pd.read_sql(statement, con=conn, params=params)]
+        raw_bytes = None
+        if dtypes is not None:
+            raw_bytes, decoded = 0, []
+            for chunk in chunks:
+                raw_bytes += memory_bytes(chunk)
+                decoded.append(decode(chunk, dtypes))
+            chunks = decoded
+        chunks = list(chunks)
+        result = chunks[0] if len(chunks) == 1 else concat_decoded(chunks)
+    _record(Timing(name, time.perf_counter() - t0, result.shape[0], prepare, raw_bytes,
+                   memory_bytes(result) if dtypes is not None else None, False))
+    if cache is not None:
+        cache.put(engine, name, query.sql, params, result, geom_col, marks)
+    return result
+
+
+def explain(engine, name, params=None, analyze=False):
+    """ Plan of a registered query, as text. With analyze, the query is run and the plan carries actual times and
+    buffer usage. """
+    options = "(ANALYZE, BUFFERS)" if analyze else ""
+    with engine.connect() as conn:
+        plan = conn.execute(text("EXPLAIN {} {}".format(options, queries[name].sql)), params or {}).fetchall()
+    return '\n'.join(' '.join(str(v) for v in row) for row in plan)
+
+
+def timing_summary():
+    """ Calls, cache hits, rows and seconds (mean, median, max, total) of the reads timed so far, by query, slowest total
+    first. """
+    frame = pd.DataFrame(list(timings), columns=Timing._fields)
+    if frame.empty:
+        return frame
+    return frame.groupby('name').agg(calls=('seconds', 'size'), cached=('cached', 'sum'), rows=('rows', 'mean'),
+                                     mean=('seconds', 'mean'),
+                                     median=('seconds', 'median'), max=('seconds', 'max'), total=('seconds', 'sum'))\
+                .sort_values('total', ascending=False)
+
+
+def memory_summary():
+    """ Raw and decoded size of the last decoded read of every query, in MB, with the fraction of memory saved. """
+    frame = pd.DataFrame([t for t in timings if t.bytes is not None and not t.cached], columns=Timing._fields)
+    if frame.empty:
+        return frame
+    last = frame.groupby('name').last()
+    return pd.DataFrame({"rows": last.rows,
+                         "raw_mb": last.raw_bytes / 2**20,
+                         "decoded_mb": last.bytes / 2**20,
+                         "saved": 1 - last.bytes / last.raw_bytes.where(last.raw_bytes > 0)})
@@ -0,0 +1,95 @@
+# Vectorized rent roll.
+# Expands lease intervals into quarterly (or monthly) buckets with array arithmetic instead of one pd.date_range frame
+# per lease: every lease adds its rent to a difference array at its first bucket and removes it after its last one,
+# and a cumulative sum over the bucket axis gives the rent of every bucket and group. A lease counts in every bucket
+# whose end date falls within [start, end], the same buckets pd.date_range(start, end, freq='Q') gives.
+
+import pandas as pd, numpy as np
+
+bucket_months = {'Q': 3, 'M': 1}
+bucket_names = {'Q': 'Quarter', 'M': 'Month'}
+
+
+def _bucket_ordinals(dates, months):
+    """ Bucket of every date, as an integer counting buckets since year 0. """
+    return (dates.dt.year.values * 12 + dates.dt.month.values - 1) // months
+
+
+def _bucket_end_dates(ordinals, months):
+    month_idx = ordinals * months + months - 1
+    firsts = pd.to_datetime(pd.DataFrame({'year': month_idx // 12, 'month': month_idx % 12 + 1, 'day': 1}))
+    return firsts + pd.offsets.MonthEnd(0)
+
+
+def rent_roll(leases, start_col='Start Date', end_col='End Date', rent_col='Rent', group_col='Address', freq='Q',
+              escalation=None, area_average=True):
+    """
+    Rent received by every group (building) in every quarter or month, for a set of leases.
+
+    Parameters
+    ----------
+    leases : Pandas DataFrame
+        One row per lease, with its start and end dates, rent and group.
+    start_col, end_col, rent_col, group_col : str, optional
+        Columns holding the lease start and end dates, the rent counted in every bucket and the group.
+    freq : str, optional
+        'Q' for quarterly buckets, 'M' for monthly ones.
+    escalation : float or str, optional
+        Yearly rent escalation, e.g. 0.03, either for every lease or as the name of a column holding it per lease. The
+        rent steps up every 12 months after the first bucket of the lease.
+    area_average : bool, optional
+        Adds an "Area Average" column with the mean over the groups of every bucket.
+
+    Returns
+    -------
+    A Pandas DataFrame indexed by the bucket end dates, one column per group, NaN where a group has no lease
+    """
+    months = bucket_months[freq]
+    per_year = 12 // months
+    leases = leases.loc[leases[start_col].notna() & leases[end_col].notna()]
+    starts = pd.to_datetime(leases[start_col]).dt.normalize()
+    ends = pd.to_datetime(leases[end_col]).dt.normalize()
+    first = _bucket_ordinals(starts, months)
+    # the last bucket counted is the one of the end date only when the end date is its last day
+    next_days = ends + pd.Timedelta(days=1)
+    ends_bucket = (next_days.dt.day.values == 1) & ((next_days.dt.month.values - 1) % months == 0)
+    last = _bucket_ordinals(ends, months) - (~ends_bucket).astype('int64')
+    rents = leases[rent_col].astype('float64').fillna(0.).values
+    groups, group_idx = np.unique(leases[group_col].astype(str).values, return_inverse=True)
+
+    keep = last >= first
+    first, last, rents, group_idx = first[keep], last[keep], rents[keep], group_idx[keep]
+    if escalation is not None:
+        rates = leases.loc[keep, escalation].astype('float64').fillna(0.).values if isinstance(escalation, str) \
+                    else np.full(first.shape[0], float(escalation))
+        # one segment per lease year, with its escalated rent
+        n_years = (last - first) // per_year + 1
+        lease_of = np.repeat(np.arange(first.shape[0]), n_years)
+        year = np.arange(lease_of.shape[0]) - np.repeat(np.cumsum(n_years) - n_years, n_years)
+        seg_first = first[lease_of] + year * per_year
+        seg_last = np.minimum(seg_first + per_year - 1, last[lease_of])
+        first, last, group_idx = seg_first, seg_last, group_idx[lease_of]
+        rents = rents[lease_of] * (1 + rates[lease_of]) ** year
+
+    name = bucket_names[freq]
+    if first.shape[0] == 0:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name=name), columns=pd.Index([], name=group_col))
+    origin = first.min()
+    n_buckets = last.max() - origin + 2
+    # difference arrays of rent and of number of leases, cumulated over the buckets
+    rent_diff = np.zeros((n_buckets, groups.shape[0]))
+    count_diff = np.zeros((n_buckets, groups.shape[0]), dtype='int64')
+    np.add.at(rent_diff, (first - origin, group_idx), rents)
+    np.add.at(rent_diff, (last - origin + 1, group_idx), -rents)
+    np.add.at(count_diff, (first - origin, group_idx), 1)
+    np.add.at(count_diff, (last - origin + 1, group_idx), -1)
+    rent = np.cumsum(rent_diff, axis=0)[:-1]
+    covered = np.cumsum(count_diff, axis=0)[:-1] > 0
+    rent[~covered] = np.nan
+
+    with_leases = covered.any(axis=1)
+    index = pd.DatetimeIndex(_bucket_end_dates(np.arange(origin, origin + n_buckets - 1)[with_leases], months), name=name)
+    roll = pd.DataFrame(rent[with_leases], index=index, columns=pd.Index(groups, name=group_col))
+    if area_average:
+        roll.loc[:, "Area Average"] = roll.mean(axis=1)
+    return roll
@@ -0,0 +1,222 @@
+# Local cache of query results.
+# queries.read looks results up here before going to the database, once a cache is plugged in with queries.set_cache:
+#   - entries are keyed on the database, the query (name and sql) and its parameters
+#   - the last max_entries results are kept in memory (LRU), and all of them on disk, as parquet (pickle for frames
+#     parquet can't hold), so a restarted notebook starts warm
+#   - every entry expires after the TTL of the tables its query reads (the shortest one)
+#   - entries reading tables with a touched_at column are invalidated once its high-water mark moves past the mark seen
+#     at fetch time; the marks are read at most every mark_interval seconds
+#   - offline, entries are served whatever their age and marks, and a miss raises instead of reaching the database
+
+import os
+import re
+import json
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd, geopandas as gpd
+from sqlalchemy import text
+
+DEFAULT_PATH = "./data/query_cache"
+
+DAY = 24 * 3600
+# seconds an entry stays valid, by table read
+table_ttls = {'properties_ry': 7 * DAY,
+              'properties_f42': 7 * DAY,
+              'ck_to_ry': 7 * DAY,
+              'f42_to_ry': 7 * DAY,
+              'leases_ck': DAY,
+              'listings_f42': DAY}
+# tables carrying a touched_at high-water mark
+touched_tables = ['leases_ck', 'listings_f42']
+
+_table_ref = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)', re.IGNORECASE)
+
+
+class OfflineMiss(LookupError):
+    """ Raised in offline mode for a query with no cached result. """
+
+
+def query_tables(sql):
+    """ Tables of table_ttls a query reads. """
+    return sorted(set(_table_ref.findall(sql)) & set(table_ttls))
+
+
+class ResultCache:
+
+    def __init__(self, path=DEFAULT_PATH, max_entries=256, ttls=None, default_ttl=DAY, mark_interval=60,
+                 offline=False):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            Directory of the on-disk entries. None keeps the cache in memory only.
+        max_entries : int, optional
+            Number of results kept in memory.
+        ttls : dict, optional
+            Overrides of table_ttls, in seconds.
+        default_ttl : int, optional
+            TTL of queries reading none of the tables of table_ttls, in seconds.
+        mark_interval : int, optional
+            Seconds between two reads of the touched_at high-water marks.
+        offline : bool, optional
+            Serve every request from the cache, never reaching the database.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttls = dict(table_ttls, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.mark_interval = mark_interval
+        self.offline = offline
+        self.memory = OrderedDict()
+        self.marks = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(engine, name, sql, params):
+        database = "{}/{}".format(engine.url.host, engine.url.database) if engine is not None else ""
+        raw = json.dumps([database, name, sql, params], sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def ttl(self, sql):
+        tables = query_tables(sql)
+        return min(self.ttls[t] for t in tables) if tables else self.default_ttl
+
+    def current_marks(self, engine, tables):
+        """ touched_at high-water marks of tables, read from the database at most every mark_interval seconds. """
+        now = time.time()
+        stale = [t for t in tables if t not in self.marks or now - self.marks[t][0] > self.mark_interval]
+        if stale:
+            marks_query = "SELECT {}".format(', '.join("(SELECT MAX(touched_at) FROM {0}) AS {0}".format(t) for t in stale))
+            with engine.connect() as conn:
+                row = conn.execute(text(marks_query)).fetchone()
+            for t, mark in zip(stale, row):
+                self.marks[t] = (now, str(mark) if mark is not None else None)
+        return dict((t, self.marks[t][1]) for t in tables)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def _load(self, key):
+        base = self._entry_path(key)
+        if not os.path.exists(base + ".json"):
+            return None
+        with open(base + ".json") as f:
+            meta = json.load(f)
+        try:
+            if meta['format'] == 'pickle':
+                with open(base + ".pkl", 'rb') as f:
+                    frame = pickle.load(f)
+            elif meta['geom_col'] is not None:
+                frame = gpd.read_parquet(base + ".parquet")
+            else:
+                frame = pd.read_parquet(base + ".parquet")
+        except Exception as e:
+            print("Error while reading cached result {}.\n{}".format(key, e))
+            return None
+        return frame, meta
+
+    def _store(self, key, frame, meta):
+        base = self._entry_path(key)
+        try:
+            frame.to_parquet(base + ".parquet.tmp")
+            os.replace(base + ".parquet.tmp", base + ".parquet")
+            meta['format'] = 'parquet'
+        except Exception:
+            if os.path.exists(base + ".parquet.tmp"):
+                os.remove(base + ".parquet.tmp")
+            # object columns parquet can't hold (e.g. json aggregates), pickled instead
+            with open(base + ".pkl.tmp", 'wb') as f:
+                pickle.dump(frame, f)
+            os.replace(base + ".pkl.tmp", base + ".pkl")
+            meta['format'] = 'pickle'
+        with open(base + ".json.tmp", 'w') as f:
+            json.dump(meta, f)
+        os.replace(base + ".json.tmp", base + ".json")
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _valid(self, engine, sql, meta):
+        if time.time() - meta['fetched_at'] > self.ttl(sql):
+            return False
+        marked = meta['marks']
+        if marked:
+            current = self.current_marks(engine, sorted(marked))
+            if any(current[t] is not None and (marked[t] is None or current[t] > marked[t]) for t in marked):
+                return False
+        return True
+
+    def get(self, engine, name, sql, params):
+        """ Cached result of a query, as a copy, or None when missing or no longer valid. Offline, a missing result
+        raises OfflineMiss. """
+        key = self.key(engine, name, sql, params)
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is None and self.path is not None:
+                entry = self._load(key)
+            if entry is not None and (self.offline or self._valid(engine, sql, entry[1])):
+                self._remember(key, entry)
+                self.hits += 1
+                return entry[0].copy()
+            self.misses += 1
+            if self.offline:
+                raise OfflineMiss("No cached result for query {} with parameters {}.".format(name, params))
+            return None
+
+    def query_marks(self, engine, sql):
+        """ touched_at marks of the tables a query reads, to be read before the query runs and passed to put: a row
+        touched in between then invalidates the entry, instead of counting as seen. """
+        with self._lock:
+            return self.current_marks(engine, [t for t in query_tables(sql) if t in touched_tables])
+
+    def put(self, engine, name, sql, params, frame, geom_col=None, marks=None):
+        """ Caches the result of a query, with the touched_at marks of the tables it reads, as read by query_marks
+        before the query ran (read now when not given). """
+        key = self.key(engine, name, sql, params)
+        tables = query_tables(sql)
+        if marks is None:
+            marks = self.query_marks(engine, sql)
+        with self._lock:
+            meta = {'name': name,
+                    'tables': tables,
+                    'fetched_at': time.time(),
+                    'geom_col': geom_col,
+                    'marks': marks}
+            entry = (frame.copy(), meta)
+            self._remember(key, entry)
+            if self.path is not None:
+                self._store(key, entry[0], meta)
+
+    def invalidate(self, table=None):
+        """ Drops the entries reading table, or every entry. Returns the number of entries dropped from disk. """
+        with self._lock:
+            self.marks.clear()
+            for key in [k for k, (_, meta) in self.memory.items() if table is None or table in meta.get('tables', [])]:
+                del self.memory[key]
+            dropped = 0
+            if self.path is None:
+                return dropped
+            for f in [f for f in os.listdir(self.path) if f.endswith(".json")]:
+                with open(os.path.join(self.path, f)) as fp:
+                    meta = json.load(fp)
+                if table is None or table in meta.get('tables', []):
+                    for ext in (".json", ".parquet", ".pkl"):
+                        if os.path.exists(os.path.join(self.path, f[:-5] + ext)):
+                            os.remove(os.path.join(self.path, f[:-5] + ext))
+                    dropped += 1
+            return dropped
+
+    def stats(self):
+        on_disk = len([f for f in os.listdir(self.path) if f.endswith(".json")]) if self.path is not None else 0
+        return {"in_memory": len(self.memory), "on_disk": on_disk, "hits": self.hits, "misses": self.misses,
+                "offline": self.offline}
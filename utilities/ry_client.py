@@ -0,0 +1,120 @@
+# Batch engine for Reonomy's batch endpoints (match, get multiple).
+# Requests go through one pooled keep-alive session, several batches are kept in flight at once on a thread pool,
+# rate-limited (429) and server-error (5xx) answers are retried with backoff (honoring Retry-After), and every batch that
+# still fails is reported on its own instead of being folded into the results.
+
+import time
+import random
+import itertools
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# outcome of one batch: its batch number in the job, the payload sent, the decoded json answer (None on failure),
+# the error message (None on success) and the number of attempts made
+BatchResult = namedtuple('BatchResult', ['batch', 'payload', 'result', 'error', 'attempts'])
+
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+class BatchClient:
+
+    def __init__(self, auth=None, max_in_flight=4, max_retries=5, backoff=1., max_backoff=60., timeout=120):
+        """
+        Parameters
+        ----------
+        auth : tuple, optional
+            (user, api key) sent with every request.
+        max_in_flight : int, optional
+            Number of batches posted concurrently; also the size of the connection pool.
+        max_retries : int, optional
+            Retries of a batch answered with 429/5xx or failing at the connection level, before giving up on it.
+        backoff : float, optional
+            Base of the exponential backoff, in seconds, when the answer carries no Retry-After header.
+        max_backoff : float, optional
+            Cap of a single wait, in seconds.
+        timeout : float, optional
+            Timeout of a single request, in seconds.
+        """
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.failures = []
+
+    def _wait_time(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.)
+
+    def post(self, url, payload, batch=0):
+        """
+        Posts one batch, retrying on rate limits and transient errors. Never raises, returns a BatchResult.
+        payload can also be a callable building the request body, it is then called here, on the worker thread.
+        """
+        if callable(payload):
+            try:
+                payload = payload()
+            except Exception as e:
+                return BatchResult(batch, None, None, "Error while building the request: {} {}".format(e, e.args), 0)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                if response.status_code not in retry_statuses:
+                    response.raise_for_status()
+                    return BatchResult(batch, payload, response.json(), None, attempt + 1)
+                error = "HTTP {}".format(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            except Exception as e:
+                # other client errors and undecodable answers won't get better on retry
+                return BatchResult(batch, payload, None, str(e), attempt + 1)
+            if attempt < self.max_retries:
+                time.sleep(self._wait_time(attempt, response))
+        return BatchResult(batch, payload, None, error, self.max_retries + 1)
+
+    def run(self, url, payloads, batch_ids=None):
+        """
+        Posts every payload to url, keeping up to max_in_flight batches in flight.
+
+        Parameters
+        ----------
+        url : str
+            Endpoint to post to.
+        payloads : iterable
+            Json-serializable request bodies, or callables building them, consumed lazily.
+        batch_ids : iterable, optional
+            Batch number of every payload in the job, carried into its BatchResult, e.g. the batches left to do on a
+            resumed job. Defaults to the positions of the payloads.
+
+        Returns
+        -------
+        A generator of BatchResult, in the order of the payloads. Failed batches are also appended to self.failures
+        """
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            in_flight = deque()
+            for batch, payload in zip(batch_ids if batch_ids is not None else itertools.count(), payloads):
+                in_flight.append(pool.submit(self.post, url, payload, batch))
+                if len(in_flight) >= self.max_in_flight:
+                    yield self._collect(in_flight.popleft().result())
+            while in_flight:
+                yield self._collect(in_flight.popleft().result())
+
+    def _collect(self, res):
+        if res.error is not None:
+            self.failures.append(res)
+            print("Batch {} failed after {} attempt(s): {}".format(res.batch, res.attempts, res.error))
+        return res
@@ -0,0 +1,99 @@
+# Spatial index over a building layer.
+# Wraps shapely's STRtree so that point-in-polygon and closest-polygon lookups stop scanning every footprint of the city,
+# while returning exactly the rows the full-table scans in BldgFinder and Building picked:
+#   - predicate queries return every matching row, in the order of the layer (same as a boolean mask on the frame)
+#   - nearest queries return the single closest row, ties going to the first row of the layer
+# The tree is bulk-loaded from the layer geometries, which the building store already persists pre-parsed, in a few
+# milliseconds per city; it is built once per loaded layer and kept alongside it.
+
+import numpy as np
+import shapely
+from shapely import STRtree
+
+# STRtree evaluates predicate(query geometry, layer geometry); the frame scans it replaces evaluate
+# predicate(layer geometry, query geometry), e.g. df.geometry.contains(point), so asymmetric predicates are swapped
+_swapped_predicates = {'contains': 'within', 'within': 'contains',
+                       'covers': 'covered_by', 'covered_by': 'covers'}
+
+
+class BldgIndex:
+
+    def __init__(self, geometry):
+        self.geometries = np.asarray(geometry)
+        self.tree = STRtree(self.geometries)
+
+    def __len__(self):
+        return self.geometries.shape[0]
+
+    def query(self, geom, predicate='intersects'):
+        """ Positions of the layer rows whose geometry satisfies predicate(row, geom), in layer order. """
+        return np.sort(self.tree.query(geom, predicate=_swapped_predicates.get(predicate, predicate)))
+
+    def nearest(self, geom):
+        """ Position of the layer row closest to geom, with its distance (in layer units, i.e. degrees). """
+        idx, dist = self.tree.query_nearest(geom, all_matches=True, return_distance=True)
+        if idx.shape[0] == 0:
+            return None, np.nan
+        return int(idx.min()), float(dist.min())
+
+    def query_bulk(self, geoms, predicate='intersects'):
+        """
+        Vectorized predicate query for an array of geometries, predicate(row, geom) as in query.
+
+        Returns
+        -------
+        Two aligned arrays (input positions, layer positions), sorted by input then layer position
+        """
+        input_idx, tree_idx = self.tree.query(np.asarray(geoms), predicate=_swapped_predicates.get(predicate, predicate))
+        order = np.lexsort((tree_idx, input_idx))
+        return input_idx[order], tree_idx[order]
+
+    def nearest_bulk(self, geoms):
+        """
+        Vectorized nearest query for an array of geometries.
+
+        Returns
+        -------
+        Two arrays aligned with geoms: position of the closest layer row (ties to the first row) and its distance
+        """
+        geoms = np.asarray(geoms)
+        (input_idx, tree_idx), dist = self.tree.query_nearest(geoms, all_matches=True, return_distance=True)
+        nearest_idx = np.full(geoms.shape[0], -1, dtype='int64')
+        nearest_dist = np.full(geoms.shape[0], np.nan)
+        # first (smallest) layer position of every input, after sorting by input then layer position
+        order = np.lexsort((tree_idx, input_idx))
+        inputs, first = np.unique(input_idx[order], return_index=True)
+        nearest_idx[inputs] = tree_idx[order][first]
+        nearest_dist[inputs] = dist[order][first]
+        return nearest_idx, nearest_dist
+
+    def closest_bulk(self, geoms):
+        """
+        Vectorized version of the footprint matching of Building.get_closest_bldg: for every geometry, the single row that
+        contains it, else intersects it, else touches it; the nearest row when there is no hit or more than one.
+
+        Returns
+        -------
+        Array aligned with geoms of the matched layer positions, -1 for missing geometries
+        """
+        geoms = np.asarray(geoms, dtype=object)
+        valid = np.array([isinstance(g, shapely.Geometry) and not g.is_empty for g in geoms], dtype=bool)
+        chosen = np.full(geoms.shape[0], -1, dtype='int64')
+        pending = np.flatnonzero(valid)
+        needs_nearest = []
+        for predicate in ['contains', 'intersects', 'touches']:
+            if pending.shape[0] == 0:
+                break
+            inp, rows = self.query_bulk(geoms[pending], predicate=predicate)
+            counts = np.bincount(inp, minlength=pending.shape[0])
+            single = counts == 1
+            first = np.searchsorted(inp, np.flatnonzero(single))
+            chosen[pending[single]] = rows[first]
+            needs_nearest.append(pending[counts > 1])
+            pending = pending[counts == 0]
+        needs_nearest.append(pending)
+        needs_nearest = np.concatenate(needs_nearest)
+        if needs_nearest.shape[0] > 0:
+            chosen[needs_nearest] = self.nearest_bulk(geoms[needs_nearest])[0]
+        return chosen
+
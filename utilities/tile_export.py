@@ -0,0 +1,379 @@
+# Export of the building footprint layer for web maps.
+# folium.Polygon writes every building it draws into the map html as a list of coordinate pairs, with its own tooltip and
+# popup javascript, so a map of a district weighs several MB. Here the layer is written once as a pyramid of GeoJSON
+# tiles, in the usual web-mercator (slippy map) tiling:
+#     <tile_dir>/<z>/<x>/<y>.geojson
+# every building stored, at every zoom, in each tile its bounding box touches, under its row position as feature id. At
+# every zoom the footprints are simplified to a pixel, their coordinates quantized to a quarter of a pixel, and buildings
+# smaller than min_pixels are left out, so the low zooms stay light. tiles.json lists the zooms and the tiles written.
+# Maps load the tiles from the browser (add_tiles): after every pan or zoom, the tiles in view not loaded yet are fetched
+# from the tile server and their buildings not drawn yet are added, so the html holds no footprint at all. The tiles
+# have to be served with CORS headers, as the map runs on another origin (a notebook, a file):
+#     python -m utilities.tile_export --port 8001 --directory ./data/bldg_tiles
+# Maps embed only the few buildings they highlight, simplified and quantized the same way, as a single GeoJSON layer
+# (add_buildings).
+# (Mapbox vector tiles would need a protobuf encoder and a Leaflet plugin; GeoJSON tiles are read by Leaflet as is.)
+
+import os
+import json
+import html
+import argparse
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import numpy as np, pandas as pd
+import shapely
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+from .popups import escape
+
+TILE_DIR = "./data/bldg_tiles"
+TILE_SIZE = 256
+ZOOMS = (14, 15, 16, 17)
+
+highlight_style = {'color': 'red', 'fillColor': '#FF0000'}
+context_style = {'color': '#555555', 'weight': 1, 'fillColor': '#999999', 'fillOpacity': 0.3}
+
+
+def degrees_per_pixel(zoom):
+    """ Longitude span of a pixel at zoom. """
+    return 360. / (TILE_SIZE * 2**zoom)
+
+
+def tile_xy(lon, lat, zoom):
+    """ x and y of the tiles holding every (lon, lat), at zoom. """
+    n = 2**zoom
+    lat = np.radians(np.clip(np.asarray(lat, dtype='float64'), -85.0511, 85.0511))
+    x = np.floor((np.asarray(lon, dtype='float64') + 180.) / 360. * n)
+    y = np.floor((1. - np.log(np.tan(lat) + 1. / np.cos(lat)) / np.pi) / 2. * n)
+    return np.clip(x, 0, n - 1).astype('int64'), np.clip(y, 0, n - 1).astype('int64')
+
+
+def simplify(geometry, zoom, min_pixels=0.):
+    """
+    Footprints as drawn at zoom: simplified to a pixel and snapped to the decimal grid under a quarter pixel (so their
+    coordinates print with few digits), all at once.
+
+    Parameters
+    ----------
+    geometry : GeoSeries or array of shapely geometries
+        Footprints, in lon/lat.
+    zoom : int
+        Web map zoom level.
+    min_pixels : float, optional
+        Footprints whose bounding box is smaller than this many pixels on both sides come back empty.
+
+    Returns
+    -------
+    A numpy array of shapely geometries, empty for the footprints left out
+    """
+    pixel = degrees_per_pixel(zoom)
+    geoms = shapely.simplify(np.asarray(geometry), pixel, preserve_topology=True)
+    geoms = shapely.set_precision(geoms, 10. ** np.floor(np.log10(pixel / 4.)))
+    if min_pixels > 0:
+        bounds = shapely.bounds(geoms)
+        small = ((bounds[:, 2] - bounds[:, 0]) < min_pixels * pixel) & ((bounds[:, 3] - bounds[:, 1]) < min_pixels * pixel)
+        geoms[small] = shapely.Polygon()
+    return geoms
+
+
+def _features(geoms, properties, ids):
+    # GeoJSON text of every feature, the geometries serialized by GEOS in one vectorized call; the ids (row positions in
+    # the layer) let folium style the features of a layer it doesn't embed
+    geojson = shapely.to_geojson(geoms)
+    if properties is None or properties.shape[1] == 0:
+        props = ["{}"] * len(geoms)
+    else:
+        props = properties.to_json(orient='records', lines=True, date_format='iso').splitlines()
+    return ['{{"type":"Feature","id":{},"properties":{},"geometry":{}}}'.format(i, p, g)
+            for i, p, g in zip(ids, props, geojson)]
+
+
+def _escaped_properties(frame):
+    # text columns html-escaped, as the map clients insert the property values as html; numbers and booleans as is
+    frame = frame.copy()
+    for column in frame.columns:
+        if not (pd.api.types.is_numeric_dtype(frame[column]) or pd.api.types.is_bool_dtype(frame[column])):
+            frame[column] = escape(frame[column])
+    return frame
+
+
+def _collection(features):
+    return '{{"type":"FeatureCollection","features":[{}]}}'.format(','.join(features))
+
+
+def feature_collection(layer, zoom=16, properties=None, min_pixels=0.):
+    """
+    Simplified, quantized GeoJSON of a set of buildings.
+
+    Parameters
+    ----------
+    layer : GeoDataFrame
+        Buildings, in lon/lat.
+    zoom : int, optional
+        Zoom the footprints are simplified for.
+    properties : list or Pandas DataFrame, optional
+        Columns of layer, or a frame aligned with it, carried as feature properties.
+    min_pixels : float, optional
+        Buildings smaller than this many pixels at zoom are left out.
+
+    Returns
+    -------
+    The FeatureCollection, as JSON text
+    """
+    if properties is not None and not isinstance(properties, pd.DataFrame):
+        properties = layer[list(properties)]
+    geoms = simplify(layer.geometry, zoom, min_pixels)
+    keep = np.flatnonzero(~shapely.is_empty(geoms))
+    return _collection(_features(geoms[keep], properties.iloc[keep] if properties is not None else None, keep))
+
+
+def export_tiles(layer, zooms=ZOOMS, tile_dir=TILE_DIR, properties=('id',), min_pixels=1.):
+    """
+    Writes the building layer as GeoJSON tiles, <tile_dir>/<z>/<x>/<y>.geojson, and their list, <tile_dir>/tiles.json.
+
+    Parameters
+    ----------
+    layer : GeoDataFrame
+        Footprint layer, in lon/lat, e.g. BldgFinder.bldg_data or Building.osm_data.
+    zooms : iterable, optional
+        Zoom levels to export.
+    tile_dir : str, optional
+        Root directory of the tiles.
+    properties : iterable or Pandas DataFrame, optional
+        Columns of the layer carried in the tiles (missing ones are skipped), their text html-escaped, or an escaped
+        frame aligned with the layer, e.g. the popup attribute table of BldgFinder.popups(..., table=True).
+    min_pixels : float, optional
+        Buildings smaller than this many pixels at a zoom are left out of its tiles.
+
+    Returns
+    -------
+    A dict, zoom -> number of tiles written
+    """
+    if isinstance(properties, pd.DataFrame):
+        props = properties.reset_index(drop=True)
+    else:
+        props = _escaped_properties(layer[[c for c in properties if c in layer.columns]].reset_index(drop=True))
+    written = {}
+    tiles_written = {}
+    for zoom in zooms:
+        geoms = simplify(layer.geometry, zoom, min_pixels)
+        keep = np.flatnonzero(~shapely.is_empty(geoms))
+        features = np.array(_features(geoms[keep], props.iloc[keep], keep), dtype=object)
+        # every tile the bounding box of a building touches, one (feature, x, y) row per tile, so footprints crossing
+        # into a tile are drawn with it
+        bounds = shapely.bounds(geoms[keep])
+        x0, y1 = tile_xy(bounds[:, 0], bounds[:, 1], zoom)
+        x1, y0 = tile_xy(bounds[:, 2], bounds[:, 3], zoom)
+        nx, count = x1 - x0 + 1, (x1 - x0 + 1) * (y1 - y0 + 1)
+        feature = np.repeat(np.arange(keep.shape[0]), count)
+        k = np.arange(feature.shape[0]) - np.repeat(np.cumsum(count) - count, count)
+        x, y = x0[feature] + k % nx[feature], y0[feature] + k // nx[feature]
+        # features grouped by tile in a single sort
+        order = np.lexsort((y, x))
+        tiles, starts = np.unique(np.stack([x[order], y[order]], axis=1), axis=0, return_index=True)
+        for (tx, ty), group in zip(tiles, np.split(order, starts[1:])):
+            path = os.path.join(tile_dir, str(zoom), str(tx))
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, "{}.geojson".format(ty)), 'w') as f:
+                f.write(_collection(features[feature[group]]))
+        written[zoom] = len(tiles)
+        tiles_written[zoom] = tiles.tolist()
+        print("Wrote {:,} bldgs in {:,} tiles at zoom {}".format(len(keep), len(tiles), zoom))
+    with open(os.path.join(tile_dir, "tiles.json"), 'w') as f:
+        json.dump({'zooms': list(zooms), 'properties': list(props.columns), 'min_pixels': min_pixels,
+                   'tiles': dict((str(z), t) for z, t in tiles_written.items())}, f)
+    return written
+
+
+class _TileLayer(MacroElement):
+    """ Leaflet GeoJSON layer filled from the exported tiles, as the map is panned and zoomed. """
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var url = {{ this.tiles_url|tojson }}, style = {{ this.style|tojson }};
+            var tooltip = {{ this.tooltip|tojson }}, fields = {{ this.popup_fields|tojson }};
+            var labels = {{ this.popup_labels|tojson }};
+            var layer = L.geoJSON(null, {
+                style: function() { return style; },
+                onEachFeature: function(feature, shape) {
+                    // text property values are html-escaped at export, see export_tiles
+                    var p = feature.properties;
+                    if (tooltip !== null && p[tooltip] != null) { shape.bindTooltip(String(p[tooltip])); }
+                    if (fields.length) {
+                        shape.bindPopup('<table>' + fields.map(function(f, i) {
+                            return '<tr><th>' + labels[i] + '</th><td>' + (p[f] == null ? '' : p[f]) + '</td></tr>';
+                        }).join('') + '</table>', {maxWidth: 300});
+                    }
+                }
+            }).addTo(map);
+            var zooms = [], exported = {}, zoom = null, loaded = {}, drawn = {};
+            function tileX(lon, z) { return Math.floor((lon + 180) / 360 * Math.pow(2, z)); }
+            function tileY(lat, z) {
+                var r = Math.max(Math.min(lat, 85.0511), -85.0511) * Math.PI / 180;
+                return Math.floor((1 - Math.log(Math.tan(r) + 1 / Math.cos(r)) / Math.PI) / 2 * Math.pow(2, z));
+            }
+            function update() {
+                if (!zooms.length) { return; }
+                // closest exported zoom at or below the map one; nothing drawn below the lowest, too many tiles
+                var below = zooms.filter(function(z) { return z <= map.getZoom(); });
+                var z = below.length ? Math.max.apply(null, below) : null;
+                if (z !== zoom) { layer.clearLayers(); loaded = {}; drawn = {}; zoom = z; }
+                if (z === null) { return; }
+                var b = map.getBounds();
+                for (var x = tileX(b.getWest(), z); x <= tileX(b.getEast(), z); x++) {
+                    for (var y = tileY(b.getNorth(), z); y <= tileY(b.getSouth(), z); y++) {
+                        var key = z + '/' + x + '/' + y;
+                        if (loaded[key] || !exported[key]) { continue; }
+                        loaded[key] = true;
+                        fetch(url + '/' + key + '.geojson').then(function(r) { return r.json(); }).then(
+                            (function(tz) { return function(data) {
+                                if (tz !== zoom) { return; }
+                                // buildings spanning several tiles are in each of them, drawn once
+                                data.features = data.features.filter(function(f) {
+                                    if (drawn[f.id]) { return false; }
+                                    drawn[f.id] = true;
+                                    return true;
+                                });
+                                layer.addData(data);
+                            }; })(z));
+                    }
+                }
+            }
+            fetch(url + '/tiles.json').then(function(r) { return r.json(); }).then(function(index) {
+                zooms = index.zooms;
+                Object.keys(index.tiles).forEach(function(z) {
+                    index.tiles[z].forEach(function(t) { exported[z + '/' + t[0] + '/' + t[1]] = true; });
+                });
+                update();
+            });
+            map.on('moveend', update);
+        })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, tiles_url, style, tooltip=None, popup_fields=None):
+        super().__init__()
+        self._name = 'BldgTiles'
+        self.tiles_url = tiles_url.rstrip('/')
+        self.style = style
+        self.tooltip = tooltip
+        self.popup_fields = list(popup_fields or [])
+        self.popup_labels = [html.escape(str(f)) for f in self.popup_fields]
+
+
+def add_tiles(fmap, tiles_url, style=None, tooltip=None, popup_fields=None):
+    """
+    Draws the buildings of the exported tiles on a folium map, loaded by the browser from tiles_url after every pan or
+    zoom (the tiles in view not loaded yet), rather than embedded.
+
+    Parameters
+    ----------
+    fmap : folium Map
+        Map to draw on.
+    tiles_url : str
+        URL the tile directory is served at, with CORS headers (see serve_tiles).
+    style : dict, optional
+        Leaflet path style of the footprints. Defaults to context_style.
+    tooltip : str, optional
+        Tile property shown as tooltip.
+    popup_fields : list, optional
+        Tile properties shown as popup table.
+
+    Returns
+    -------
+    The layer element
+    """
+    return _TileLayer(tiles_url, style or context_style, tooltip, popup_fields).add_to(fmap)
+
+
+class _CorsHandler(SimpleHTTPRequestHandler):
+    """ Static files, readable by pages of any origin. """
+
+    extensions_map = dict(SimpleHTTPRequestHandler.extensions_map, **{'.geojson': 'application/geo+json',
+                                                                      '.json': 'application/json'})
+
+    def end_headers(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_tiles(tile_dir=TILE_DIR, host='127.0.0.1', port=8001):
+    """ Http server of the tile directory, with the CORS header the maps need, not started yet (serve_forever, or in a
+    thread). port 0 picks a free one. """
+    server = ThreadingHTTPServer((host, port), functools.partial(_CorsHandler, directory=tile_dir))
+    server.daemon_threads = True
+    return server
+
+
+def _attribute_popup(fields):
+    # table of the feature properties, laid out by Leaflet; add_buildings takes the attributes escaped, as
+    # PopupTemplate.table gives them
+    return folium.GeoJsonPopup(fields=list(fields), localize=False, maxWidth=300)
+
+
+def add_buildings(fmap, layer, zoom=16, tooltips=None, popups=None, attributes=None, style=None):
+    """
+    Draws a few buildings on a folium map as one embedded GeoJSON layer.
+
+    Parameters
+    ----------
+    fmap : folium Map
+        Map to draw on.
+    layer : GeoDataFrame
+        Buildings to draw, in lon/lat.
+    zoom : int, optional
+        Zoom the footprints are simplified for, usually the zoom of the map.
+    tooltips, popups : list, optional
+        Tooltip text (html-escaped here) and popup html of every building.
+    attributes : Pandas DataFrame, optional
+        Escaped attribute table of the buildings, aligned with layer (see popups.PopupTemplate.table), carried as
+        feature properties and shown as popup table, instead of popups.
+    style : dict, optional
+        Leaflet path style of the footprints. Defaults to highlight_style.
+
+    Returns
+    -------
+    The folium GeoJson layer
+    """
+    properties = pd.DataFrame(index=range(layer.shape[0]))
+    popup = None
+    if tooltips is not None:
+        properties['tooltip'] = escape(pd.Series(list(tooltips), dtype=object)).values
+    if popups is not None:
+        properties['popup'] = list(popups)
+        popup = folium.GeoJsonPopup(fields=['popup'], labels=False, localize=False, maxWidth=300)
+    elif attributes is not None:
+        for column in attributes.columns:
+            properties[column] = attributes[column].values
+        popup = _attribute_popup(attributes.columns)
+    style = style or highlight_style
+    data = json.loads(feature_collection(layer.reset_index(drop=True), zoom, properties))
+    return folium.GeoJson(data, style_function=lambda feature: style,
+                          tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False) if tooltips is not None else None,
+                          popup=popup).add_to(fmap)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the building tiles to the maps, with CORS headers.")
+    parser.add_argument('--directory', default=TILE_DIR)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+    server = serve_tiles(args.directory, args.host, args.port)
+    print("Serving {} on http://{}:{}".format(args.directory, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()